@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Benchmark cases for the firmware build path.
+
+Every case is a setup function registered with @case: it receives a
+scratch directory, prepares its input data there (deterministic, so runs
+are comparable) and returns the callable that is timed. Raise Skip when a
+tool or module is not available on this machine.
+"""
+import io
+import os
+import sys
+import random
+import shutil
+import subprocess
+import importlib.util
+from contextlib import redirect_stderr
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+TOOLS_DIR = os.path.join(PROJECT_ROOT, "heystack-nrf5x", "tools")
+for path in (PROJECT_ROOT, TOOLS_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import zip_stream
+import content_store
+import firmware_image
+
+APP_SIZE = 96 * 1024          # application image (nRF52810 app region is ~100 KB)
+SD_SIZE = 100 * 1024          # S112 SoftDevice
+SD_BASE, APP_BASE = 0x00000, 0x19000
+KEYS = 200                    # keys per device, as the web UI generates
+KEY_SIZE = 28
+
+CASES = []
+
+
+class Skip(Exception):
+    pass
+
+
+def case(name, number=1, unit="call"):
+    """Register a case; `number` calls are timed per repetition, results are per call"""
+    def register(setup):
+        CASES.append({"name": name, "setup": setup, "number": number, "unit": unit,
+                      "doc": (setup.__doc__ or "").strip()})
+        return setup
+    return register
+
+
+# --- Input data ---
+def rng(tag):
+    return random.Random(f"nrf5-bench-{tag}")
+
+
+def firmware_bytes(size, placeholder=None):
+    data = bytearray(rng(f"fw{size}").randbytes(size))
+    if placeholder:
+        offset = size * 3 // 4  # the key table lives in .rodata, near the end
+        data[offset:offset + len(placeholder)] = placeholder
+    return data
+
+
+def hex_text(base, data):
+    """Intel HEX of `data` at `base`, 16 bytes per record like objcopy"""
+    blocks = content_store.split_blocks([(base, data)])
+    contents = {content_store.digest(b): b for _, b in blocks}
+    manifest = {"blocks": [[a, len(b), content_store.digest(b)] for a, b in blocks]}
+    return content_store.render_hex(manifest, contents.get)
+
+
+def keyfile_bytes(nkeys):
+    return bytes([nkeys & 0xFF]) + rng(f"keys{nkeys}").randbytes(nkeys * KEY_SIZE)
+
+
+def write(path, data):
+    with open(path, "wb" if isinstance(data, (bytes, bytearray)) else "w") as f:
+        f.write(data)
+    return path
+
+
+def need_module(name):
+    if importlib.util.find_spec(name) is None:
+        raise Skip(f"python module '{name}' not installed")
+
+
+def need_tool(name):
+    path = shutil.which(name)
+    if not path:
+        raise Skip(f"'{name}' not on PATH")
+    return path
+
+
+# --- Key generation ---
+@case("derive_key", number=200, unit="key")
+def bench_derive_key(work):
+    """SHA256(seed || counter) -> SECP224R1 public key, as the dynamic firmware derives it"""
+    need_module("cryptography")
+    from generate_keys_from_seed import derive_key
+    seed = rng("seed").randbytes(32)
+    counter = iter(range(10 ** 9))
+    return lambda: derive_key(seed, next(counter))
+
+
+@case("generate_keys_e2e")
+def bench_generate_keys(work):
+    """generate_keys.py for one device (200 keys), process start included"""
+    need_module("cryptography")
+    out = os.path.join(work, "keys") + os.sep
+    cmd = [sys.executable, os.path.join(TOOLS_DIR, "generate_keys.py"), "-n", str(KEYS), "-p", "BENCH", "-o", out]
+
+    def run():
+        shutil.rmtree(out, ignore_errors=True)
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return run
+
+
+# --- Patching ---
+@case("placeholder_patch", number=50)
+def bench_placeholder_patch(work):
+    """Find the key placeholder in a 96 KB image and write a 200-key table over it"""
+    image = firmware_bytes(APP_SIZE, firmware_image.KEY_PLACEHOLDER)
+    payload = keyfile_bytes(KEYS)[1:]
+
+    def run():
+        fw_data = bytearray(image)
+        if firmware_image.patch_placeholder(fw_data, firmware_image.KEY_PLACEHOLDER, payload) == -1:
+            raise RuntimeError("placeholder not found")
+    return run
+
+
+# --- bin <-> hex ---
+@case("objcopy_bin_to_hex")
+def bench_objcopy_bin_to_hex(work):
+    """arm-none-eabi-objcopy binary -> ihex with --change-addresses (the patch step)"""
+    tool = need_tool("arm-none-eabi-objcopy")
+    src = write(os.path.join(work, "app.bin"), firmware_bytes(APP_SIZE))
+    dst = os.path.join(work, "app.hex")
+    cmd = [tool, "-I", "binary", "-O", "ihex", "--change-addresses", hex(APP_BASE), src, dst]
+    return lambda: subprocess.run(cmd, check=True)
+
+
+@case("objcopy_hex_to_bin")
+def bench_objcopy_hex_to_bin(work):
+    """arm-none-eabi-objcopy ihex -> binary (unpacking the build output)"""
+    tool = need_tool("arm-none-eabi-objcopy")
+    src = write(os.path.join(work, "app.hex"), hex_text(APP_BASE, firmware_bytes(APP_SIZE)))
+    dst = os.path.join(work, "app.bin")
+    return lambda: subprocess.run([tool, "-I", "ihex", "-O", "binary", src, dst], check=True)
+
+
+@case("hex_manifest", number=5)
+def bench_hex_manifest(work):
+    """Parse a 96 KB application HEX into hashed 4 KB blocks (content_store.build_manifest)"""
+    text = hex_text(APP_BASE, firmware_bytes(APP_SIZE))
+    return lambda: content_store.build_manifest(text)
+
+
+@case("hex_render", number=5)
+def bench_hex_render(work):
+    """Rebuild the HEX text from a manifest and its blocks (bridge side)"""
+    manifest, contents = content_store.build_manifest(hex_text(APP_BASE, firmware_bytes(APP_SIZE)))
+    return lambda: content_store.render_hex(manifest, contents.get)
+
+
+# --- Images and bundles ---
+@case("sd_merge", number=10)
+def bench_sd_merge(work):
+    """SoftDevice + application HEX merged into the full WebUSB image"""
+    sd = write(os.path.join(work, "sd.hex"), hex_text(SD_BASE, firmware_bytes(SD_SIZE)))
+    app = write(os.path.join(work, "app.hex"), hex_text(APP_BASE, firmware_bytes(APP_SIZE)))
+    out = os.path.join(work, "full.hex")
+    return lambda: firmware_image.merge_hex(sd, app, out)
+
+
+def bundle_members(work):
+    members = [("BENCH.hex", write(os.path.join(work, "BENCH.hex"), hex_text(APP_BASE, firmware_bytes(APP_SIZE)))),
+               ("softdevice.hex", write(os.path.join(work, "softdevice.hex"), hex_text(SD_BASE, firmware_bytes(SD_SIZE)))),
+               ("BENCH_keyfile", write(os.path.join(work, "BENCH_keyfile"), keyfile_bytes(KEYS))),
+               ("flash.sh", write(os.path.join(work, "flash.sh"), "#!/bin/bash\n" * 40))]
+    return members
+
+
+@case("zip_bundle_deflate", number=5)
+def bench_zip_bundle_deflate(work):
+    """Offline bundle (app + SoftDevice HEX, keyfile, script) written with deflate"""
+    members = bundle_members(work)
+    out = os.path.join(work, "bundle.zip")
+    return lambda: zip_stream.write_zip(out, members, "deflate")
+
+
+@case("zip_bundle_store", number=5)
+def bench_zip_bundle_store(work):
+    """The same bundle stored uncompressed (batch archive default)"""
+    members = bundle_members(work)
+    out = os.path.join(work, "bundle.zip")
+    return lambda: zip_stream.write_zip(out, members, "store")
+
+
+# --- Key files ---
+@case("showmac_extract", number=5)
+def bench_showmac_extract(work):
+    """showmac.extract_macs on a 20000-key file (a batch of 100 devices)"""
+    from showmac import extract_macs
+    path = write(os.path.join(work, "big_keyfile"), keyfile_bytes(20000))
+
+    def run():
+        with redirect_stderr(io.StringIO()):  # count byte overflows: it warns on every call
+            macs = extract_macs(path)
+        if len(macs) != 20000:
+            raise RuntimeError(f"expected 20000 MACs, got {len(macs)}")
+    return run
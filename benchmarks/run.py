@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Benchmark runner.
+
+    python3 benchmarks/run.py                  # all cases, compared with baseline.json
+    python3 benchmarks/run.py -k hex           # cases whose name contains "hex"
+    python3 benchmarks/run.py --save-baseline  # accept this run as the new baseline
+
+Each case is warmed up once, then timed `--repeat` times; the median time
+per call is compared with the baseline. A case slower than the baseline by
+more than the threshold (default 25 %, per-case "threshold" in the
+baseline file overrides it) is a regression and the exit code is 1.
+Results are written as JSON to benchmarks/results/.
+
+Timings depend on the machine, so baseline.json is not committed: generate
+it with --save-baseline on the machine that will run the comparisons (before
+the change being measured), then compare later runs against it.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cases import CASES, Skip, BENCH_DIR
+
+BASELINE_FILE = os.path.join(BENCH_DIR, "baseline.json")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+DEFAULT_REPEAT = 7
+DEFAULT_THRESHOLD = 0.25
+
+
+def machine_info():
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+def run_case(c, repeat):
+    work = tempfile.mkdtemp(prefix=f"bench_{c['name']}_")
+    try:
+        try:
+            func = c["setup"](work)
+        except Skip as e:
+            return {"skipped": str(e)}
+        func()  # warm-up: imports, page cache
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for _ in range(c["number"]):
+                func()
+            times.append((time.perf_counter() - t0) / c["number"])
+        median = statistics.median(times)
+        return {"median_s": median, "min_s": min(times), "mean_s": statistics.fmean(times),
+                "stdev_s": statistics.stdev(times) if len(times) > 1 else 0.0,
+                "per_s": round(1 / median, 1) if median else None, "unit": c["unit"],
+                "number": c["number"], "repeat": repeat}
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def compare(results, baseline, threshold):
+    """Adds "baseline_s" / "change" / "regression" to every timed result; returns the regressed names"""
+    regressed = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if "median_s" not in r or not base or not base.get("median_s"):
+            continue
+        limit = base.get("threshold", threshold)
+        r["baseline_s"] = base["median_s"]
+        r["change"] = round(r["median_s"] / base["median_s"] - 1, 3)
+        r["regression"] = r["change"] > limit
+        if r["regression"]:
+            regressed.append(name)
+    return regressed
+
+
+def fmt_time(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds * 1e6:.1f} us"
+
+
+def print_table(results):
+    print(f"{'case':<22} {'median':>10} {'min':>10} {'rate':>14} {'baseline':>10} {'change':>8}")
+    for name, r in results.items():
+        if "skipped" in r:
+            print(f"{name:<22} {'skipped: ' + r['skipped']}")
+            continue
+        rate = f"{r['per_s']:g} {r['unit']}/s" if r["per_s"] else "-"
+        base = fmt_time(r["baseline_s"]) if "baseline_s" in r else "-"
+        change = f"{r['change']:+.0%}" if "change" in r else "-"
+        flag = "  REGRESSION" if r.get("regression") else ""
+        print(f"{name:<22} {fmt_time(r['median_s']):>10} {fmt_time(r['min_s']):>10} {rate:>14} {base:>10} {change:>8}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Firmware build path benchmarks")
+    parser.add_argument("-k", dest="filter", help="only cases whose name contains this")
+    parser.add_argument("--list", action="store_true", help="list cases and exit")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown vs. baseline (0.25 = 25%%)")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="write this run as the baseline")
+    parser.add_argument("--output", help="results file (default: results/<timestamp>.json)")
+    args = parser.parse_args()
+
+    cases = [c for c in CASES if not args.filter or args.filter in c["name"]]
+    if args.list:
+        for c in cases:
+            print(f"{c['name']:<22} {c['doc']}")
+        return 0
+
+    results = {}
+    for c in cases:
+        print(f"... {c['name']}", file=sys.stderr)
+        results[c["name"]] = run_case(c, args.repeat)
+
+    try:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {"cases": {}}
+    regressed = compare(results, baseline.get("cases", {}), args.threshold)
+    print_table(results)
+    if not baseline.get("cases"):
+        print(f"\nNo baseline at {args.baseline}, so no regressions were checked: "
+              f"generate one on this machine first with --save-baseline")
+    elif baseline.get("machine") and baseline["machine"] != machine_info():
+        print(f"\nWarning: baseline was recorded on another machine ({baseline['machine'].get('platform')})")
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "machine": machine_info(),
+              "baseline_machine": baseline.get("machine"), "cases": results}
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime("%Y%m%d_%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"\nResults: {output}")
+
+    if args.save_baseline:
+        cases_out = dict(baseline.get("cases", {}))
+        for name, r in results.items():
+            if "median_s" in r:
+                entry = {"median_s": r["median_s"], "unit": r["unit"]}
+                if "threshold" in cases_out.get(name, {}):
+                    entry["threshold"] = cases_out[name]["threshold"]
+                cases_out[name] = entry
+        with open(args.baseline, "w") as f:
+            json.dump({"created": report["created"], "machine": report["machine"], "cases": cases_out}, f, indent=1)
+        print(f"Baseline saved: {args.baseline}")
+        return 0
+
+    if regressed:
+        print(f"Regressions (> {args.threshold:.0%} slower): {', '.join(regressed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
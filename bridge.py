@@ -2,13 +2,29 @@
 import os
 import sys
 import threading
-import subprocess
 import time
+import json
+import tempfile
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+import toolchain
+import usb_inventory
+import content_store
+import proc_runner
+import probe_select
+from job_queue import JobScheduler, FINAL_STATES
 
 # --- Configuration ---
 PORT = 5001
+FLASH_WORKERS = 4   # probes flashed in parallel; each probe still runs one job at a time
+JOB_HISTORY = 100
+
+# OpenOCD interface per debugger type (usb_inventory ids; '4' = J-Link driven by OpenOCD)
+OPENOCD_INTERFACES = {
+    '2': 'interface/stlink.cfg',
+    '3': 'interface/cmsis-dap.cfg',   # DAPLink / CMSIS-DAP
+    '4': 'interface/jlink.cfg',
+}
 
 # --- Bundle Resource Path Helper ---
 if getattr(sys, 'frozen', False):
@@ -60,44 +76,54 @@ CHIP_NAME_TO_KEY = {
 
 app = Flask(__name__)
 
+# Toolchain capabilities, rescanned at startup
+toolchain.load(os.path.join(TEMP_DIR, "toolchain.json"))
+
+# Attached probes, kept fresh by one background thread
+USB_INVENTORY = usb_inventory.UsbInventory()
+
+# Firmware blocks received so far; repeat flashes only transfer what is missing
+CONTENT = content_store.ContentStore(os.path.join(TEMP_DIR, "content"))
+
 # --- Helpers ---
 def log(msg, level="info"):
     timestamp = datetime.now().strftime('%H:%M:%S')
     print(f"[{timestamp}] [{level.upper()}] {msg}")
 
 def run_command(cmd, cwd=None, timeout=None):
+    # One event loop drives every tool process; the timeout holds even if the tool hangs silently
     try:
-        proc = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, timeout=timeout)
-        combined_output = (proc.stdout + "\n" + proc.stderr).strip()
-        if proc.returncode != 0:
-            return False, combined_output
-        return True, combined_output
-    except subprocess.TimeoutExpired:
-        return False, "Timeout"
+        result = proc_runner.run(cmd, cwd=cwd, timeout=timeout)
     except Exception as e:
         return False, str(e)
+    if result.timed_out:
+        return False, "Timeout"
+    return result.returncode == 0, result.output
 
 # --- Core Logic ---
-def perform_flash(CHIP_CFG, patch_hex, debugger_type, flash_sd=False, timeout_val=None, probe_only=False):
+def perform_flash(CHIP_CFG, patch_hex, debugger_type, flash_sd=False, timeout_val=None, probe_only=False, probe_serial=None):
     # Resolve paths relative to PROJECT_ROOT (resource bundle)
     sd_path = os.path.join(PROJECT_ROOT, CHIP_CFG['sd_hex'])
+    # Every command names the job's probe; otherwise the tool opens whichever it finds first
+    snr = probe_select.nrfjprog_args(probe_serial)
     
     if debugger_type == '1': # J-Link
         nrfjprog_success = False
-        if not probe_only: 
+        if not probe_only and toolchain.has_tool("nrfjprog"): 
             try:
                 if flash_sd:
-                    run_command(["nrfjprog", "-f", CHIP_CFG['family'], "--program", sd_path, "--chiperase"], timeout=10)
-                s, o = run_command(["nrfjprog", "-f", CHIP_CFG['family'], "--program", patch_hex, "--sectorerase", "--verify"], timeout=10)
+                    run_command(["nrfjprog", "-f", CHIP_CFG['family']] + snr + ["--program", sd_path, "--chiperase"], timeout=10)
+                s, o = run_command(["nrfjprog", "-f", CHIP_CFG['family']] + snr + ["--program", patch_hex, "--sectorerase", "--verify"], timeout=10)
                 if s:
-                    run_command(["nrfjprog", "-f", CHIP_CFG['family'], "--reset"], timeout=5)
+                    run_command(["nrfjprog", "-f", CHIP_CFG['family']] + snr + ["--reset"], timeout=5)
                     nrfjprog_success = True
                     log("SUCCESS (nrfjprog)", "success")
             except: pass
 
         if not nrfjprog_success:
             # JLinkExe Logic
-            jlink_script_path = os.path.join(TEMP_DIR, "flash_cmd.jlink")
+            fd, jlink_script_path = tempfile.mkstemp(prefix="flash_cmd_", suffix=".jlink", dir=TEMP_DIR)
+            os.close(fd)  # one command file per flash: concurrent jobs never share it
             jlink_device = ""
             if CHIP_CFG['family'] == 'nrf51': jlink_device = "nRF51822_xxAA"
             elif CHIP_CFG['name'] == 'nRF52832': jlink_device = "nRF52832_xxAA"
@@ -131,14 +157,17 @@ def perform_flash(CHIP_CFG, patch_hex, debugger_type, flash_sd=False, timeout_va
             
             t_jlink = timeout_val if timeout_val else 20
             # Note: We assume JLinkExe is in PATH
-            success, output = run_command(["JLinkExe", "-CommandFile", jlink_script_path], timeout=t_jlink)
-            if os.path.exists(jlink_script_path): os.remove(jlink_script_path)
+            try:
+                success, output = run_command(["JLinkExe"] + probe_select.jlink_args(probe_serial) + ["-CommandFile", jlink_script_path], timeout=t_jlink)
+            finally:
+                if os.path.exists(jlink_script_path): os.remove(jlink_script_path)
             
             if not success or "Cannot connect" in output or "FAILED" in output:
                  raise Exception("JLinkExe failed: Connection Error")
             if not probe_only: log("SUCCESS (JLinkExe)", "success")
             
-    else: # ST-Link
+    else: # OpenOCD: ST-Link, DAPLink, J-Link via OpenOCD
+        interface = get_openocd_interface(debugger_type)
         flash_family = CHIP_CFG['family']
         o_cmds = []
         if probe_only:
@@ -152,31 +181,37 @@ def perform_flash(CHIP_CFG, patch_hex, debugger_type, flash_sd=False, timeout_va
         
         t_st = timeout_val if timeout_val else 20
         # Note: We assume openocd is in PATH, config is relative to bundled resources
-        # We need to make sure openocd can find 'interface/stlink.cfg' and target config.
-        # If openocd is standard install, interface/stlink.cfg checks out.
+        # We need to make sure openocd can find the interface config and target config.
+        # If openocd is standard install, the stock interface/*.cfg check out.
         # But CHIP_CFG['openocd_target'] is 'target/nrf52.cfg', which might need standard scripts path.
         # Ideally we pass '-s <scripts_dir>' but for standard install we hope it works or we bundle scripts.
         # For now, rely on standard installation.
-        success, output = run_command(["openocd", "-f", "interface/stlink.cfg", "-f", CHIP_CFG['openocd_target'], "-c", "; ".join(o_cmds)], timeout=t_st)
-        if not success: raise Exception(f"OpenOCD: {output}")
-        if not probe_only: log("SUCCESS (OpenOCD/ST-Link)", "success")
+        success, output = run_command(["openocd", "-f", interface] + probe_select.openocd_args(probe_serial) +
+                                      ["-f", CHIP_CFG['openocd_target'], "-c", "; ".join(o_cmds)], timeout=t_st)
+        if not success: raise Exception(f"OpenOCD ({interface}): {output}")
+        if not probe_only: log(f"SUCCESS (OpenOCD/{interface})", "success")
+
+def get_openocd_interface(debugger_type):
+    return OPENOCD_INTERFACES.get(str(debugger_type), 'interface/stlink.cfg')
+
+def detected_debugger_type(probe_serial=None):
+    """Debugger type of the attached probe (the one with `probe_serial`, else the first); '2' if none"""
+    USB_INVENTORY.start()
+    for p in USB_INVENTORY.list():
+        if not probe_serial or p['serial'] == probe_serial:
+            return p['debugger']
+    return '2'
 
 def check_hardware_connection(config, chip_cfg):
-    debugger_type = config.get('debugger', '2')
+    debugger_type = config.get('debugger') or detected_debugger_type(config.get('probe_serial'))
     debugger_info = None
     
-    # Step 1: Check debugger (macOS specific command, works on Bridge/Mac)
-    try:
-        cmd = "ioreg -p IOUSB -l"
-        output = subprocess.check_output(cmd, shell=True).decode('utf-8')
-        
-        if debugger_type == '1':  # J-Link
-            if "J-Link" in output:
-                debugger_info = "Segger J-Link"
-        else:  # ST-Link
-            if "STLink" in output or "ST-Link" in output or "STLINK" in output or "stlink" in output.lower():
-                debugger_info = "ST-Link V2/V3"
-    except: pass
+    # Step 1: Check debugger (from the background USB inventory)
+    USB_INVENTORY.start()
+    for p in USB_INVENTORY.list(probe_select.inventory_type(debugger_type)):
+        if not config.get('probe_serial') or p['serial'] == config.get('probe_serial'):
+            debugger_info = p['name']
+            break
     
     if not debugger_info:
         return False, None, None, 'debugger_missing', "Debugger not found"
@@ -203,25 +238,62 @@ def home():
 
 @app.route('/api/detect_debugger')
 def api_detect_debugger():
-    # Simple check for ST-Link presence
+    # Served from memory; the inventory thread does the scanning
+    USB_INVENTORY.start()
+    probes = USB_INVENTORY.list()
+    return jsonify({
+        "connected": bool(probes),
+        "name": probes[0]['name'] if probes else None,
+        "debugger": probes[0]['debugger'] if probes else None,
+        "probes": probes
+    })
+
+@app.route('/api/content/missing', methods=['POST'])
+def api_content_missing():
+    """Which blocks of an image the bridge still needs. Payload: { "manifest": {...} } or { "hashes": [...] }"""
+    data = request.json or {}
+    try:
+        hashes = content_store.manifest_hashes(data['manifest']) if 'manifest' in data else data.get('hashes', [])
+        missing = CONTENT.missing(hashes)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"missing": missing, "total": len(hashes)})
+
+@app.route('/api/content', methods=['POST'])
+def api_content_upload():
+    """Store a compressed block pack (the body, as served by the cloud's /api/content/pack)"""
     try:
-        cmd = "ioreg -p IOUSB -l"
-        output = subprocess.check_output(cmd, shell=True).decode('utf-8')
-        connected = "STLink" in output or "ST-Link" in output or "stlink" in output.lower() or "J-Link" in output
-        return jsonify({
-            "connected": connected,
-            "name": "ST-Link/J-Link" if connected else None
-        })
-    except:
-        return jsonify({"connected": False, "name": None})
+        received = CONTENT.put_pack(request.get_data())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"success": True, "received": len(received)})
+
+@app.route('/api/content/stats')
+def api_content_stats():
+    return jsonify(CONTENT.stats())
 
 @app.route('/api/flash_hex', methods=['POST'])
 def api_flash_hex():
+    """
+    Queue a flash: { "hex": "..." } or { "manifest": {...} } whose blocks were
+    uploaded to /api/content before (409 with the missing hashes otherwise).
+    Optional: "probe_serial", "priority", "wait": true (answer when done).
+    Returns a job_id to poll via /api/jobs/<id> or follow via /api/jobs/<id>/events.
+    """
     data = request.json
     hex_content = data.get('hex')
     chip_name = data.get('chip_name', 'nRF51822')
-    debugger = data.get('debugger', '2')
+    # Without an explicit type, drive the probe that is attached (e.g. DAPLink -> '3')
+    debugger = data.get('debugger') or detected_debugger_type(data.get('probe_serial'))
     
+    if not hex_content and data.get('manifest'):
+        try:
+            missing = CONTENT.missing(content_store.manifest_hashes(data['manifest']))
+            if missing:
+                return jsonify({"error": "Missing blocks", "missing": missing}), 409
+            hex_content = content_store.render_hex(data['manifest'], CONTENT.get)
+        except (ValueError, KeyError) as e:
+            return jsonify({"error": f"Invalid manifest: {e}"}), 400
     if not hex_content: return jsonify({"error": "Missing hex"}), 400
     
     # Resolve chip
@@ -232,20 +304,110 @@ def api_flash_hex():
             break
     if not target_chip: target_chip = CHIP_MAP['1'] # Default 51822
     
-    tmp_hex = os.path.join(TEMP_DIR, "bridge_flash.hex")
-    with open(tmp_hex, "w") as f:
+    # Unique per job: overlapping requests never overwrite each other's image
+    fd, tmp_hex = tempfile.mkstemp(prefix="bridge_flash_", suffix=".hex", dir=TEMP_DIR)
+    with os.fdopen(fd, "w") as f:
         f.write(hex_content)
-        
+
+    SCHEDULER.start()
+    probe_serial, probe = resolve_probe(debugger, data.get('probe_serial'))
+    job = SCHEDULER.submit("flash_hex", {"hex_path": tmp_hex, "chip": target_chip, "debugger": debugger,
+                                         "probe_serial": probe_serial},
+                           probe=probe,
+                           priority=data.get('priority', 0), requeue=False)
+    if data.get('wait'):
+        job = SCHEDULER.wait(job)
+        if job.state != "succeeded":
+            return jsonify({"success": False, "error": job.error or job.state, "job_id": job.id}), 500
+    return jsonify({"success": True, "job_id": job.id, "state": job.state, "position": SCHEDULER.position(job)})
+
+def resolve_probe(debugger_type, probe_serial=None):
+    """(probe serial the job's tools use, per-probe lock key): one job per attached probe at a time"""
+    USB_INVENTORY.start()
+    return probe_select.resolve(USB_INVENTORY.list(probe_select.inventory_type(debugger_type)), debugger_type, probe_serial)
+
+def run_flash_hex_job(job):
+    payload = job.payload
+    chip = payload["chip"]
     try:
-        log(f"Flashing {chip_name} via Debugger {debugger}...")
-        perform_flash(target_chip, tmp_hex, debugger, flash_sd=False, probe_only=False)
-        return jsonify({"success": True})
+        log(f"[{job.id}] Flashing {chip['name']} via Debugger {payload['debugger']}...")
+        SCHEDULER.run_stage(job, "flash", perform_flash, chip, payload["hex_path"], payload["debugger"],
+                            flash_sd=False, probe_only=False, probe_serial=payload.get("probe_serial"))
     except Exception as e:
-        log(f"Flash Error: {str(e)}", "error")
-        return jsonify({"success": False, "error": str(e)}), 500
+        log(f"[{job.id}] Flash Error: {str(e)}", "error")
+        raise
     finally:
-        if os.path.exists(tmp_hex): os.remove(tmp_hex)
+        if os.path.exists(payload["hex_path"]): os.remove(payload["hex_path"])
+    return {"chip": chip['name']}
+
+JOBS_CHANGED = threading.Condition()
+
+def on_job_change(job):
+    if job.state == "cancelled" and not job.started:
+        # Cancelled while queued: the handler never runs, so drop its image here
+        path = (job.payload or {}).get("hex_path")
+        if path and os.path.exists(path):
+            os.remove(path)
+    with JOBS_CHANGED:
+        JOBS_CHANGED.notify_all()
+
+SCHEDULER = JobScheduler({"flash_hex": run_flash_hex_job}, max_running=FLASH_WORKERS, per_session=1, per_probe=1,
+                         stage_workers={"flash": FLASH_WORKERS}, history=JOB_HISTORY, log_func=log)
+SCHEDULER.on_change(on_job_change)
+
+def job_info(job):
+    return dict(job.to_dict(), position=SCHEDULER.position(job))
+
+@app.route('/api/jobs')
+def api_jobs():
+    states = request.args.get('state')
+    jobs = SCHEDULER.list(states=states.split(',') if states else None)
+    return jsonify({"jobs": [job_info(j) for j in jobs], "stats": SCHEDULER.stats()})
+
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    job = SCHEDULER.get(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job_info(job))
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_job_cancel(job_id):
+    """Queued jobs are dropped; a flash already running finishes (the probe must not be left half-written)"""
+    return jsonify({"success": SCHEDULER.cancel(job_id)})
+
+@app.route('/api/jobs/<job_id>/events')
+def api_job_events(job_id):
+    """Server-Sent Events: one `job` event per change until the job is final"""
+    if not SCHEDULER.get(job_id):
+        return jsonify({"error": "Unknown job"}), 404
+
+    def generate():
+        last = None
+        while True:
+            job = SCHEDULER.get(job_id)
+            info = job_info(job) if job else None
+            if info != last:
+                last = info
+                yield f"event: job\ndata: {json.dumps(info)}\n\n"
+            if not job or job.state in FINAL_STATES:
+                return
+            with JOBS_CHANGED:
+                JOBS_CHANGED.wait(1.0)
+
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.route('/api/toolchain')
+def api_toolchain():
+    return jsonify(toolchain.snapshot())
+
+@app.route('/api/toolchain/refresh', methods=['POST'])
+def api_toolchain_refresh():
+    return jsonify(toolchain.scan(OPENOCD_INTERFACES, PROJECT_ROOT))
 
 if __name__ == '__main__':
+    toolchain.scan_async(OPENOCD_INTERFACES, PROJECT_ROOT)
+    USB_INVENTORY.start()
+    SCHEDULER.start()
     print(f"Starting Bridge on port {PORT}...")
-    app.run(host='0.0.0.0', port=PORT)
+    app.run(host='0.0.0.0', port=PORT, threaded=True)
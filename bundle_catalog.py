@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Indexed catalog of generated device bundles.
+
+/api/history used to glob CONFIG_DIR and every user_sessions/<id>/ directory
+and stat each bundle on every request. The catalog records a bundle when it
+is written and forgets it when it is deleted, so listing is an indexed query:
+sorted newest first, filterable by session, name prefix, chip and date, and
+paginated with opaque `next` tokens (keyset pagination, stable while new
+bundles keep arriving).
+
+The directories remain the source of truth: `rebuild()` rescans them (run
+once when the catalog is first created, or on demand).
+"""
+import os
+import glob
+import json
+import time
+import uuid
+import base64
+from datetime import datetime
+
+from state_store import SqliteDB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bundles (
+    key        TEXT PRIMARY KEY,
+    filename   TEXT NOT NULL,
+    name       TEXT NOT NULL,
+    source     TEXT NOT NULL,
+    session_id TEXT,
+    chip       TEXT,
+    size       INTEGER,
+    ts         REAL NOT NULL,
+    last_used  REAL
+);
+CREATE INDEX IF NOT EXISTS bundles_ts ON bundles (ts DESC, key DESC);
+CREATE INDEX IF NOT EXISTS bundles_session_ts ON bundles (session_id, ts DESC, key DESC);
+CREATE TABLE IF NOT EXISTS catalog_meta (k TEXT PRIMARY KEY, v TEXT);
+CREATE TABLE IF NOT EXISTS archives (
+    token   TEXT PRIMARY KEY,
+    files   TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+BUNDLE_SUFFIX = "_bundle.zip"
+MAX_PAGE = 1000
+ARCHIVE_TTL = 3600  # seconds a batch download link stays valid
+
+
+def bundle_key(source, session_id, filename):
+    return f"{session_id}/{filename}" if source == "session" else f"global/{filename}"
+
+
+def encode_cursor(ts, key):
+    raw = json.dumps([ts, key]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """(ts, key) from a `next` token; ValueError if it is not one of ours"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        ts, key = json.loads(raw)
+        return float(ts), str(key)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _like_prefix(prefix):
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+class BundleCatalog(SqliteDB):
+    SCHEMA = SCHEMA
+
+    def __init__(self, path, config_dir, sessions_dir):
+        self.config_dir = config_dir
+        self.sessions_dir = sessions_dir
+        super().__init__(path)
+        columns = [r["name"] for r in self.conn().execute("PRAGMA table_info(bundles)")]
+        if "last_used" not in columns:  # catalogs created before downloads were tracked
+            self.conn().execute("ALTER TABLE bundles ADD COLUMN last_used REAL")
+
+    # --- Updates ---
+    def add(self, bundle_path, session_id=None, chip=None):
+        """Record a bundle that has just been written"""
+        filename = os.path.basename(bundle_path)
+        source = "session" if session_id else "global"
+        try:
+            st = os.stat(bundle_path)
+        except OSError:
+            return None
+        with self.tx() as db:
+            db.execute("INSERT OR REPLACE INTO bundles (key, filename, name, source, session_id, chip, size, ts, last_used) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (bundle_key(source, session_id, filename), filename, filename[:-len(BUNDLE_SUFFIX)],
+                        source, session_id, chip, st.st_size, st.st_mtime, time.time()))
+        return filename
+
+    def remove(self, source, session_id, filename):
+        with self.tx() as db:
+            db.execute("DELETE FROM bundles WHERE key = ?", (bundle_key(source, session_id, filename),))
+
+    def touch(self, source, session_id, filename):
+        """Record a download (storage GC evicts least recently used bundles first)"""
+        with self.tx() as db:
+            db.execute("UPDATE bundles SET last_used = ? WHERE key = ?",
+                       (time.time(), bundle_key(source, session_id, filename)))
+
+    def last_used(self):
+        """{(session_id, filename): last use} for session bundles"""
+        rows = self.conn().execute("SELECT session_id, filename, COALESCE(last_used, ts) FROM bundles "
+                                   "WHERE source = 'session'").fetchall()
+        return {(r[0], r[1]): r[2] for r in rows}
+
+    def is_empty(self):
+        return self.conn().execute("SELECT v FROM catalog_meta WHERE k = 'built'").fetchone() is None
+
+    def rebuild(self):
+        """Rescan CONFIG_DIR and every session directory; returns the number of bundles found"""
+        rows = []
+        for fpath in glob.glob(os.path.join(self.config_dir, "*" + BUNDLE_SUFFIX)):
+            rows.append(self._row(fpath, "global", None))
+        if os.path.isdir(self.sessions_dir):
+            for sid in os.listdir(self.sessions_dir):
+                for fpath in glob.glob(os.path.join(self.sessions_dir, sid, "*" + BUNDLE_SUFFIX)):
+                    rows.append(self._row(fpath, "session", sid))
+        rows = [r for r in rows if r]
+        with self.tx() as db:
+            # Keep what rescans cannot recover: the chip and the last download
+            known = {r[0]: (r[1], r[2]) for r in db.execute("SELECT key, chip, last_used FROM bundles")}
+            merged = []
+            for r in rows:
+                chip, last_used = known.get(r[0], (None, None))
+                merged.append(r[:5] + (chip,) + r[6:] + (last_used,))
+            db.execute("DELETE FROM bundles")
+            db.executemany("INSERT INTO bundles (key, filename, name, source, session_id, chip, size, ts, last_used) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", merged)
+            db.execute("INSERT OR REPLACE INTO catalog_meta (k, v) VALUES ('built', ?)", (str(time.time()),))
+        return len(rows)
+
+    def _row(self, fpath, source, session_id):
+        filename = os.path.basename(fpath)
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        return (bundle_key(source, session_id, filename), filename, filename[:-len(BUNDLE_SUFFIX)],
+                source, session_id, None, st.st_size, st.st_mtime)
+
+    # --- Batch archives ---
+    def save_archive(self, files):
+        """Remember the bundle selection of a batch download; returns its token"""
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self.tx() as db:
+            db.execute("DELETE FROM archives WHERE created < ?", (now - ARCHIVE_TTL,))
+            db.execute("INSERT INTO archives (token, files, created) VALUES (?, ?, ?)",
+                       (token, json.dumps(files), now))
+        return token
+
+    def archive(self, token):
+        """The selection saved under `token`, or None if unknown or expired"""
+        row = self.conn().execute("SELECT files FROM archives WHERE token = ? AND created >= ?",
+                                  (token, time.time() - ARCHIVE_TTL)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # --- Queries ---
+    def query(self, session_id=None, prefix=None, chip=None, since=None, until=None, limit=100, cursor=None):
+        """
+        One page of bundles, newest first. Returns (files, next_token, total);
+        next_token is None on the last page.
+        """
+        where, args = [], []
+        if session_id:
+            where.append("session_id = ?")
+            args.append(session_id)
+        if prefix:
+            where.append("name LIKE ? ESCAPE '\\'")
+            args.append(_like_prefix(prefix))
+        if chip:
+            where.append("chip = ?")
+            args.append(chip)
+        if since is not None:
+            where.append("ts >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("ts < ?")
+            args.append(until)
+        filters = (" WHERE " + " AND ".join(where)) if where else ""
+        db = self.conn()
+        total = db.execute("SELECT COUNT(*) FROM bundles" + filters, args).fetchone()[0]
+
+        page_where, page_args = list(where), list(args)
+        if cursor:
+            ts, key = decode_cursor(cursor)
+            page_where.append("(ts < ? OR (ts = ? AND key < ?))")
+            page_args += [ts, ts, key]
+        limit = max(1, min(int(limit), MAX_PAGE))
+        sql = "SELECT * FROM bundles"
+        if page_where:
+            sql += " WHERE " + " AND ".join(page_where)
+        sql += " ORDER BY ts DESC, key DESC LIMIT ?"
+        rows = db.execute(sql, page_args + [limit + 1]).fetchall()
+
+        files = [self._file(r) for r in rows[:limit]]
+        next_token = encode_cursor(rows[limit - 1]["ts"], rows[limit - 1]["key"]) if len(rows) > limit else None
+        return files, next_token, total
+
+    def _file(self, r):
+        f = {"name": r["name"], "filename": r["filename"], "ts": r["ts"],
+             "time": datetime.fromtimestamp(r["ts"]).strftime('%Y-%m-%d %H:%M:%S'),
+             "source": r["source"], "chip": r["chip"], "size": r["size"]}
+        if r["session_id"]:
+            f["session_id"] = r["session_id"]
+        return f
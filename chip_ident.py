@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Single-session nRF5 chip identification.
+
+Reads FICR INFO.PART, FICR DEVICEID and the UICR protection word in ONE
+debugger session (JLinkExe command file, one OpenOCD run, or a single
+nrfjprog memory read), bounded by a latency budget, instead of probing
+family by family with a separate process each time.
+
+`runner(cmd, timeout)` must behave like run_command(): returns
+(success, output).
+"""
+import os
+import re
+import time
+import tempfile
+
+import probe_select
+
+FICR_DEVICEID = 0x10000060
+FICR_INFO_PART = 0x10000100
+UICR_RBPCONF = 0x10001004    # nRF51 readback protection
+UICR_APPROTECT = 0x10001208  # nRF52 access port protection
+
+PART_NAMES = {
+    0x51822: ("nRF51822", "nrf51"),
+    0x52832: ("nRF52832", "nrf52"),
+    0x52810: ("nRF52810", "nrf52"),
+    0x52811: ("nRF52811", "nrf52"),
+    0x52833: ("nRF52833", "nrf52"),
+    0x52840: ("nRF52840", "nrf52"),
+}
+
+# "0x10000100: 00052832" (nrfjprog / OpenOCD) and "10000100 = 00052832" (JLinkExe)
+_WORDS_RE = re.compile(r"^[ \t]*(?:0x)?([0-9a-fA-F]{8})[ \t]*[:=][ \t]*((?:(?:0x)?[0-9a-fA-F]{8}[ \t]*)+)", re.M)
+
+PROTECTION_HINTS = ["approtect", "protection", "protected", "secured",
+                    "ap lock", "locked"]
+
+
+def parse_words(output):
+    """Map address -> 32-bit value for every memory dump line in `output`"""
+    words = {}
+    for m in _WORDS_RE.finditer(output or ""):
+        addr = int(m.group(1), 16)
+        for i, tok in enumerate(m.group(2).split()):
+            words[addr + 4 * i] = int(tok, 16)
+    return words
+
+
+def decode(words):
+    """Turn raw FICR/UICR words into a chip description (or None if INFO.PART missing)"""
+    part = words.get(FICR_INFO_PART)
+    if part is None:
+        return None
+    name, family = PART_NAMES.get(part, (f"nRF{part:X}", None))
+    device_id = None
+    if FICR_DEVICEID in words and FICR_DEVICEID + 4 in words:
+        device_id = f"{words[FICR_DEVICEID + 4]:08X}{words[FICR_DEVICEID]:08X}"
+    if family == "nrf51":
+        rbp = words.get(UICR_RBPCONF)
+        # PALL (bits 15:8) == 0x00 means readback protection of the whole flash
+        approtect = None if rbp is None else ((rbp >> 8) & 0xFF) == 0x00
+    else:
+        ap = words.get(UICR_APPROTECT)
+        # PALL 0x00 = Enabled; 0xFF (erased) and 0x5A (HwDisabled) leave the port open
+        approtect = None if ap is None else (ap & 0xFF) == 0x00
+    return {"part": f"0x{part:05X}", "name": name, "family": family,
+            "device_id": device_id, "approtect": approtect}
+
+
+def _result(ok, chip=None, error_type=None, error=None, backend=None, started=None):
+    res = {"ok": ok, "error_type": error_type, "error": error, "backend": backend,
+           "elapsed_ms": round((time.monotonic() - started) * 1000, 1) if started else None}
+    res.update(chip or {"part": None, "name": None, "family": None, "device_id": None, "approtect": None})
+    return res
+
+
+def _classify_failure(output, backend, started):
+    low = (output or "").lower()
+    if any(h in low for h in PROTECTION_HINTS):
+        return _result(False, error_type="chip_protected", backend=backend, started=started,
+                       error="芯片已被保护（APPROTECT 启用）。请执行 recover / mass erase 解锁。")
+    if output == "Timeout":
+        return _result(False, error_type="chip_disconnected", backend=backend, started=started,
+                       error="芯片识别超时。请检查连线。")
+    return _result(False, error_type="chip_disconnected", backend=backend, started=started,
+                   error=f"无法识别芯片型号。请检查连线。 ({(output or '').strip()[:100]})")
+
+
+def _jlink_session(runner, budget, speed_khz, probe_serial=None):
+    fd, script = tempfile.mkstemp(suffix=".jlink")
+    with os.fdopen(fd, "w") as f:
+        # Generic core: the family is not known yet
+        f.write("device Cortex-M0\nsi SWD\n")
+        f.write(f"speed {speed_khz}\nconnect\n")
+        f.write(f"mem32 {FICR_DEVICEID:08X} 2\n")
+        f.write(f"mem32 {FICR_INFO_PART:08X} 1\n")
+        f.write(f"mem32 {UICR_RBPCONF:08X} 1\n")
+        f.write(f"mem32 {UICR_APPROTECT:08X} 1\n")
+        f.write("exit\n")
+    try:
+        return runner(["JLinkExe", "-NoGui", "1"] + probe_select.jlink_args(probe_serial) + ["-CommandFile", script], timeout=budget)
+    finally:
+        os.remove(script)
+
+
+def _nrfjprog_session(runner, budget, probe_serial=None):
+    # One read covering DEVICEID .. INFO.PART; family UNKNOWN works across nRF51/52
+    n = FICR_INFO_PART + 4 - FICR_DEVICEID
+    return runner(["nrfjprog", "-f", "UNKNOWN"] + probe_select.nrfjprog_args(probe_serial) + ["--memrd", hex(FICR_DEVICEID), "--w", "32", "--n", str(n)], timeout=budget)
+
+
+def _openocd_session(runner, budget, interface_cfg, target_cfg, speed_khz, probe_serial=None):
+    reads = [f"mdw 0x{FICR_DEVICEID:08x} 2", f"mdw 0x{FICR_INFO_PART:08x}",
+             f"mdw 0x{UICR_RBPCONF:08x}", f"mdw 0x{UICR_APPROTECT:08x}"]
+    # catch each read so a protected UICR does not abort the whole session
+    script = "init; " + "; ".join(f"catch {{echo [capture {{{r}}}]}}" for r in reads) + "; shutdown"
+    return runner(["openocd", "-f", interface_cfg] + probe_select.openocd_args(probe_serial) + ["-f", target_cfg,
+                   "-c", f"adapter speed {speed_khz}", "-c", script], timeout=budget)
+
+
+def identify(debugger_type, runner, interface_cfg=None, target_cfg="target/nrf52.cfg",
+             budget=6.0, speed_khz=1000, has_tool=None, probe_serial=None):
+    """
+    Identify the attached chip (on the probe with `probe_serial`, if given).
+    Returns a dict with ok, name, family, part, device_id, approtect,
+    error_type, error, backend and elapsed_ms.
+    """
+    has_tool = has_tool or (lambda name: True)
+    started = time.monotonic()
+
+    if debugger_type == '1':
+        backends = [b for b in ("JLinkExe", "nrfjprog") if has_tool(b)]
+        if not backends:
+            return _result(False, error_type="debugger_missing", started=started,
+                           error="未找到 JLinkExe / nrfjprog。")
+        output = ""
+        for backend in backends:
+            remaining = budget - (time.monotonic() - started)
+            if remaining <= 0.5:
+                break
+            if backend == "JLinkExe":
+                success, output = _jlink_session(runner, remaining, speed_khz, probe_serial)
+            else:
+                success, output = _nrfjprog_session(runner, remaining, probe_serial)
+            chip = decode(parse_words(output))
+            if chip:
+                return _result(True, chip, backend=backend, started=started)
+            if any(h in output.lower() for h in PROTECTION_HINTS):
+                break  # the other backend would hit the same lock
+        return _classify_failure(output, backends[0], started)
+
+    if not has_tool("openocd"):
+        return _result(False, error_type="debugger_missing", started=started, error="未找到 OpenOCD。")
+    success, output = _openocd_session(runner, budget, interface_cfg, target_cfg, speed_khz, probe_serial)
+    chip = decode(parse_words(output))
+    if chip:
+        return _result(True, chip, backend="openocd", started=started)
+    return _classify_failure(output, "openocd", started)
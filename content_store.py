@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Content-addressed firmware images for the cloud -> bridge hybrid path.
+
+An Intel HEX image is cut into blocks (contiguous data inside one
+BLOCK_SIZE-aligned page) named by their sha256. The image itself becomes a
+small manifest: [address, length, hash] per block. The SoftDevice and the
+unchanged parts of the application give the same blocks every build, so a
+bridge that keeps a ContentStore only needs the few blocks it is missing,
+sent as a zlib-compressed binary pack instead of hex text.
+
+Used by nrf5_airtag_web.py (builds manifests, serves packs) and bridge.py
+(stores blocks, rebuilds the hex to flash).
+"""
+import os
+import time
+import zlib
+import struct
+import hashlib
+import threading
+
+BLOCK_SIZE = 4096
+MANIFEST_VERSION = 1
+HEX_LINE_BYTES = 16
+
+
+# --- Intel HEX <-> blocks ---
+def parse_hex(hex_text):
+    """Contiguous data runs [(address, bytearray)] and the start-address record (or None)"""
+    runs = []
+    base = 0
+    start = None
+    for lineno, line in enumerate(hex_text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise ValueError(f"Invalid HEX line {lineno}")
+        try:
+            raw = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError(f"Invalid HEX line {lineno}")
+        if len(raw) < 5 or len(raw) != raw[0] + 5 or sum(raw) & 0xFF:
+            raise ValueError(f"Bad HEX record at line {lineno}")
+        rtype, data = raw[3], raw[4:4 + raw[0]]
+        addr = (raw[1] << 8) | raw[2]
+        if rtype == 0x00:
+            addr += base
+            if runs and runs[-1][0] + len(runs[-1][1]) == addr:
+                runs[-1][1].extend(data)
+            else:
+                runs.append((addr, bytearray(data)))
+        elif rtype == 0x01:
+            break
+        elif rtype == 0x02:
+            base = ((data[0] << 8) | data[1]) << 4
+        elif rtype == 0x04:
+            base = ((data[0] << 8) | data[1]) << 16
+        elif rtype in (0x03, 0x05):
+            start = line
+    return runs, start
+
+
+def split_blocks(runs, block_size=BLOCK_SIZE):
+    """Cut data runs at page boundaries: [(address, bytes)]"""
+    blocks = []
+    for addr, data in runs:
+        pos = 0
+        while pos < len(data):
+            a = addr + pos
+            n = min(block_size - a % block_size, len(data) - pos)
+            blocks.append((a, bytes(data[pos:pos + n])))
+            pos += n
+    return blocks
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def build_manifest(hex_text):
+    """(manifest, {hash: bytes}) for a HEX image"""
+    runs, start = parse_hex(hex_text)
+    blocks = split_blocks(runs)
+    contents = {}
+    entries = []
+    for addr, data in blocks:
+        h = digest(data)
+        contents[h] = data
+        entries.append([addr, len(data), h])
+    manifest = {"version": MANIFEST_VERSION, "block_size": BLOCK_SIZE, "blocks": entries,
+                "size": sum(len(d) for d in contents.values()), "start": start}
+    return manifest, contents
+
+
+def manifest_hashes(manifest):
+    """Distinct block hashes of a manifest, in image order; ValueError if malformed"""
+    try:
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError
+        hashes = []
+        for addr, length, h in manifest["blocks"]:
+            if not isinstance(addr, int) or not isinstance(length, int) or len(h) != 64:
+                raise ValueError
+            int(h, 16)
+            if h not in hashes:
+                hashes.append(h)
+        return hashes
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError("Invalid manifest")
+
+
+def _record(rtype, addr, data):
+    raw = bytes([len(data), (addr >> 8) & 0xFF, addr & 0xFF, rtype]) + data
+    return ":" + (raw + bytes([(-sum(raw)) & 0xFF])).hex().upper()
+
+
+def render_hex(manifest, get):
+    """Intel HEX text of a manifest; get(hash) -> bytes"""
+    lines = []
+    upper = None
+    for addr, length, h in manifest["blocks"]:
+        data = get(h)
+        if data is None or len(data) != length:
+            raise KeyError(h)
+        if addr >> 16 != upper:  # blocks never cross a page, so never a 64 KB segment
+            upper = addr >> 16
+            lines.append(_record(0x04, 0, struct.pack(">H", upper)))
+        for pos in range(0, length, HEX_LINE_BYTES):
+            lines.append(_record(0x00, (addr + pos) & 0xFFFF, data[pos:pos + HEX_LINE_BYTES]))
+    if manifest.get("start"):
+        lines.append(manifest["start"])
+    lines.append(":00000001FF")
+    return "\n".join(lines) + "\n"
+
+
+# --- Packs: [32-byte sha256][u32 length][zlib data] ... ---
+def pack(items):
+    """Compressed binary pack of (hash, bytes) pairs"""
+    out = []
+    for h, data in items:
+        z = zlib.compress(data, 6)
+        out.append(bytes.fromhex(h) + struct.pack(">I", len(z)) + z)
+    return b"".join(out)
+
+
+def unpack(payload):
+    """Yield verified (hash, bytes) pairs; ValueError on a corrupt pack"""
+    pos = 0
+    while pos < len(payload):
+        if pos + 36 > len(payload):
+            raise ValueError("Truncated pack")
+        h = payload[pos:pos + 32].hex()
+        (n,) = struct.unpack(">I", payload[pos + 32:pos + 36])
+        pos += 36
+        try:
+            data = zlib.decompress(payload[pos:pos + n])
+        except zlib.error:
+            raise ValueError(f"Corrupt block {h}")
+        pos += n
+        if digest(data) != h:
+            raise ValueError(f"Hash mismatch for block {h}")
+        yield h, data
+
+
+# --- Local store ---
+class ContentStore:
+    """Blocks on disk under root/<hh>/<hash>, least recently used pruned beyond max_bytes"""
+
+    def __init__(self, root, max_bytes=256 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, h):
+        if len(h) != 64 or any(c not in "0123456789abcdef" for c in h):
+            raise ValueError(f"Invalid hash: {h}")
+        return os.path.join(self.root, h[:2], h)
+
+    def has(self, h):
+        return os.path.exists(self._path(h))
+
+    def missing(self, hashes):
+        return [h for h in hashes if not self.has(h)]
+
+    def get(self, h):
+        path = self._path(h)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # recently used: pruned last
+            return data
+        except OSError:
+            return None
+
+    def put(self, h, data):
+        if digest(data) != h:
+            raise ValueError(f"Hash mismatch for block {h}")
+        path = self._path(h)
+        if os.path.exists(path):
+            os.utime(path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return True
+
+    def put_image(self, hex_text):
+        """Store every block of a HEX image; returns its manifest"""
+        manifest, contents = build_manifest(hex_text)
+        for h, data in contents.items():
+            self.put(h, data)
+        self.prune()
+        return manifest
+
+    def put_pack(self, payload):
+        """Store the blocks of a pack; returns the hashes received"""
+        received = []
+        for h, data in unpack(payload):
+            self.put(h, data)
+            received.append(h)
+        self.prune()
+        return received
+
+    def stats(self):
+        files = self._files()
+        return {"blocks": len(files), "bytes": sum(f[2] for f in files), "max_bytes": self.max_bytes}
+
+    def _files(self):
+        files = []
+        for root, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, path, st.st_size))
+        return files
+
+    def prune(self):
+        with self.lock:
+            files = self._files()
+            total = sum(f[2] for f in files)
+            if total <= self.max_bytes:
+                return 0
+            removed = 0
+            for mtime, path, size in sorted(files):
+                if total <= self.max_bytes or time.time() - mtime < 60:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            return removed
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Locks that hold across the worker processes of the web tool.
+
+In production mode gunicorn runs several worker processes, and a
+threading.Lock only orders the threads of one of them. FileLock adds an
+flock() on a file (under config/locks/), so two builds in the shared
+_build directory, or two tools on the same probe, are serialised no matter
+which process started them. The lock is re-entrant within a thread and is
+released by the kernel if its process dies.
+
+Without fcntl (Windows, where only the single-process server runs) it is
+a plain thread lock.
+"""
+import os
+import re
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+POLL_INTERVAL = 0.05  # seconds between attempts while waiting with a timeout
+NAME_RE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self, blocking=True, timeout=None):
+        """Returns False if the lock could not be taken (non-blocking or timed out)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._lock.acquire(blocking, timeout if blocking and timeout is not None else -1):
+            return False
+        if self._depth == 0 and fcntl is not None:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if blocking and deadline is None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                else:
+                    while True:
+                        try:
+                            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            break
+                        except BlockingIOError:
+                            if not blocking or time.monotonic() >= deadline:
+                                os.close(fd)
+                                self._lock.release()
+                                return False
+                            time.sleep(POLL_INTERVAL)
+            except OSError:
+                self._lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            finally:
+                os.close(self._fd)
+                self._fd = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FileLockSet:
+    """One FileLock per name (e.g. per probe), as files in `root`"""
+
+    def __init__(self, root):
+        self.root = root
+        self.locks = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, name):
+        with self.lock:
+            lock = self.locks.get(name)
+            if lock is None:
+                fname = NAME_RE.sub("_", str(name)).strip("_") or "default"
+                lock = self.locks[name] = FileLock(os.path.join(self.root, f"{fname}.lock"))
+            return lock
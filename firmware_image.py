@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Firmware image helpers shared by the web build path and the benchmarks.
+
+- patch_placeholder(): write the seed / key table over the marker the
+  firmware reserves for it
+- merge_hex(): SoftDevice + application in one Intel HEX (for WebUSB
+  DAPLink, which erases the whole chip)
+"""
+
+SEED_PLACEHOLDER = b"LinkyTagDynamicSeedPlaceholder!!"
+KEY_PLACEHOLDER = b"OFFLINEFINDINGPUBLICKEYHERE!"
+HEX_EOF = ":00000001FF"
+
+
+def patch_placeholder(fw_data, placeholder, payload):
+    """Overwrite `placeholder` in the bytearray `fw_data` with `payload`; returns the offset or -1"""
+    offset = fw_data.find(placeholder)
+    if offset != -1:
+        fw_data[offset:offset + len(payload)] = payload
+    return offset
+
+
+def merge_hex(sd_path, app_path, out_path):
+    """Concatenate SoftDevice and application HEX, dropping the SoftDevice's EOF record"""
+    with open(sd_path, "r") as f_sd:
+        sd_lines = [l for l in f_sd if not l.strip().startswith(HEX_EOF)]
+    with open(app_path, "r") as f_app:
+        app_lines = f_app.readlines()
+    with open(out_path, "w") as f_out:
+        f_out.writelines(sd_lines)
+        f_out.writelines(app_lines)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Progress parsing for flash and build tool output.
+
+run_command() feeds every output line of OpenOCD, JLinkExe, nrfjprog and
+make to a ProgressTracker, which turns the lines it recognises into a
+structured snapshot: phase, percent, bytes written, bytes/s and ETA.
+
+The tools report little while they work (OpenOCD prints one
+"wrote N bytes ... (X KiB/s)" line per file, J-Link one speed line per
+download), so between lines the percentage is extrapolated from the rate
+measured so far or, before that, the rate this probe achieved last time.
+`estimate()` redoes that extrapolation on a stored snapshot, so status
+polls keep moving even while the tool is silent.
+
+ThroughputStats keeps the measured rates per probe.
+"""
+import os
+import re
+import json
+import time
+import threading
+
+OPENOCD_WROTE = re.compile(r"wrote (\d+) bytes from file .* in ([\d.]+)s \(([\d.]+) KiB/s\)")
+JLINK_DOWNLOAD = re.compile(r"Downloading file \[(.+?)\]")
+JLINK_RANGE = re.compile(r"Flash download: Bank \d+ @ 0x[0-9A-Fa-f]+: .*\((\d+) bytes\)")
+JLINK_SPEED = re.compile(r"Program & Verify speed: ([\d.]+) KiB/s")
+MAKE_COMPILE = re.compile(r"^(Compiling|Assembling) file: (.+)$")
+MAKE_LINK = re.compile(r"^Linking target: ")
+
+# Share of a build spent linking / post-processing after the last compile
+LINK_PERCENT = 92
+
+
+def estimate(snap, now=None):
+    """Percent and ETA of a snapshot, extrapolated to `now` while a write is in progress"""
+    if not snap:
+        return snap
+    snap = dict(snap)
+    now = now or time.time()
+    if snap.get("kind") == "flash" and snap.get("phase") == "write" and snap.get("total_bytes"):
+        rate = snap.get("bytes_per_s") or snap.get("expected_bps")
+        done = snap.get("bytes", 0)
+        if rate:
+            extra = (now - snap["mark"]) * rate
+            done = min(done + extra, snap["total_bytes"] * 0.99)
+            snap["eta_s"] = round(max(snap["total_bytes"] - done, 0) / rate, 1)
+        snap["percent"] = max(snap.get("percent", 0), round(100.0 * done / snap["total_bytes"], 1))
+    elif snap.get("kind") == "build" and 0 < snap.get("percent", 0) < 100:
+        elapsed = now - snap["started"]
+        snap["eta_s"] = round(elapsed * (100 - snap["percent"]) / snap["percent"], 1)
+    snap["elapsed_s"] = round(now - snap["started"], 1)
+    return snap
+
+
+class ProgressTracker:
+    """
+    kind "flash": total_bytes is the image size, expected_bps the last known
+    rate of this probe. kind "build": total_units the number of source files
+    the last build compiled.
+    """
+
+    def __init__(self, kind, total_bytes=0, expected_bps=None, total_units=None, on_update=None, min_interval=0.5):
+        self.kind = kind
+        self.total_bytes = total_bytes
+        self.expected_bps = expected_bps
+        self.total_units = total_units
+        self.on_update = on_update
+        self.min_interval = min_interval
+        self.tool = None
+        self.started = time.time()
+        self.phase = "starting"
+        self.mark = self.started  # last phase change or confirmed write; extrapolation starts here
+        self.bytes = 0          # confirmed written
+        self.pending = 0        # announced for the current J-Link download
+        self.measured = []      # (bytes, seconds) reported by the tool
+        self.units = 0
+        self.percent = 0.0
+        self.last_publish = 0
+
+    # --- Parsing ---
+    def feed(self, line):
+        line = line.strip()
+        if not line:
+            return
+        phase = self.phase
+        if self.kind == "build":
+            self._feed_build(line)
+        else:
+            self._feed_flash(line)
+        self._publish(force=phase != self.phase)
+
+    def _feed_flash(self, line):
+        m = OPENOCD_WROTE.search(line)
+        if m:
+            n, secs = int(m.group(1)), float(m.group(2))
+            self.tool = "openocd"
+            self._confirm(n)
+            self.measured.append((n, secs))
+            self._set_phase("verify" if self.bytes >= self.total_bytes else "write")
+            return
+        if "** Programming Started **" in line:
+            self.tool = "openocd"
+            self._set_phase("write")
+        elif "** Verify Started **" in line:
+            self._set_phase("verify")
+        elif "mass erase" in line.lower() or "Erasing" in line:
+            self._set_phase("erase")
+        elif JLINK_DOWNLOAD.search(line):
+            self.tool = "jlink"
+            self._set_phase("write")
+        elif JLINK_RANGE.search(line):
+            self.pending += int(JLINK_RANGE.search(line).group(1))
+        elif JLINK_SPEED.search(line):
+            bps = float(JLINK_SPEED.search(line).group(1)) * 1024
+            if self.pending and bps:
+                self.measured.append((self.pending, self.pending / bps))
+        elif line.startswith("O.K.") and self.phase == "write":
+            self._confirm(self.pending)  # J-Link reports only the bytes that differed
+            self.pending = 0
+        elif "Programming device" in line:
+            self.tool = "nrfjprog"
+            self._set_phase("write")
+        elif "Verifying programming" in line:
+            self._set_phase("verify")
+
+    def _feed_build(self, line):
+        if MAKE_COMPILE.match(line):
+            self.units += 1
+            self._set_phase("compile")
+            if self.total_units:
+                self.percent = min(LINK_PERCENT - 1, LINK_PERCENT * self.units / self.total_units)
+        elif MAKE_LINK.match(line):
+            self._set_phase("link")
+            self.percent = LINK_PERCENT
+
+    def _set_phase(self, phase):
+        if phase != self.phase:
+            self.phase = phase
+            self.mark = time.time()
+
+    def _confirm(self, nbytes):
+        self.bytes = min(self.total_bytes, self.bytes + nbytes)
+        self.mark = time.time()
+
+    # --- Results ---
+    def rate(self):
+        """bytes/s measured by the tool so far (None if it reported nothing)"""
+        n = sum(b for b, _ in self.measured)
+        secs = sum(s for _, s in self.measured)
+        return n / secs if n and secs else None
+
+    def snapshot(self):
+        snap = {"kind": self.kind, "phase": self.phase, "tool": self.tool, "started": self.started,
+                "mark": self.mark, "percent": round(self.percent, 1)}
+        if self.kind == "flash":
+            rate = self.rate()
+            snap.update(bytes=self.bytes, total_bytes=self.total_bytes, expected_bps=self.expected_bps,
+                        bytes_per_s=round(rate) if rate else None)
+            if self.total_bytes:
+                snap["percent"] = round(min(100.0, 100.0 * self.bytes / self.total_bytes), 1)
+        else:
+            snap.update(units=self.units, total_units=self.total_units)
+        return estimate(snap)
+
+    def finish(self, ok=True):
+        self._set_phase("done" if ok else "failed")
+        if ok:
+            self.percent = 100.0
+            if self.kind == "flash":
+                self.bytes = self.total_bytes
+        self._publish(force=True)
+        return self.snapshot()
+
+    def _publish(self, force=False):
+        if not self.on_update:
+            return
+        now = time.monotonic()
+        if force or now - self.last_publish >= self.min_interval:
+            self.last_publish = now
+            try:
+                self.on_update(self.snapshot())
+            except Exception:
+                pass
+
+
+class ThroughputStats:
+    """Measured flash throughput per probe key, persisted as JSON"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+
+    def record(self, key, nbytes, seconds, tool=None):
+        if not nbytes or seconds <= 0:
+            return
+        bps = nbytes / seconds
+        with self.lock:
+            s = self.data.setdefault(key, {"flashes": 0, "bytes": 0, "seconds": 0.0,
+                                           "min_bps": None, "max_bps": None})
+            s["flashes"] += 1
+            s["bytes"] += nbytes
+            s["seconds"] = round(s["seconds"] + seconds, 3)
+            s["last_bps"] = round(bps)
+            s["avg_bps"] = round(s["bytes"] / s["seconds"]) if s["seconds"] else None
+            s["min_bps"] = round(min(bps, s["min_bps"] or bps))
+            s["max_bps"] = round(max(bps, s["max_bps"] or 0))
+            s["tool"] = tool or s.get("tool")
+            s["updated"] = time.time()
+            self._save()
+
+    def get(self, key):
+        with self.lock:
+            return dict(self.data.get(key) or {})
+
+    def snapshot(self):
+        with self.lock:
+            return {k: dict(v) for k, v in self.data.items()}
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.data, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Pre-generated device identity pool for autoflash production.
+
+A background producer keeps between `low` and `high` ready-to-flash images
+(each with its own keys / seed and bundle) per chip + config, so the flash
+loop can pop a fresh identity the moment a board is clamped instead of
+running key generation, compile and patching in between boards.
+
+Ready entries are listed in `pool.json` inside the pool directory and are
+reloaded on start, so a restart does not throw away generated identities.
+"""
+import os
+import json
+import shutil
+import hashlib
+import threading
+from datetime import datetime
+
+# Config fields that change the produced image; anything else (session_id,
+# autoflash, debugger...) can share a pool.
+POOL_KEY_FIELDS = ["chip", "mode", "prefix", "start_num", "padding", "base_interval",
+                   "interval_step", "dcdc", "key_count"]
+
+
+def pool_key(config):
+    """Stable identifier for the image-relevant part of a config"""
+    relevant = {k: str(config.get(k, "")) for k in POOL_KEY_FIELDS}
+    digest = hashlib.sha1(json.dumps(relevant, sort_keys=True).encode()).hexdigest()[:12]
+    return f"{relevant['chip']}_{relevant['mode']}_{digest}"
+
+
+class IdentityPool:
+    """
+    `produce_func(config, output_dir)` must behave like generate_firmware():
+    returns (success, result_dict, error_msg) and writes everything into
+    `output_dir`.
+    """
+
+    def __init__(self, pool_dir, config, produce_func, low=2, high=5, log_func=None):
+        self.pool_dir = pool_dir
+        self.config = dict(config)
+        self.produce_func = produce_func
+        self.low = max(0, int(low))
+        self.high = max(self.low + 1, int(high))
+        self.log = log_func or (lambda msg, level="info": None)
+        self.manifest = os.path.join(pool_dir, "pool.json")
+        self.entries = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+        self.produced = 0
+        self.failures = 0
+        os.makedirs(pool_dir, exist_ok=True)
+        self._load()
+
+    # --- Persistence ---
+    def _load(self):
+        try:
+            with open(self.manifest, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for entry in data.get("entries", []):
+            if os.path.exists(entry.get("patch_hex", "")) and os.path.exists(entry.get("bundle_path", "")):
+                self.entries.append(entry)
+
+    def _save(self):
+        tmp = self.manifest + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"config": self.config, "entries": self.entries}, f, indent=1)
+        os.replace(tmp, self.manifest)
+
+    # --- Producer ---
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"identity-pool-{os.path.basename(self.pool_dir)}")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def _run(self):
+        while self.running:
+            if self.size() >= self.low:
+                self.wakeup.wait(5)
+                self.wakeup.clear()
+                continue
+            # Below low watermark: refill up to the high watermark
+            while self.running and self.size() < self.high:
+                if not self._produce_one():
+                    # Back off on build errors instead of spinning
+                    self.wakeup.wait(10)
+                    self.wakeup.clear()
+                    break
+
+    def _produce_one(self):
+        entry_dir = os.path.join(self.pool_dir, datetime.now().strftime('%Y%m%d_%H%M%S_%f'))
+        os.makedirs(entry_dir, exist_ok=True)
+        success, result, err = self.produce_func(self.config, entry_dir)
+        if not success:
+            self.failures += 1
+            self.log(f"Identity pool: generation failed: {err}", "warning")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return False
+        entry = {
+            "device_name": result["device_name"],
+            "patch_hex": result["patch_hex"],
+            "bundle_file": result["bundle_file"],
+            "bundle_path": result["bundle_path"],
+            "dir": entry_dir,
+            "created": datetime.now().isoformat(timespec='seconds'),
+        }
+        with self.lock:
+            self.entries.append(entry)
+            self._save()
+        self.produced += 1
+        self.log(f"Identity pool: {entry['device_name']} ready ({self.size()}/{self.high})", "info")
+        return True
+
+    # --- Consumer ---
+    def size(self):
+        with self.lock:
+            return len(self.entries)
+
+    def pop(self):
+        """Take the oldest ready identity (or None if the pool is empty)"""
+        with self.lock:
+            entry = self.entries.pop(0) if self.entries else None
+            if entry:
+                self._save()
+        if self.size() < self.low:
+            self.wakeup.set()
+        return entry
+
+    def names(self):
+        """Device names of the identities waiting in the pool"""
+        with self.lock:
+            return {e["device_name"] for e in self.entries}
+
+    def claim(self, entry, dest_dir):
+        """Move a popped identity's bundle into `dest_dir`; returns the new bundle path"""
+        os.makedirs(dest_dir, exist_ok=True)
+        dest = os.path.join(dest_dir, entry["bundle_file"])
+        shutil.move(entry["bundle_path"], dest)
+        shutil.rmtree(entry["dir"], ignore_errors=True)
+        return dest
+
+    def stats(self):
+        return {
+            "ready": self.size(),
+            "low": self.low,
+            "high": self.high,
+            "produced": self.produced,
+            "failures": self.failures,
+            "running": self.running,
+        }
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Job queue and scheduler for build / flash work.
+
+Replaces the single global "is_flashing" flag: every request becomes a job
+with an id, a priority and an owner (session and probe). The dispatcher
+starts queued jobs as soon as the per-session and per-probe concurrency
+limits allow, highest priority first. Each running job gets a coordinator
+thread; its heavy stages run on shared worker pools (`run_stage`), so
+compiles and flashes from many stations proceed in parallel within bounds.
+
+Queued jobs are persisted and re-queued after a restart; jobs that were
+running when the process died are marked "interrupted".
+
+With a `store` (state_store.StateStore) the queue lives in the shared
+SQLite database instead: every server process runs a dispatcher that claims
+jobs atomically, so the per-session / per-probe limits hold across workers.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+ACTIVE_STATES = ("queued", "running")
+FINAL_STATES = ("succeeded", "failed", "cancelled", "interrupted")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    """Fail the job with an error the handler has already reported to the user"""
+    pass
+
+
+class Job:
+    def __init__(self, kind, payload, session_id=None, probe=None, priority=0, job_id=None, requeue=True):
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.payload = payload
+        self.session_id = session_id
+        self.probe = probe
+        self.priority = int(priority or 0)
+        self.requeue = requeue  # False: nobody waits for it after a restart, do not run it again
+        self.state = "queued"
+        self.stage = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.result = None
+        self.seq = 0
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()  # set once the job reaches a final state
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def to_dict(self, include_payload=False):
+        d = {
+            "id": self.id, "kind": self.kind, "session_id": self.session_id, "probe": self.probe,
+            "priority": self.priority, "state": self.state, "stage": self.stage,
+            "created": self.created, "started": self.started, "finished": self.finished,
+            "error": self.error, "result": self.result, "requeue": self.requeue,
+        }
+        if include_payload:
+            d["payload"] = self.payload
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        job = cls(d["kind"], d.get("payload"), d.get("session_id"), d.get("probe"),
+                  d.get("priority", 0), job_id=d["id"], requeue=d.get("requeue", True))
+        for k in ("state", "created", "started", "finished", "error", "result"):
+            setattr(job, k, d.get(k))
+        return job
+
+
+class JobScheduler:
+    """
+    handlers: kind -> func(job). A handler raises to fail the job and may
+    return a JSON-serialisable result.
+    """
+
+    def __init__(self, handlers, persist_path=None, max_running=16, per_session=1, per_probe=1,
+                 stage_workers=None, history=500, log_func=None, store=None):
+        self.handlers = handlers
+        self.persist_path = persist_path
+        self.store = store
+        self.owner = None
+        self.max_running = max_running
+        self.per_session = per_session
+        self.per_probe = per_probe
+        self.history = history
+        self.log = log_func or (lambda msg, level="info": None)
+        self.pools = {name: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"{name}-stage")
+                      for name, n in (stage_workers or {"build": 2, "flash": 8}).items()}
+        self.jobs = {}  # id -> Job (active and recent history)
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.thread = None
+        self.listeners = []  # callables(job) on every state change
+
+    # --- Lifecycle ---
+    def start(self):
+        with self.cond:
+            if self.thread:
+                return
+            self.owner = str(os.getpid())
+            if self.store:
+                n = self.store.reap_jobs(self.history)
+                if n:
+                    self.log(f"Marked {n} orphaned job(s) as interrupted | 已标记中断任务", "warning")
+            else:
+                self._load()
+            self.thread = threading.Thread(target=self._dispatch_loop, name="job-dispatcher")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def on_change(self, func):
+        self.listeners.append(func)
+
+    # --- Public API ---
+    def submit(self, kind, payload, session_id=None, probe=None, priority=0, requeue=True):
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = Job(kind, payload, session_id, probe, priority, requeue=requeue)
+        if self.store:
+            job.seq = self.store.insert_job(dict(job.to_dict(include_payload=True), owner=str(os.getpid())))
+            with self.cond:
+                self.cond.notify_all()
+            self._notify(job)
+            return job
+        with self.cond:
+            self.seq += 1
+            job.seq = self.seq
+            self.jobs[job.id] = job
+            self._save()
+            self.cond.notify_all()
+        self._changed(job)
+        return job
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job or not self.store:
+            return job
+        d = self.store.get_job(job_id)
+        return self._from_store(d) if d else None
+
+    def wait(self, job, timeout=None):
+        """Block until `job` is final; returns its latest state (None on timeout)"""
+        if not self.store:
+            return job if job.done.wait(timeout) else None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            current = self.get(job.id)
+            if current is None or current.state in FINAL_STATES:
+                return current
+            job.done.wait(0.25)
+        return None
+
+    def list(self, session_id=None, states=None):
+        if self.store:
+            return [self._from_store(d) for d in self.store.list_jobs(session_id, states, self.history)]
+        with self.cond:
+            jobs = list(self.jobs.values())
+        if session_id:
+            jobs = [j for j in jobs if j.session_id == session_id]
+        if states:
+            jobs = [j for j in jobs if j.state in states]
+        return sorted(jobs, key=lambda j: j.created, reverse=True)
+
+    def cancel(self, job_id):
+        """Cancel a queued job immediately, or signal a running one. Returns False if unknown/finished."""
+        if self.store:
+            before = self.store.request_cancel(job_id)
+            if not before:
+                return False
+            local = self.jobs.get(job_id)
+            if local:
+                local.cancel_event.set()  # otherwise the owning process picks the flag up
+            elif before == "queued":
+                self._notify(self.get(job_id))
+            return True
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if not job or job.state not in ACTIVE_STATES:
+                return False
+            job.cancel_event.set()
+            if job.state == "queued":
+                job.state = "cancelled"
+                job.finished = time.time()
+                job.done.set()
+            self._save()
+            self.cond.notify_all()
+        self._changed(job)
+        return True
+
+    def cancel_session(self, session_id=None):
+        """Cancel every active job of a session (all sessions if None)"""
+        n = 0
+        for job in self.list(session_id, ACTIVE_STATES):
+            n += self.cancel(job.id)
+        return n
+
+    def position(self, job):
+        """1-based position among queued jobs (None if not queued)"""
+        if job.state != "queued":
+            return None
+        if self.store:
+            return self.store.queue_position(job.id)
+        queued = self._queued_order()
+        return queued.index(job) + 1 if job in queued else None
+
+    def session_active(self, session_id):
+        if self.store:
+            return self.store.session_active(session_id)
+        return any(j.session_id == session_id and j.state in ACTIVE_STATES for j in list(self.jobs.values()))
+
+    def stats(self):
+        counts = {}
+        for j in list(self.jobs.values()):
+            counts[j.state] = counts.get(j.state, 0) + 1
+        if self.store:
+            counts = self.store.job_counts()
+        return {"counts": counts, "queued": counts.get("queued", 0), "running": counts.get("running", 0),
+                "max_running": self.max_running, "per_session": self.per_session, "per_probe": self.per_probe,
+                "pools": {name: pool._max_workers for name, pool in self.pools.items()}}
+
+    def run_stage(self, job, stage, func, *args, **kwargs):
+        """
+        Run one stage of `job` on the named worker pool and wait for it.
+        Thread attributes (session_id, job) are carried over so log() keeps
+        routing to the right session. Raises JobCancelled if cancelled.
+
+        A stage still waiting for a pool slot is dropped at once. A running
+        stage is not interrupted from here: it has to watch job.cancelled
+        (the web tool's run_command kills the tool process it is waiting on,
+        and the stages check between steps and retries).
+        """
+        if job.cancelled:
+            raise JobCancelled()
+        job.stage = stage
+        self._changed(job)
+
+        def call():
+            t = threading.current_thread()
+            t.session_id, t.job = job.session_id, job
+            try:
+                return func(*args, **kwargs)
+            finally:
+                t.session_id, t.job = None, None
+
+        future = self.pools[stage].submit(call)
+        while True:
+            try:
+                return future.result(timeout=0.2)
+            except FutureTimeout:
+                # Still waiting for a pool slot: drop out right away on cancel
+                if job.cancelled and future.cancel():
+                    raise JobCancelled()
+
+    # --- Dispatcher ---
+    def _queued_order(self):
+        queued = [j for j in self.jobs.values() if j.state == "queued"]
+        return sorted(queued, key=lambda j: (-j.priority, j.seq))
+
+    def _can_start(self, job, running):
+        if len(running) >= self.max_running:
+            return False
+        if job.session_id and sum(1 for r in running if r.session_id == job.session_id) >= self.per_session:
+            return False
+        if job.probe and sum(1 for r in running if r.probe == job.probe) >= self.per_probe:
+            return False
+        return True
+
+    def _dispatch_loop(self):
+        if self.store:
+            return self._store_dispatch_loop()
+        while True:
+            with self.cond:
+                started = None
+                running = [j for j in self.jobs.values() if j.state == "running"]
+                for job in self._queued_order():
+                    if self._can_start(job, running):
+                        job.state = "running"
+                        job.started = time.time()
+                        started = job
+                        self._save()
+                        break
+                if not started:
+                    self.cond.wait(1.0)
+                    continue
+            self._changed(started)
+            t = threading.Thread(target=self._run_job, args=(started,), name=f"job-{started.id}")
+            t.daemon = True
+            t.start()
+
+    def _store_dispatch_loop(self):
+        while True:
+            try:
+                local = [j for j in list(self.jobs.values()) if j.state == "running"]
+                # Cancels may have been requested through another process
+                for job_id in self.store.cancel_requested([j.id for j in local]):
+                    self.jobs[job_id].cancel_event.set()
+                d = None
+                if len(local) < self.max_running:
+                    d = self.store.claim_job(self.owner, self.per_session, self.per_probe)
+            except Exception as e:
+                self.log(f"Job store error: {e}", "warning")
+                d = None
+            if not d:
+                with self.cond:
+                    self.cond.wait(0.5)
+                continue
+            job = self._from_store(d)
+            self.jobs[job.id] = job
+            self._notify(job)
+            t = threading.Thread(target=self._run_job, args=(job,), name=f"job-{job.id}")
+            t.daemon = True
+            t.start()
+
+    def _from_store(self, d):
+        job = Job.from_dict(d)
+        job.seq = d.get("seq", 0)
+        job.stage = d.get("stage")
+        if job.state in FINAL_STATES:
+            job.done.set()
+        return job
+
+    def _run_job(self, job):
+        t = threading.current_thread()
+        t.session_id, t.job = job.session_id, job
+        try:
+            job.result = self.handlers[job.kind](job)
+            state = "cancelled" if job.cancelled else "succeeded"
+        except JobCancelled:
+            state = "cancelled"
+        except Exception as e:
+            job.error = str(e)
+            state = "cancelled" if job.cancelled else "failed"
+        with self.cond:
+            job.state = state
+            job.stage = None
+            job.finished = time.time()
+            job.done.set()
+            if self.store:
+                self.jobs.pop(job.id, None)  # only running jobs are held locally
+            self._trim()
+            self._save()
+            self.cond.notify_all()
+        self._changed(job)
+
+    def _changed(self, job):
+        if self.store:
+            try:
+                self.store.update_job(job.id, state=job.state, stage=job.stage, started=job.started,
+                                      finished=job.finished, error=job.error, result=job.result)
+            except Exception as e:
+                self.log(f"Job store error: {e}", "warning")
+        self._notify(job)
+
+    def _notify(self, job):
+        for func in self.listeners:
+            try:
+                func(job)
+            except Exception:
+                pass
+
+    # --- Persistence ---
+    def _trim(self):
+        done = sorted((j for j in self.jobs.values() if j.state in FINAL_STATES), key=lambda j: j.finished or 0)
+        for j in done[:max(0, len(done) - self.history)]:
+            self.jobs.pop(j.id, None)
+
+    def _save(self):
+        if not self.persist_path or self.store:
+            return
+        data = {"seq": self.seq, "jobs": [j.to_dict(include_payload=j.state == "queued") for j in self.jobs.values()]}
+        tmp = self.persist_path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.persist_path)
+        except (OSError, TypeError) as e:
+            self.log(f"Job queue persist failed: {e}", "warning")
+
+    def _load(self):
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.seq = data.get("seq", 0)
+        requeued = 0
+        for d in data.get("jobs", []):
+            job = Job.from_dict(d)
+            if job.state == "running" or (job.state == "queued" and not job.requeue):
+                job.state = "interrupted"  # the process died under it
+                job.finished = job.finished or time.time()
+            if job.state in FINAL_STATES:
+                job.done.set()
+            elif job.state == "queued":
+                if job.kind not in self.handlers or job.payload is None:
+                    continue
+                self.seq += 1
+                job.seq = self.seq
+                requeued += 1
+            self.jobs[job.id] = job
+        if requeued:
+            self.log(f"Re-queued {requeued} job(s) from previous run | 已恢复排队任务", "info")
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Simulated probe and toolchain executables for load tests.
+
+loadtest/bin/ holds `openocd`, `JLinkExe`, `nrfjprog`, `make` and
+`arm-none-eabi-objcopy` shims that land here. Put that directory first
+on PATH and the web tool and the bridge run their real build and flash
+paths against a simulated board: same command lines, output in the
+format the real tools print (progress parsing, chip identification and
+error classification all see what they would on hardware), real files
+written where the real tools write them.
+
+Behaviour is set through the environment of the server process:
+
+    FAKE_MODE             success | approtect | disconnect | latency
+    FAKE_APPROTECT_RATE   chance (0..1) that a session finds the chip protected
+    FAKE_DISCONNECT_RATE  chance that a session cannot reach the target
+    FAKE_LATENCY          seconds to connect to the target        (default 0.2,
+                          "latency" mode: 2.0)
+    FAKE_FLASH_KBPS       programming speed in KiB/s               (default 32)
+    FAKE_BUILD_SECONDS    duration of one firmware compile         (default 2)
+    FAKE_CHIP             part number, e.g. 52832 (default: from the target config)
+    FAKE_LOG              file that gets one line per invocation
+"""
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import content_store
+import firmware_image
+
+FICR_DEVICEID = 0x10000060
+FICR_INFO_PART = 0x10000100
+UICR_RBPCONF = 0x10001004
+UICR_APPROTECT = 0x10001208
+
+BUILD_FILES = 24              # "Compiling file:" lines per build
+APP_IMAGE_SIZE = 64 * 1024    # fake application image
+KEY_TABLE_SIZE = 200 * 28     # room the firmware reserves for the key table
+
+
+class Sim:
+    def __init__(self):
+        env = os.environ
+        self.mode = env.get("FAKE_MODE", "success")
+        self.latency = float(env.get("FAKE_LATENCY", 2.0 if self.mode == "latency" else 0.2))
+        self.kbps = float(env.get("FAKE_FLASH_KBPS", 32))
+        self.build_seconds = float(env.get("FAKE_BUILD_SECONDS", 2))
+        self.chip = env.get("FAKE_CHIP")
+        self.rand = random.Random()
+        self.fault = None
+        if self.mode in ("approtect", "disconnect"):
+            self.fault = self.mode
+        elif self.rand.random() < float(env.get("FAKE_APPROTECT_RATE", 0)):
+            self.fault = "approtect"
+        elif self.rand.random() < float(env.get("FAKE_DISCONNECT_RATE", 0)):
+            self.fault = "disconnect"
+
+    def part(self, family_hint=""):
+        if self.chip:
+            return int(self.chip, 16)
+        return 0x51822 if "51" in family_hint else 0x52832
+
+    def words(self, part):
+        """FICR / UICR contents of the simulated chip"""
+        protected = self.fault == "approtect"
+        return {FICR_DEVICEID: self.rand.getrandbits(32), FICR_DEVICEID + 4: self.rand.getrandbits(32),
+                FICR_INFO_PART: part,
+                UICR_RBPCONF: 0xFFFF00FF if protected else 0xFFFFFFFF,
+                UICR_APPROTECT: 0xFFFFFF00 if protected else 0xFFFFFFFF}
+
+    def connect(self):
+        time.sleep(self.latency)
+
+    def write_time(self, nbytes):
+        return nbytes / 1024.0 / self.kbps
+
+
+def out(*lines):
+    for line in lines:
+        print(line, flush=True)
+
+
+def err(*lines):
+    for line in lines:
+        print(line, file=sys.stderr, flush=True)
+
+
+def hex_size(path):
+    """Data bytes of an Intel HEX file (what the probe has to write)"""
+    try:
+        with open(path, "r") as f:
+            runs, _ = content_store.parse_hex(f.read())
+        return sum(len(d) for _, d in runs)
+    except (OSError, ValueError):
+        return 0
+
+
+# --- OpenOCD ---
+def openocd(argv):
+    if "--version" in argv or "-v" in argv:
+        err("Open On-Chip Debugger 0.12.0 (simulated)")
+        return 0
+    sim = Sim()
+    target = ""
+    commands = []
+    i = 0
+    while i < len(argv):
+        if argv[i] == "-f" and i + 1 < len(argv):
+            target = argv[i + 1] if "target/" in argv[i + 1] else target
+            i += 2
+        elif argv[i] == "-c" and i + 1 < len(argv):
+            commands += [c.strip() for c in argv[i + 1].split(";") if c.strip()]
+            i += 2
+        else:
+            i += 1
+    err("Open On-Chip Debugger 0.12.0 (simulated)", "Licensed under GNU GPL v2")
+    family = "nrf51" if "nrf51" in target else "nrf52"
+    words = None
+    for cmd in commands:
+        if cmd == "init":
+            sim.connect()
+            err("Info : clock speed 1000 kHz")
+            if sim.fault == "disconnect":
+                err("Error: Error connecting DP: cannot read IDR")
+                return 1
+            err("Info : STLINK V2J37S7 (API v2) VID:PID 0483:3748", "Info : Target voltage: 3.261756",
+                f"Info : [{family}.cpu] Cortex-M4 r0p1 processor detected")
+            if sim.fault == "approtect" and family == "nrf52":
+                err(f"Error: [{family}.cpu] nRF52 device has AP lock engaged (see UICR APPROTECT register).")
+            words = sim.words(sim.part(family))
+        elif "mdw" in cmd:
+            m = re.search(r"mdw 0x([0-9a-fA-F]+)(?: (\d+))?", cmd)
+            if m and words is not None:
+                if sim.fault == "approtect" and family == "nrf52":
+                    err("Error: Failed to read memory at 0x" + m.group(1))
+                    continue
+                addr, n = int(m.group(1), 16), int(m.group(2) or 1)
+                out(f"0x{addr:08x}: " + " ".join(f"{words.get(addr + 4 * k, 0xFFFFFFFF):08x}" for k in range(n)))
+        elif cmd.endswith("mass_erase"):
+            if sim.fault == "approtect":
+                err("Info : Mass erase completed. (AP lock cleared)")  # a real mass erase recovers the chip
+                sim.fault = None
+            time.sleep(0.3)
+            err(f"Info : {family} mass erase complete")
+        elif cmd.startswith("program "):
+            if sim.fault:
+                err("Error: Failed to write memory at 0x00000000", "** Programming Failed **")
+                return 1
+            path = cmd.split()[1]
+            nbytes = hex_size(path)
+            secs = sim.write_time(nbytes)
+            err("** Programming Started **")
+            time.sleep(secs)
+            err(f"Info : wrote {nbytes} bytes from file {path} in {secs:.6f}s ({sim.kbps:.3f} KiB/s)",
+                "** Programming Finished **")
+            if "verify" in cmd:
+                err("** Verify Started **")
+                time.sleep(secs * 0.2)
+                err(f"Info : verified {nbytes} bytes in {secs * 0.2:.6f}s", "** Verified OK **")
+        elif cmd in ("exit", "shutdown"):
+            break
+    if sim.fault:
+        return 1
+    return 0
+
+
+# --- J-Link Commander ---
+def jlinkexe(argv):
+    out("SEGGER J-Link Commander V7.94e (simulated)")
+    script = argv[argv.index("-CommandFile") + 1] if "-CommandFile" in argv else None
+    if not script:
+        return 0
+    try:
+        with open(script, "r") as f:
+            lines = [l.strip() for l in f if l.strip()]
+    except OSError:
+        out(f"Could not open command file {script}")
+        return 1
+    sim = Sim()
+    device = ""
+    words = None
+    for line in lines:
+        parts = line.split()
+        cmd = parts[0].lower()
+        if cmd == "device":
+            device = parts[1] if len(parts) > 1 else ""
+        elif cmd == "connect":
+            out("Connecting to target via SWD")
+            sim.connect()
+            if sim.fault == "disconnect":
+                out("Cannot connect to target.")
+                return 1
+            out("Found SW-DP with ID 0x2BA01477", "Cortex-M4 identified.")
+            if sim.fault == "approtect":
+                out("Device is secured (APPROTECT). Unsecure it to connect.")
+            words = sim.words(sim.part(device.lower()))
+        elif cmd == "mem32" and words is not None:
+            if sim.fault == "approtect":
+                out("Could not read memory.")
+                continue
+            addr, n = int(parts[1], 16), int(parts[2], 16) if len(parts) > 2 else 1
+            out(f"{addr:08X} = " + " ".join(f"{words.get(addr + 4 * k, 0xFFFFFFFF):08X}" for k in range(n)))
+        elif cmd == "loadfile":
+            path = parts[1]
+            if sim.fault:
+                out("Error occurred: Could not connect to target.")
+                return 1
+            nbytes = hex_size(path)
+            secs = sim.write_time(nbytes)
+            out(f"Downloading file [{path}]...",
+                f"J-Link: Flash download: Bank 0 @ 0x00000000: 1 range affected ({nbytes} bytes)")
+            time.sleep(secs)
+            out(f"J-Link: Flash download: Total: {secs:.3f}s (Prepare: 0.05s, Compare: 0.01s, Erase: 0.2s, "
+                f"Program & Verify: {secs:.3f}s, Restore: 0.01s)",
+                f"J-Link: Flash download: Program & Verify speed: {sim.kbps:.0f} KiB/s", "O.K.")
+        elif cmd == "sleep":
+            time.sleep(int(parts[1]) / 1000.0)
+        elif cmd in ("exit", "q", "qc"):
+            break
+    out("Script processing completed.")
+    return 0
+
+
+# --- nrfjprog ---
+def nrfjprog(argv):
+    if "--version" in argv or "-v" in argv:
+        out("nrfjprog version: 10.24.2 external (simulated)", "JLinkARM.dll version: 7.94e")
+        return 0
+    sim = Sim()
+    sim.connect()
+    if sim.fault == "disconnect":
+        out("ERROR: Unable to connect to a debugger.", "ERROR: Could not connect to target device.")
+        return 33
+    if sim.fault == "approtect" and "--recover" not in argv:
+        out("ERROR: The operation attempted is unavailable due to readback protection in",
+            "ERROR: your device. Please use --recover to unlock the device.")
+        return 16
+    family = argv[argv.index("-f") + 1].lower() if "-f" in argv else ""
+    if "--memrd" in argv:
+        addr = int(argv[argv.index("--memrd") + 1], 16)
+        n = int(argv[argv.index("--n") + 1]) if "--n" in argv else 4
+        words = sim.words(sim.part(family if family != "unknown" else ""))
+        for row in range(addr, addr + n, 16):
+            count = min(4, (addr + n - row + 3) // 4)
+            out(f"0x{row:08X}: " + " ".join(f"{words.get(row + 4 * k, 0xFFFFFFFF):08X}" for k in range(count)))
+        return 0
+    if "--program" in argv:
+        path = argv[argv.index("--program") + 1]
+        nbytes = hex_size(path)
+        out("Parsing image file.")
+        if "--chiperase" in argv:
+            out("Erasing user available code and UICR flash areas.")
+        out("Applying system reset.", "Checking that the area to write is not protected.", "Programming device.")
+        time.sleep(sim.write_time(nbytes))
+        if "--verify" in argv:
+            out("Verifying programming.")
+            time.sleep(sim.write_time(nbytes) * 0.2)
+            out("Verified OK.")
+    if "--reset" in argv:
+        out("Applying system reset.", "Run.")
+    return 0
+
+
+# --- make ---
+def app_image(seed):
+    """Fake application with the key and seed placeholders the patch step looks for"""
+    rand = random.Random(seed)
+    image = bytearray(rand.randbytes(APP_IMAGE_SIZE))
+    table = APP_IMAGE_SIZE // 2
+    image[table:table + KEY_TABLE_SIZE] = bytes(KEY_TABLE_SIZE)
+    image[table:table + len(firmware_image.KEY_PLACEHOLDER)] = firmware_image.KEY_PLACEHOLDER
+    seed_at = table + KEY_TABLE_SIZE + 64
+    image[seed_at:seed_at + len(firmware_image.SEED_PLACEHOLDER)] = firmware_image.SEED_PLACEHOLDER
+    return bytes(image)
+
+
+def make(argv):
+    if "--version" in argv:
+        out("GNU Make 4.3 (simulated)")
+        return 0
+    directory = argv[argv.index("-C") + 1] if "-C" in argv else "."
+    goals = [a for a in argv if not a.startswith("-") and "=" not in a and a != directory]
+    build_dir = os.path.join(directory, "_build")
+    if "clean" in goals:
+        out(f"rm -rf {build_dir}")
+        for name in os.listdir(build_dir) if os.path.isdir(build_dir) else []:
+            try:
+                os.remove(os.path.join(build_dir, name))
+            except OSError:
+                pass
+        return 0
+    target = goals[0] if goals else "default"
+    build_seconds = Sim().build_seconds
+    out(f"make: Entering directory '{os.path.abspath(directory)}'")
+    for n in range(BUILD_FILES):
+        out(f"Compiling file: src_{n:02d}.c")
+        time.sleep(build_seconds * 0.9 / BUILD_FILES)
+    out(f"Linking target: _build/{target}.out")
+    time.sleep(build_seconds * 0.1)
+    os.makedirs(build_dir, exist_ok=True)
+    blocks = content_store.split_blocks([(0, app_image(target))])
+    contents = {content_store.digest(b): b for _, b in blocks}
+    manifest = {"blocks": [[a, len(b), content_store.digest(b)] for a, b in blocks]}
+    with open(os.path.join(build_dir, f"{target}.hex"), "w") as f:
+        f.write(content_store.render_hex(manifest, contents.get))
+    out("Preparing: _build/" + target + ".hex", "DONE " + target)
+    return 0
+
+
+# --- objcopy ---
+def objcopy(argv):
+    if "--version" in argv:
+        out("GNU objcopy (GNU Arm Embedded Toolchain, simulated) 2.40")
+        return 0
+    opts = {}
+    files = []
+    i = 0
+    while i < len(argv):
+        if argv[i] in ("-I", "-O", "--change-addresses") and i + 1 < len(argv):
+            opts[argv[i]] = argv[i + 1]
+            i += 2
+        else:
+            files.append(argv[i])
+            i += 1
+    if len(files) != 2:
+        err("arm-none-eabi-objcopy: expected <input> <output>")
+        return 1
+    src, dst = files
+    try:
+        if opts.get("-I") == "ihex" and opts.get("-O") == "binary":
+            with open(src, "r") as f:
+                runs, _ = content_store.parse_hex(f.read())
+            if not runs:
+                raise ValueError("no data")
+            base = min(a for a, _ in runs)
+            image = bytearray(b"\xFF" * (max(a + len(d) for a, d in runs) - base))
+            for a, d in runs:
+                image[a - base:a - base + len(d)] = d
+            with open(dst, "wb") as f:
+                f.write(image)
+        elif opts.get("-I") == "binary" and opts.get("-O") == "ihex":
+            with open(src, "rb") as f:
+                data = f.read()
+            base = int(opts.get("--change-addresses", "0"), 0)
+            blocks = content_store.split_blocks([(base, data)])
+            contents = {content_store.digest(b): b for _, b in blocks}
+            manifest = {"blocks": [[a, len(b), content_store.digest(b)] for a, b in blocks]}
+            with open(dst, "w") as f:
+                f.write(content_store.render_hex(manifest, contents.get))
+        else:
+            err(f"arm-none-eabi-objcopy: unsupported conversion {opts.get('-I')} -> {opts.get('-O')}")
+            return 1
+    except (OSError, ValueError) as e:
+        err(f"arm-none-eabi-objcopy: {src}: {e}")
+        return 1
+    return 0
+
+
+TOOLS = {"openocd": openocd, "JLinkExe": jlinkexe, "nrfjprog": nrfjprog,
+         "make": make, "arm-none-eabi-objcopy": objcopy}
+
+
+def main(tool):
+    log = os.environ.get("FAKE_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write(f"{time.time():.3f} {tool} {' '.join(sys.argv[1:])}\n")
+    sys.exit(TOOLS[tool](sys.argv[1:]))
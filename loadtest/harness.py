@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput harness on simulated stations.
+
+N stations (one simulated probe each) drive the real build and flash
+paths at the same time and the harness reports throughput, latency
+percentiles and error rates:
+
+    flash     POST /api/flash, poll /api/jobs/<id> until it finishes
+    generate  POST /api/generate (blocks until the build job is done)
+    bridge    POST /api/flash_hex with "wait": true on bridge.py
+
+    python3 loadtest/harness.py --spawn --stations 8 --jobs 5
+    python3 loadtest/harness.py --spawn --target all --disconnect-rate 0.05
+    python3 loadtest/harness.py --web-url https://lab-pc:52810 --target flash
+
+--spawn starts nrf5_airtag_web.py (and bridge.py for the bridge target)
+from this checkout with loadtest/bin first on PATH, so every tool they
+run is a simulator (loadtest/fake_tools.py); the --mode / --*-rate /
+--latency / --flash-kbps / --build-seconds options set its behaviour.
+Without --spawn the servers must already be running (on hardware or with
+the simulators on their PATH).
+"""
+import os
+import re
+import sys
+import ssl
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(LOADTEST_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+sys.path.insert(0, LOADTEST_DIR)
+
+WEB_URL = "https://127.0.0.1:52810"
+BRIDGE_URL = "http://127.0.0.1:5001"
+POLL_INTERVAL = 0.25
+JOB_TIMEOUT = 600
+# Stage spans summed per job from /api/jobs/<id>/trace
+TRACE_STAGES = ["hardware_check", "keygen", "make_clean", "compile", "patch", "objcopy", "sd_merge", "zip", "flash"]
+
+_INSECURE = ssl.create_default_context()
+_INSECURE.check_hostname = False
+_INSECURE.verify_mode = ssl.CERT_NONE  # the web tool runs on a self-signed certificate
+
+
+def http(method, url, body=None, timeout=JOB_TIMEOUT):
+    """(status, parsed JSON or text)"""
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method,
+                                 headers={"Content-Type": "application/json"} if data else {})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout, context=_INSECURE if url.startswith("https") else None) as r:
+            status, raw = r.status, r.read()
+    except urllib.error.HTTPError as e:
+        status, raw = e.code, e.read()
+    try:
+        return status, json.loads(raw)
+    except ValueError:
+        return status, raw.decode("utf-8", errors="replace")
+
+
+def classify(error):
+    """Error category of a failed job / request"""
+    low = (error or "").lower()
+    if "approtect" in low or "protect" in low or "保护" in low:
+        return "chip_protected"
+    if "timeout" in low or "超时" in low:
+        return "timeout"
+    if "connect" in low or "连线" in low or "识别" in low:
+        return "chip_disconnected"
+    if "make failed" in low or "keygen" in low or "toolchain" in low:
+        return "build_failed"
+    return "other"
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+# --- Station workloads ---
+def station_config(args, n, run):
+    return {"prefix": f"S{n:02d}", "start_num": run + 1, "mode": args.key_mode, "key_count": 200,
+            "debugger": args.debugger, "chip": args.chip, "flash_sd": False, "dcdc": False,
+            "base_interval": 2000, "interval_step": 10, "autoflash": False,
+            "session_id": f"loadtest-{n:02d}", "probe_serial": f"SIM{n:04d}"}
+
+
+def trace_stages(web_url, job_id):
+    status, trace = http("GET", f"{web_url}/api/jobs/{job_id}/trace", timeout=10)
+    if status != 200 or not isinstance(trace, dict):
+        return {}
+    stages = defaultdict(float)
+    for s in trace.get("spans", []):
+        if s["name"] in TRACE_STAGES and s.get("dur") is not None:
+            stages[s["name"]] += s["dur"] / 1000.0
+    return dict(stages)
+
+
+def run_flash(args, n, run):
+    status, data = http("POST", f"{args.web_url}/api/flash", station_config(args, n, run), timeout=30)
+    if status != 200 or not isinstance(data, dict) or not data.get("job_id"):
+        return False, f"HTTP {status}: {data}", {}
+    job_id = data["job_id"]
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        status, job = http("GET", f"{args.web_url}/api/jobs/{job_id}", timeout=10)
+        if status == 200 and job.get("state") in ("succeeded", "failed", "cancelled"):
+            return job["state"] == "succeeded", job.get("error") or job["state"], trace_stages(args.web_url, job_id)
+    return False, "timeout (harness)", {}
+
+
+def run_generate(args, n, run):
+    status, data = http("POST", f"{args.web_url}/api/generate", station_config(args, n, run))
+    ok = status == 200 and isinstance(data, dict) and data.get("success")
+    stages = trace_stages(args.web_url, data["job_id"]) if isinstance(data, dict) and data.get("job_id") else {}
+    return bool(ok), None if ok else (data.get("error") if isinstance(data, dict) else f"HTTP {status}"), stages
+
+
+def bridge_hex():
+    """A 64 KB application image as Intel HEX, like the ones the cloud hands out"""
+    import content_store
+    from fake_tools import app_image
+    blocks = content_store.split_blocks([(0x19000, app_image("bridge"))])
+    contents = {content_store.digest(b): b for _, b in blocks}
+    manifest = {"blocks": [[a, len(b), content_store.digest(b)] for a, b in blocks]}
+    return content_store.render_hex(manifest, contents.get)
+
+
+def run_bridge(args, n, run):
+    body = {"hex": args.hex_text, "chip_name": "nRF52832", "debugger": args.debugger,
+            "probe_serial": f"SIM{n:04d}", "wait": True}
+    status, data = http("POST", f"{args.bridge_url}/api/flash_hex", body)
+    ok = status == 200 and isinstance(data, dict) and data.get("success")
+    return bool(ok), None if ok else (data.get("error") if isinstance(data, dict) else f"HTTP {status}"), {}
+
+
+WORKLOADS = {"flash": run_flash, "generate": run_generate, "bridge": run_bridge}
+
+
+def run_target(args, target):
+    results = []
+    lock = threading.Lock()
+
+    def station(n):
+        time.sleep(random.uniform(0, args.ramp))  # operators do not all press the button at once
+        for run in range(args.jobs):
+            t0 = time.monotonic()
+            try:
+                ok, error, stages = WORKLOADS[target](args, n, run)
+            except Exception as e:  # connection refused, reset...
+                ok, error, stages = False, f"{type(e).__name__}: {e}", {}
+            with lock:
+                results.append({"station": n, "ok": ok, "error": error, "latency": time.monotonic() - t0,
+                                "stages": stages, "end": time.monotonic()})
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=station, args=(n,), name=f"station-{n}") for n in range(args.stations)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(target, results, time.monotonic() - started)
+
+
+def summarize(target, results, wall):
+    ok = [r for r in results if r["ok"]]
+    latencies = [r["latency"] for r in ok]
+    errors = Counter(classify(r["error"]) for r in results if not r["ok"])
+    samples = Counter(" ".join((r["error"] or "").split())[:120] for r in results if not r["ok"])
+    stages = defaultdict(list)
+    for r in ok:
+        for name, secs in r["stages"].items():
+            stages[name].append(secs)
+    r3 = lambda v: round(v, 3) if v is not None else None
+    return {"target": target, "requests": len(results), "succeeded": len(ok),
+            "error_rate": round(1 - len(ok) / len(results), 4) if results else None,
+            "wall_s": round(wall, 2), "throughput_per_min": round(len(ok) / wall * 60, 2) if wall else None,
+            "latency_s": {"p50": r3(percentile(latencies, 50)), "p90": r3(percentile(latencies, 90)),
+                          "p99": r3(percentile(latencies, 99)), "max": r3(max(latencies) if latencies else None)},
+            "stages_p50_s": {k: r3(percentile(v, 50)) for k, v in sorted(stages.items())},
+            "errors": dict(errors), "error_samples": dict(samples.most_common(5))}
+
+
+def print_summary(s):
+    lat = s["latency_s"]
+    fmt = lambda v: f"{v:.2f}s" if v is not None else "-"
+    print(f"\n== {s['target']}: {s['succeeded']}/{s['requests']} ok, error rate {s['error_rate']:.1%}, "
+          f"{s['throughput_per_min']} jobs/min over {s['wall_s']} s")
+    print(f"   latency p50 {fmt(lat['p50'])}  p90 {fmt(lat['p90'])}  p99 {fmt(lat['p99'])}  max {fmt(lat['max'])}")
+    if s["stages_p50_s"]:
+        print("   stages p50 " + "  ".join(f"{k} {v:.2f}s" for k, v in s["stages_p50_s"].items()))
+    for category, count in s["errors"].items():
+        print(f"   error {category}: {count}")
+    for sample, count in s["error_samples"].items():
+        print(f"     {count} x {sample}")
+
+
+# --- Spawned servers ---
+def scrape_errors(web_url):
+    """nrf5_errors_total by type from /metrics (single-process server)"""
+    status, text = http("GET", f"{web_url}/metrics", timeout=10)
+    if status != 200 or not isinstance(text, str):
+        return {}
+    return {m.group(1): float(m.group(2)) for m in re.finditer(r'nrf5_errors_total\{type="([^"]+)"\} (\S+)', text)}
+
+
+def spawn(cmd, env, ready_url, name, timeout=30):
+    log = open(os.path.join(LOADTEST_DIR, f"{name}.log"), "w")
+    proc = subprocess.Popen(cmd, cwd=PROJECT_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{name} exited with {proc.returncode}, see loadtest/{name}.log")
+        try:
+            if http("GET", ready_url, timeout=2)[0] == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.3)
+    proc.terminate()
+    raise RuntimeError(f"{name} did not come up within {timeout}s, see loadtest/{name}.log")
+
+
+def simulator_env(args):
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(LOADTEST_DIR, "bin") + os.pathsep + env.get("PATH", "")
+    env.update({"FAKE_MODE": args.mode, "FAKE_APPROTECT_RATE": str(args.approtect_rate),
+                "FAKE_DISCONNECT_RATE": str(args.disconnect_rate), "FAKE_FLASH_KBPS": str(args.flash_kbps),
+                "FAKE_BUILD_SECONDS": str(args.build_seconds)})
+    if args.latency is not None:
+        env["FAKE_LATENCY"] = str(args.latency)
+    return env
+
+
+def add_simulator_options(parser):
+    parser.add_argument("--spawn", action="store_true", help="start the servers with the simulators on PATH")
+    parser.add_argument("--mode", default="success", choices=["success", "approtect", "disconnect", "latency"])
+    parser.add_argument("--approtect-rate", type=float, default=0.0)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, help="seconds to connect to the target")
+    parser.add_argument("--flash-kbps", type=float, default=32)
+    parser.add_argument("--build-seconds", type=float, default=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent station load test on simulated probes")
+    parser.add_argument("--target", choices=["flash", "generate", "bridge", "all"], default="flash")
+    parser.add_argument("--stations", type=int, default=4, help="concurrent stations (one probe each)")
+    parser.add_argument("--jobs", type=int, default=3, help="jobs per station")
+    parser.add_argument("--ramp", type=float, default=2.0, help="stations start within this many seconds")
+    parser.add_argument("--web-url", default=WEB_URL)
+    parser.add_argument("--bridge-url", default=BRIDGE_URL)
+    parser.add_argument("--chip", default="2", help="chip id of the web tool (2 = nRF52832)")
+    parser.add_argument("--debugger", default="2", help="1 J-Link, 2 ST-Link, 3 DAPLink")
+    parser.add_argument("--key-mode", default="1", help="1 dynamic (seed), 0 static keys")
+    add_simulator_options(parser)
+    parser.add_argument("--json", help="write the report here")
+    args = parser.parse_args()
+
+    targets = ["flash", "generate", "bridge"] if args.target == "all" else [args.target]
+    procs = []
+    try:
+        if args.spawn:
+            env = simulator_env(args)
+            if set(targets) & {"flash", "generate"}:
+                port = args.web_url.rsplit(":", 1)[-1].strip("/")
+                procs.append(spawn([sys.executable, "nrf5_airtag_web.py", "--port", port], env,
+                                   f"{args.web_url}/api/toolchain", "web"))
+                http("POST", f"{args.web_url}/api/toolchain/refresh", {}, timeout=60)  # see the simulators now
+            if "bridge" in targets:
+                procs.append(spawn([sys.executable, "bridge.py"], env, f"{args.bridge_url}/api/jobs", "bridge"))
+        if "bridge" in targets:
+            args.hex_text = bridge_hex()
+
+        before = scrape_errors(args.web_url) if set(targets) & {"flash", "generate"} else {}
+        report = {"stations": args.stations, "jobs_per_station": args.jobs,
+                  "simulator": {k: v for k, v in simulator_env(args).items() if k.startswith("FAKE_")}
+                  if args.spawn else None,
+                  "targets": []}
+        for target in targets:
+            summary = run_target(args, target)
+            print_summary(summary)
+            report["targets"].append(summary)
+        if set(targets) & {"flash", "generate"}:
+            after = scrape_errors(args.web_url)
+            report["server_errors"] = {k: after[k] - before.get(k, 0) for k in after if after[k] - before.get(k, 0)}
+            if report["server_errors"]:
+                print("\nServer error counters (/metrics): " +
+                      ", ".join(f"{k} +{v:g}" for k, v in report["server_errors"].items()))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=1)
+            print(f"\nReport: {args.json}")
+    finally:
+        for proc in procs:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
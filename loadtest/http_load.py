@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+HTTP load generator for the web tool: many open browser tabs.
+
+Every simulated session behaves like the page does (templates/index.html):
+
+    GET  /api/logs?session_id=..&start=..   every 0.8 s (the polling fallback)
+    GET  /api/detect_debugger               every 2 s
+    GET  /api/history?show_all=true         now and then (--history-interval)
+    POST /api/generate                      now and then (--generate-interval)
+
+Each session keeps its connections open like a browser. While the load
+runs, the server is sampled every --sample-interval seconds: CPU and RSS of
+the server process tree from /proc (--spawn, or --pid for a server started
+elsewhere on this machine) and the buffer counters of /api/stats/memory.
+The report has latency percentiles per endpoint, a timeline and the memory
+growth rate, for sizing a deployment to a number of stations.
+
+    python3 loadtest/http_load.py --spawn --sessions 50 --duration 120
+    python3 loadtest/http_load.py --spawn --server-args "--production --workers 4"
+    python3 loadtest/http_load.py --web-url https://lab-pc:52810 --pid 4242
+"""
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import argparse
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import (WEB_URL, JOB_TIMEOUT, _INSECURE, percentile, spawn, simulator_env,
+                     add_simulator_options, station_config)
+
+LOGS_INTERVAL = 0.8
+DETECT_INTERVAL = 2.0
+HISTORY_PATH = "/api/history?show_all=true&limit=500"
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+WARMUP_FRACTION = 0.25  # growth rates ignore the first quarter of the run
+
+
+class Client:
+    """One keep-alive connection, reopened when the server drops it"""
+
+    def __init__(self, base_url, timeout=30):
+        u = urllib.parse.urlsplit(base_url)
+        self.https = u.scheme == "https"
+        self.host, self.port = u.hostname, u.port or (443 if self.https else 80)
+        self.timeout = timeout
+        self.conn = None
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def request(self, method, path, body=None):
+        """(status, body bytes); a GET is retried once on a connection the server had closed"""
+        data = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if data else {}
+        for attempt in range(2 if method == "GET" else 1):
+            reused = self.conn is not None
+            if not reused:
+                if self.https:
+                    self.conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=_INSECURE)
+                else:
+                    self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=data, headers=headers)
+                r = self.conn.getresponse()
+                raw = r.read()
+                if r.will_close:
+                    self.close()
+                return r.status, raw
+            except (OSError, http.client.HTTPException):
+                self.close()
+                if not reused or attempt:
+                    raise
+        raise ConnectionError("unreachable")
+
+
+class Recorder:
+    """Every request as (end time, endpoint, latency, ok)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def add(self, endpoint, latency, ok, error=None):
+        with self.lock:
+            self.requests.append((time.monotonic(), endpoint, latency, ok))
+            if not ok:
+                self.errors[endpoint][error] += 1
+
+
+def timed(recorder, endpoint, client, method, path, body=None):
+    t0 = time.monotonic()
+    try:
+        status, raw = client.request(method, path, body)
+    except Exception as e:  # refused, reset, timeout
+        recorder.add(endpoint, time.monotonic() - t0, False, type(e).__name__)
+        return None
+    ok = status == 200
+    recorder.add(endpoint, time.monotonic() - t0, ok, None if ok else f"HTTP {status}")
+    try:
+        return json.loads(raw) if ok else None
+    except ValueError:
+        return None
+
+
+# --- Browser sessions ---
+def run_session(args, n, recorder, stop):
+    session_id = f"httpload-{n:03d}"
+    client = Client(args.web_url)
+    cursor = 0
+    generating = threading.Event()
+    generated = 0
+    now = time.monotonic()
+    due = {"logs": now + random.uniform(0, LOGS_INTERVAL),  # tabs were not opened in the same instant
+           "detect": now + random.uniform(0, DETECT_INTERVAL),
+           "history": now,  # the page loads the history once on open
+           "generate": now + random.expovariate(1 / args.generate_interval) if args.generate_interval else None}
+
+    def generate(run):
+        build = Client(args.web_url, timeout=JOB_TIMEOUT)  # fetch() on a second connection
+        try:
+            timed(recorder, "generate", build, "POST", "/api/generate", dict(station_config(args, n, run),
+                                                                           session_id=session_id))
+        finally:
+            build.close()
+            generating.clear()
+
+    while not stop.is_set():
+        action = min((t, a) for a, t in due.items() if t is not None)[1]
+        if stop.wait(max(0.0, due[action] - time.monotonic())):
+            break
+        if action == "logs":
+            data = timed(recorder, "logs", client, "GET", f"/api/logs?session_id={session_id}&start={cursor}")
+            if data:
+                cursor = data.get("next_index", cursor)
+            due["logs"] = max(due["logs"] + LOGS_INTERVAL, time.monotonic())  # setInterval does not catch up
+        elif action == "detect":
+            timed(recorder, "detect_debugger", client, "GET", "/api/detect_debugger")
+            due["detect"] = max(due["detect"] + DETECT_INTERVAL, time.monotonic())
+        elif action == "history":
+            timed(recorder, "history", client, "GET", HISTORY_PATH)
+            due["history"] = time.monotonic() + random.expovariate(1 / args.history_interval)
+        else:
+            if not generating.is_set():  # the button is disabled while a build runs
+                generating.set()
+                threading.Thread(target=generate, args=(generated,), daemon=True).start()
+                generated += 1
+            due["generate"] = time.monotonic() + random.expovariate(1 / args.generate_interval)
+    client.close()
+
+
+# --- Server sampling ---
+def read_stat(pid):
+    """(comm, ppid, cpu ticks, rss bytes) from /proc/<pid>/stat"""
+    with open(f"/proc/{pid}/stat", "r") as f:
+        head, tail = f.read().rsplit(")", 1)
+    fields = tail.split()
+    return head.split("(", 1)[1], int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21]) * PAGE_SIZE
+
+
+def process_tree(root):
+    """
+    CPU ticks over `root` and all its descendants (gunicorn workers and the
+    tools they run), RSS over the server processes only (same name as `root`)
+    so builds in flight do not show up as memory growth.
+    """
+    stats = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                stats[int(entry)] = read_stat(entry)
+            except (OSError, IndexError, ValueError):
+                pass  # exited while scanning
+    children = defaultdict(list)
+    for pid, (_, ppid, _, _) in stats.items():
+        children[ppid].append(pid)
+    ticks = rss = 0
+    todo = [root]
+    while todo:
+        pid = todo.pop()
+        if pid in stats:
+            comm, _, cpu, mem = stats[pid]
+            ticks += cpu
+            if comm == stats[root][0]:
+                rss += mem
+            todo += children[pid]
+    return ticks, rss
+
+
+def sample_server(args, pid, samples, stop):
+    client = Client(args.web_url, timeout=10)
+    last = None
+    while True:
+        now = time.monotonic()
+        row = {"t": now}
+        if pid:
+            try:
+                ticks, rss = process_tree(pid)
+                row["rss_bytes"] = rss
+                if last:
+                    row["cpu_percent"] = round((ticks - last[1]) / CLK_TCK / (now - last[0]) * 100, 1)
+                last = (now, ticks)
+            except OSError:
+                pid = None  # the server went away
+        try:
+            status, raw = client.request("GET", "/api/stats/memory")
+            mem = json.loads(raw) if status == 200 else {}
+        except (OSError, http.client.HTTPException, ValueError):
+            mem = {}
+        if mem:
+            row.update({"log_entries": mem.get("log_entries"), "log_bytes": mem.get("log_bytes_approx"),
+                        "sessions": mem.get("sessions")})
+            row.setdefault("rss_bytes", mem.get("rss_bytes"))
+        samples.append(row)
+        if stop.wait(args.sample_interval):
+            break
+    client.close()
+
+
+# --- Report ---
+def slope_per_hour(points):
+    """Least-squares slope of (t, value) pairs, per hour"""
+    points = [(t, v) for t, v in points if v is not None]
+    if len(points) < 3:
+        return None
+    mt = sum(t for t, _ in points) / len(points)
+    mv = sum(v for _, v in points) / len(points)
+    var = sum((t - mt) ** 2 for t, _ in points)
+    return sum((t - mt) * (v - mv) for t, v in points) / var * 3600 if var else None
+
+
+def latency_stats(latencies):
+    return {"p50_ms": round(percentile(latencies, 50) * 1000, 1), "p90_ms": round(percentile(latencies, 90) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1), "max_ms": round(max(latencies) * 1000, 1)}
+
+
+def build_report(args, recorder, samples, started, ended):
+    wall = ended - started
+    endpoints = {}
+    for name in sorted({r[1] for r in recorder.requests}):
+        rows = [r for r in recorder.requests if r[1] == name]
+        ok = [r[2] for r in rows if r[3]]
+        endpoints[name] = dict({"requests": len(rows), "errors": len(rows) - len(ok),
+                                "per_s": round(len(rows) / wall, 2)},
+                               **(latency_stats(ok) if ok else {}),
+                               error_kinds=dict(recorder.errors.get(name, {})))
+    timeline = []
+    for prev, row in zip(samples, samples[1:]):
+        window = [r[2] for r in recorder.requests if prev["t"] < r[0] <= row["t"] and r[3] and r[1] != "generate"]
+        timeline.append(dict({k: v for k, v in row.items() if k != "t"}, t=round(row["t"] - started, 1),
+                             requests=len(window), **(latency_stats(window) if window else {})))
+    cpu = [s["cpu_percent"] for s in samples if s.get("cpu_percent") is not None]
+    rss = [s["rss_bytes"] for s in samples if s.get("rss_bytes")]
+    summary = {"sessions": args.sessions, "duration_s": round(wall, 1),
+               "requests_per_s": round(len(recorder.requests) / wall, 1),
+               "cpu_percent_avg": round(sum(cpu) / len(cpu), 1) if cpu else None,
+               "cpu_percent_max": max(cpu) if cpu else None,
+               "cpu_percent_per_session": round(sum(cpu) / len(cpu) / args.sessions, 2) if cpu else None,
+               "rss_start_mb": round(rss[0] / 2 ** 20, 1) if rss else None,
+               "rss_end_mb": round(rss[-1] / 2 ** 20, 1) if rss else None,
+               "rss_peak_mb": round(max(rss) / 2 ** 20, 1) if rss else None}
+    steady = [s for s in samples if s["t"] - started >= wall * WARMUP_FRACTION]  # imports, first builds, caches
+    growth = slope_per_hour([(s["t"], s.get("rss_bytes")) for s in steady])
+    summary["rss_growth_mb_per_h"] = round(growth / 2 ** 20, 1) if growth is not None else None
+    entries = slope_per_hour([(s["t"], s.get("log_entries")) for s in steady])
+    summary["log_entries_growth_per_h"] = round(entries) if entries is not None else None
+    return {"summary": summary, "endpoints": endpoints, "timeline": timeline}
+
+
+def print_report(report):
+    print(f"\n{'endpoint':<16} {'requests':>8} {'errors':>7} {'req/s':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for name, e in report["endpoints"].items():
+        lat = [f"{e[k]:.1f}ms" if k in e else "-" for k in ("p50_ms", "p90_ms", "p99_ms", "max_ms")]
+        print(f"{name:<16} {e['requests']:>8} {e['errors']:>7} {e['per_s']:>7} " + " ".join(f"{v:>9}" for v in lat))
+        for kind, count in e["error_kinds"].items():
+            print(f"  {count} x {kind}")
+
+    print(f"\n{'t':>7} {'req':>6} {'poll p50':>9} {'poll p99':>9} {'cpu%':>7} {'rss MB':>8} {'log entries':>12}")
+    for row in report["timeline"]:
+        p50 = f"{row['p50_ms']:.1f}ms" if "p50_ms" in row else "-"
+        p99 = f"{row['p99_ms']:.1f}ms" if "p99_ms" in row else "-"
+        cpu = row.get("cpu_percent", "-")
+        rss = f"{row['rss_bytes'] / 2 ** 20:.1f}" if row.get("rss_bytes") else "-"
+        print(f"{row['t']:>7} {row['requests']:>6} {p50:>9} {p99:>9} {cpu:>7} {rss:>8} {row.get('log_entries', '-'):>12}")
+
+    s = report["summary"]
+    print(f"\n{s['sessions']} sessions, {s['requests_per_s']} req/s over {s['duration_s']} s")
+    if s["cpu_percent_avg"] is not None:
+        print(f"server CPU avg {s['cpu_percent_avg']}% (max {s['cpu_percent_max']}%), "
+              f"~{s['cpu_percent_per_session']}% per session")
+    if s["rss_end_mb"] is not None:
+        print(f"server RSS {s['rss_start_mb']} -> {s['rss_end_mb']} MB (peak {s['rss_peak_mb']} MB), "
+              f"after warm-up {s['rss_growth_mb_per_h']} MB/h, log entries {s['log_entries_growth_per_h']}/h")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Browser-like HTTP load on the web tool")
+    parser.add_argument("--sessions", type=int, default=20, help="open browser tabs")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of load")
+    parser.add_argument("--ramp", type=float, default=5, help="tabs open within this many seconds")
+    parser.add_argument("--history-interval", type=float, default=30, help="mean seconds between history views")
+    parser.add_argument("--generate-interval", type=float, default=120,
+                        help="mean seconds between builds per session (0 = never)")
+    parser.add_argument("--sample-interval", type=float, default=2, help="seconds between server samples")
+    parser.add_argument("--web-url", default=WEB_URL)
+    parser.add_argument("--pid", type=int, help="server pid to sample CPU / RSS from (same machine)")
+    parser.add_argument("--server-args", default="", help="extra nrf5_airtag_web.py arguments with --spawn")
+    parser.add_argument("--chip", default="2", help="chip id for /api/generate (2 = nRF52832)")
+    parser.add_argument("--debugger", default="2")
+    parser.add_argument("--key-mode", default="1")
+    add_simulator_options(parser)
+    parser.add_argument("--json", help="write the report here")
+    args = parser.parse_args()
+
+    proc = None
+    try:
+        pid = args.pid
+        if args.spawn:
+            port = args.web_url.rsplit(":", 1)[-1].strip("/")
+            cmd = [sys.executable, "nrf5_airtag_web.py", "--port", port] + shlex.split(args.server_args)
+            proc = spawn(cmd, simulator_env(args), f"{args.web_url}/api/toolchain", "web", timeout=60)
+            pid = proc.pid
+        recorder, samples, stop = Recorder(), [], threading.Event()
+        sampler = threading.Thread(target=sample_server, args=(args, pid, samples, stop), name="sampler")
+        sampler.start()
+        started = time.monotonic()
+
+        def delayed_session(n):
+            if not stop.wait(random.uniform(0, args.ramp)):
+                run_session(args, n, recorder, stop)
+
+        sessions = [threading.Thread(target=delayed_session, args=(n,), name=f"session-{n}", daemon=True)
+                    for n in range(args.sessions)]
+        for t in sessions:
+            t.start()
+        try:
+            time.sleep(args.duration)
+        except KeyboardInterrupt:
+            pass
+        stop.set()
+        ended = time.monotonic()
+        for t in sessions:
+            t.join(10)
+        sampler.join()
+
+        report = build_report(args, recorder, samples, started, ended)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=1)
+            print(f"\nReport: {args.json}")
+    finally:
+        if proc:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
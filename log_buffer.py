@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Fixed-capacity per-session log ring buffer.
+
+Every entry gets a monotonically increasing sequence number, so a client
+cursor (the `start` / `next_index` of /api/logs and the SSE event id)
+stays valid even after old entries have been dropped or the log has been
+cleared: reading from a cursor that has fallen off the ring simply resumes
+at the oldest entry still held and reports how many were missed.
+"""
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+
+class LogRing:
+    def __init__(self, capacity=2000):
+        self.entries = deque(maxlen=capacity)
+        self.next_seq = 0
+        self.dropped = 0
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+
+    def append(self, entry):
+        """Store `entry` (a dict); returns its sequence number"""
+        with self.lock:
+            if len(self.entries) == self.entries.maxlen:
+                self.dropped += 1
+            entry["seq"] = self.next_seq
+            self.entries.append(entry)
+            self.next_seq += 1
+            self.last_active = time.monotonic()
+            return entry["seq"]
+
+    def read(self, cursor=0):
+        """Entries with seq >= cursor. Returns (entries, next_cursor, missed)."""
+        with self.lock:
+            self.last_active = time.monotonic()
+            first_seq = self.next_seq - len(self.entries)
+            cursor = max(0, min(int(cursor), self.next_seq))
+            missed = max(0, first_seq - cursor)
+            skip = max(0, cursor - first_seq)
+            return list(islice(self.entries, skip, None)), self.next_seq, missed
+
+    def clear(self):
+        """Drop all entries; sequence numbers keep counting"""
+        with self.lock:
+            self.entries.clear()
+            self.last_active = time.monotonic()
+
+    def idle_seconds(self):
+        return time.monotonic() - self.last_active
+
+    def approx_bytes(self):
+        """Rough memory held by the entries (dict + string payloads)"""
+        with self.lock:
+            total = sys.getsizeof(self.entries)
+            for e in self.entries:
+                total += sys.getsizeof(e) + sum(sys.getsizeof(v) for v in e.values())
+            return total
+
+    def __len__(self):
+        return len(self.entries)
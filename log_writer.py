@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Asynchronous, batched log file writer.
+
+log() used to open, append one line to and close the log file for every
+message, hundreds of times per build. Records are now put on a queue and a
+background thread writes them in batches: a batch is flushed
+`flush_interval` seconds after its first record or once it holds
+`batch_size` records, through a file handle kept open between batches.
+The file is rotated when it grows past `max_bytes`
+(file -> file.1 -> file.2 ...). Several processes may append to the same
+file: with `lock_path` rotation happens under a cross-process lock
+(file_lock.py), and a writer whose file was rotated by another process
+reopens it. Records can be written as the classic text lines or as JSON
+lines.
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+
+import file_lock
+
+
+class LogFileWriter:
+    def __init__(self, path, json_lines=False, flush_interval=0.5, batch_size=200,
+                 max_bytes=5 * 1024 * 1024, backup_count=5, lock_path=None):
+        self.path = path
+        self.json_lines = json_lines
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_lock = file_lock.FileLock(lock_path) if lock_path else threading.Lock()
+        self.file = None
+        self.queue = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.written = 0
+        self.batches = 0
+        self.rotations = 0
+        self.errors = 0
+
+    def start(self):
+        with self.start_lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name="log-writer")
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register(self.close)
+
+    def write(self, record):
+        """Queue a record: {"time", "level", "msg", ...}. Never blocks on disk."""
+        if not self.thread:
+            self.start()
+        self.queue.put(record)
+
+    def format(self, record):
+        if self.json_lines:
+            return json.dumps(record, ensure_ascii=False) + "\n"
+        return f"[{record['time']}] [{record['level'].upper()}] {record['msg']}\n"
+
+    def _run(self):
+        stop = False
+        while not stop:
+            # Block for the first record, then keep collecting until the batch is
+            # flush_interval old or full
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stop = True  # close() sentinel; still write what came before it
+                batch.pop()
+            if batch:
+                self._write_batch(batch)
+        self._close_file()
+
+    def _write_batch(self, batch):
+        try:
+            self._maybe_rotate()
+            f = self._open_file()
+            f.write("".join(self.format(r) for r in batch))
+            f.flush()
+            self.written += len(batch)
+            self.batches += 1
+        except Exception:
+            self.errors += 1
+            self._close_file()
+
+    def _open_file(self):
+        """The append handle, reopened if the file was rotated or removed (possibly by another process)"""
+        if self.file is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino:
+                    return self.file
+            except OSError:
+                pass
+            self._close_file()
+        self.file = open(self.path, "a", encoding="utf-8")
+        return self.file
+
+    def _close_file(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+    def _oversized(self):
+        try:
+            return os.path.getsize(self.path) >= self.max_bytes
+        except OSError:
+            return False
+
+    def _maybe_rotate(self):
+        if not self.max_bytes or not self._oversized():
+            return
+        with self.rotate_lock:
+            if not self._oversized():
+                return  # another process rotated it first
+            for i in range(self.backup_count - 1, 0, -1):
+                src, dst = f"{self.path}.{i}", f"{self.path}.{i + 1}"
+                if os.path.exists(src):
+                    os.replace(src, dst)
+            if self.backup_count > 0:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+        self._close_file()
+        self.rotations += 1
+
+    def close(self, timeout=2.0):
+        """Flush pending records and stop the writer thread"""
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+    def stats(self):
+        return {"path": self.path, "json_lines": self.json_lines, "pending": self.queue.qsize(),
+                "written": self.written, "batches": self.batches, "rotations": self.rotations,
+                "errors": self.errors}
@@ -2,42 +2,136 @@
 import os
 import sys
 import threading
-import subprocess
 import binascii
 import shutil
-import zipfile
 import time
 from datetime import datetime
 import glob
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import json
+import tempfile
+from contextlib import contextmanager
+import hashlib
+import hmac
+import functools
+from urllib.parse import quote
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, abort, g
+from werkzeug.security import safe_join
+from target_watch import TargetWatcher
+from identity_pool import IdentityPool, pool_key
+import toolchain
+import chip_ident
+import usb_inventory
+from log_buffer import LogRing
+from log_writer import LogFileWriter
+from job_queue import JobScheduler, JobCancelled, JobFailed, ACTIVE_STATES, FINAL_STATES
+from state_store import StateStore
+from bundle_catalog import BundleCatalog
+from storage_gc import StorageManager
+import zip_stream
+import firmware_image
+import content_store
+import flash_progress
+import proc_runner
+import probe_select
+import file_lock
+import metrics
+import tracing
+import profiler
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 
 # --- Global State ---
 STATE = {
-    "logs": {},  # session_id -> [log_list]
-    "session_state": {},  # session_id -> {"is_flashing": bool, ...}
+    "logs": {},  # session_id -> LogRing
+    "session_state": {},  # session_id -> {"is_flashing": bool, "status_message": str, "job": dict, ...}
     "last_log_index": 0,
-    "status_message": "Ready",
-    "stop_signal": False,
-    "is_flashing": False,
-    "log_history": []
+    "evicted_sessions": 0
 }
 
+# Log retention: entries kept per session, idle time before a session is dropped
+LOG_RING_CAPACITY = 2000
+SESSION_TTL = 6 * 3600
+
+# user_sessions/ storage: quotas and garbage collection (see storage_gc.py)
+SESSION_QUOTA_BYTES = 200 * 1024 * 1024
+STORAGE_QUOTA_BYTES = 5 * 1024 ** 3
+INTERMEDIATE_TTL = 3600      # raw/patched images, scripts: kept this long after a build
+STORAGE_GC_INTERVAL = 600
+
+# Zip compression (see zip_stream.py): bundles are deflated on disk, batch
+# downloads store the bundles as they are; ?compression= overrides per request
+BUNDLE_COMPRESSION = "deflate"
+ARCHIVE_COMPRESSION = "store"
+
+# Downloads carry content-hash ETags (304 on re-download) and honour Range.
+# Behind a reverse proxy the file transfer itself can be handed off:
+# "x-sendfile" (Apache / lighttpd) or "x-accel" (nginx, with an `internal`
+# location X_ACCEL_PREFIX aliased to the project directory).
+DOWNLOAD_OFFLOAD = None
+X_ACCEL_PREFIX = "/_protected/"
+app.config['USE_X_SENDFILE'] = DOWNLOAD_OFFLOAD == "x-sendfile"
+
 # --- Configuration ---
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 STATIC_FOLDER = os.path.join(PROJECT_ROOT, "templates")
 CONFIG_DIR = os.path.join(PROJECT_ROOT, "config")
 SESSIONS_DIR = os.path.join(PROJECT_ROOT, "user_sessions")
+POOL_DIR = os.path.join(PROJECT_ROOT, "identity_pool")
+JOBS_FILE = os.path.join(CONFIG_DIR, "jobs.json")
+JOBS_DIR = os.path.join(CONFIG_DIR, "jobs")  # uploaded hex files of queued /api/flash_hex jobs
+STATE_DB = os.path.join(CONFIG_DIR, "state.db")
+BUNDLE_DB = os.path.join(CONFIG_DIR, "bundles.db")
+TRACES_DIR = os.path.join(CONFIG_DIR, "traces")  # one span timeline per job
+CONTENT_DIR = os.path.join(CONFIG_DIR, "content")  # hash-addressed firmware blocks for the bridge
+PROFILES_DIR = os.path.join(CONFIG_DIR, "profiles")  # collapsed stacks of profiled requests / jobs
+LOCKS_DIR = os.path.join(CONFIG_DIR, "locks")  # cross-process lock files (file_lock.py)
+
+# Admin endpoints (/api/admin/*: profiling, memory snapshots) exist only while
+# this file is present; requests must send its content as X-Admin-Token.
+ADMIN_TOKEN_FILE = os.path.join(CONFIG_DIR, "admin_token")
+ADMIN_LOCAL_ONLY = True  # and only from this machine (127.0.0.1 / ::1)
+
+# Shared SQLite store for sessions / logs / jobs (production mode, see use_state_store).
+# None = single process, everything lives in STATE.
+STORE = None
 
 # Ensure directories exist
-for d in [CONFIG_DIR, SESSIONS_DIR]:
+for d in [CONFIG_DIR, SESSIONS_DIR, JOBS_DIR, LOCKS_DIR]:
     if not os.path.exists(d):
         os.makedirs(d)
 
-# Global Build Lock to prevent race conditions during 'make'
-BUILD_LOCK = threading.Lock()
+# Woken on every log entry / session state change (drives /api/stream)
+STATE_CHANGED = threading.Condition()
+STATE_VERSION = 0
+
+# Global Build Lock to prevent race conditions during 'make' (held across worker processes)
+BUILD_LOCK = file_lock.FileLock(os.path.join(LOCKS_DIR, "build.lock"))
+# One tool on a probe at a time, whichever process runs it (see probe_lock())
+PROBE_LOCKS = file_lock.FileLockSet(os.path.join(LOCKS_DIR, "probes"))
+
+# Job scheduling: concurrent jobs overall / per session / per probe, stage worker pools
+MAX_RUNNING_JOBS = 16
+JOBS_PER_SESSION = 1
+JOBS_PER_PROBE = 1
+BUILD_WORKERS = 2   # key generation runs in parallel; make clean + make hold BUILD_LOCK
+FLASH_WORKERS = 8
+GENERATE_WAIT = 300  # seconds /api/generate waits for its build job
+
+# Index of generated bundles behind /api/history
+BUNDLES = BundleCatalog(BUNDLE_DB, CONFIG_DIR, SESSIONS_DIR)
+
+# Blocks of generated images; a bridge fetches only the ones it lacks (see content_store.py)
+CONTENT = content_store.ContentStore(CONTENT_DIR)
+
+# Pre-generated identity pools (pool key -> IdentityPool)
+IDENTITY_POOLS = {}
+IDENTITY_POOLS_LOCK = threading.Lock()
 LOG_FILE = os.path.join(PROJECT_ROOT, "device_flash_log_web.txt")
+# Set to True for structured JSON-lines output (device_flash_log_web.jsonl)
+LOG_JSON_LINES = False
+# Production workers share the file; rotation is serialised through a lock file
+LOG_WRITER = LogFileWriter(os.path.splitext(LOG_FILE)[0] + ".jsonl" if LOG_JSON_LINES else LOG_FILE,
+                           json_lines=LOG_JSON_LINES, lock_path=os.path.join(LOCKS_DIR, "log_rotate.lock"))
 # --- Chip Config Map (NEW) ---
 CHIP_MAP = {
     "1": {
@@ -89,6 +183,10 @@ OPENOCD_INTERFACES = {
 def get_openocd_interface(debugger_id):
     return OPENOCD_INTERFACES.get(str(debugger_id), 'interface/stlink.cfg')
 
+# Toolchain capabilities (rescanned in the background at startup)
+TOOLCHAIN_CACHE_FILE = os.path.join(CONFIG_DIR, "toolchain.json")
+toolchain.load(TOOLCHAIN_CACHE_FILE)
+
 # Auto-detection: map chip name to config key
 CHIP_NAME_TO_KEY = {
     "nRF51822": "1",
@@ -119,143 +217,413 @@ def log(msg, level="info", session_id=None):
         "class": css_class
     }
     
-    # Session isolation
-    if session_id:
-        if session_id not in STATE["logs"]:
-            STATE["logs"][session_id] = []
-        STATE["logs"][session_id].append(entry)
+    # Session isolation (fallback "global" for truly global/system logs)
+    if STORE:
+        STORE.append_log(session_id or "global", entry, LOG_RING_CAPACITY)
     else:
-        # Fallback for truly global/system logs
-        if "global" not in STATE["logs"]:
-            STATE["logs"]["global"] = []
-        STATE["logs"]["global"].append(entry)
+        get_log_ring(session_id or "global").append(entry)
+    notify_state_changed()
 
     # console preview
     print(f"[{timestamp}] {msg}")
     
-    # file persistence
+    # file persistence (batched by the background writer thread)
+    LOG_WRITER.write({"time": timestamp, "level": level, "msg": msg, "session_id": session_id})
+
+def get_log_ring(session_id):
+    """Ring buffer holding a session's log (created on first use)"""
+    ring = STATE["logs"].get(session_id)
+    if ring is None:
+        ring = STATE["logs"].setdefault(session_id, LogRing(LOG_RING_CAPACITY))
+    return ring
+
+def evict_idle_sessions(ttl=None):
+    """Drop logs and state of sessions idle for longer than the TTL; returns count"""
+    ttl = SESSION_TTL if ttl is None else ttl
+    evicted = 0
+    if STORE:
+        for sid, state in STORE.idle_sessions(ttl):
+            if sid != "global" and not state.get("is_flashing"):
+                STORE.drop_session(sid)
+                evicted += 1
+        STATE["evicted_sessions"] += evicted
+        return evicted
+    for sid, ring in list(STATE["logs"].items()):
+        if sid == "global" or ring.idle_seconds() < ttl:
+            continue
+        if STATE["session_state"].get(sid, {}).get("is_flashing"):
+            continue
+        STATE["logs"].pop(sid, None)
+        STATE["session_state"].pop(sid, None)
+        evicted += 1
+    STATE["evicted_sessions"] += evicted
+    return evicted
+
+def session_evictor_loop():
+    while True:
+        time.sleep(60)
+        try:
+            n = evict_idle_sessions()
+            if n:
+                log(f"Evicted {n} idle session(s) | 已清理空闲会话", "info")
+        except Exception as e:
+            print(f"Session eviction failed: {e}")
+
+def process_rss_bytes():
+    """Resident memory of this process (None if unknown)"""
     try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(f"[{timestamp}] [{level.upper()}] {msg}\n")
-    except:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
         pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024  # peak, not current
+    except Exception:
+        return None
+
+def notify_state_changed():
+    """Wake up streaming clients"""
+    global STATE_VERSION
+    with STATE_CHANGED:
+        STATE_VERSION += 1
+        STATE_CHANGED.notify_all()
 
 # Session State Helpers
+def session_state_of(session_id):
+    """All state values of a session (a copy in production mode)"""
+    if STORE:
+        return STORE.get_state(session_id)
+    return STATE["session_state"].get(session_id, {})
+
 def get_session_state(session_id, key, default=None):
     """Get a value from session state"""
     if not session_id:
         return default
-    session_state = STATE["session_state"].get(session_id, {})
-    return session_state.get(key, default)
+    return session_state_of(session_id).get(key, default)
 
 def set_session_state(session_id, key, value):
     """Set a value in session state"""
     if not session_id:
         return
+    if STORE:
+        STORE.set_state(session_id, key, value)
+        notify_state_changed()
+        return
     if session_id not in STATE["session_state"]:
         STATE["session_state"][session_id] = {}
     STATE["session_state"][session_id][key] = value
+    get_log_ring(session_id).last_active = time.monotonic()  # keeps the session alive
+    notify_state_changed()
 
-def run_command(cmd, cwd=None, timeout=None, log_func=None):
-    """Run shell command. If log_func provided, streams stdout line-by-line."""
-    try:
-        # If no logging needed, use simple subprocess.run
-        if not log_func:
-            proc = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, timeout=timeout)
-            combined_output = (proc.stdout + "\n" + proc.stderr).strip()
-            if proc.returncode != 0:
-                return False, combined_output
-            return True, combined_output
-            
-        # Streaming mode
-        proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
-        output_lines = []
-        
-        start_time = datetime.now()
-        while True:
-            # Check timeout
-            if timeout and (datetime.now() - start_time).total_seconds() > timeout:
-                proc.kill()
-                return False, "Timeout"
-                
-            line = proc.stdout.readline()
-            if not line and proc.poll() is not None:
-                break
-            if line:
-                clean_line = line.strip()
-                if clean_line:
-                    output_lines.append(clean_line)
-                    # Broad filter for build and flash
-                    keywords = ["Compiling", "Linking", "Programming", "Verify", "Reading", "Writing", "Erasing", "Download", "O.K.", "Verified", "nRF5", "J-Link", "OpenOCD", "Flash", "halted"]
-                    if any(k in clean_line for k in keywords) or "error" in clean_line.lower() or "warning" in clean_line.lower():
-                        log_func(f"> {clean_line}", "info")
-        
-        rc = proc.poll()
-        full_output = "\n".join(output_lines)
-        if rc != 0:
-            return False, full_output
-        return True, full_output
+def set_status(msg, session_id=None):
+    """Status line shown to the session running the current job"""
+    if not session_id:
+        session_id = getattr(threading.current_thread(), "session_id", None)
+    # Work without a session reports on the "global" log / status
+    set_session_state(session_id or "global", "status_message", msg)
 
-    except subprocess.TimeoutExpired:
+# Broad filter for build and flash
+TOOL_LOG_KEYWORDS = ["Compiling", "Linking", "Programming", "Verify", "Reading", "Writing", "Erasing", "Download", "O.K.", "Verified", "nRF5", "J-Link", "OpenOCD", "Flash", "halted"]
+
+def tool_line_handler(log_func=None, progress=None):
+    """on_line(stream, line) for tool output: feeds `progress`, passes notable lines to log_func"""
+    def on_line(stream, line):
+        clean_line = line.strip()
+        if not clean_line:
+            return
+        if progress:
+            progress.feed(clean_line)
+        if log_func and (any(k in clean_line for k in TOOL_LOG_KEYWORDS) or "error" in clean_line.lower() or "warning" in clean_line.lower()):
+            log_func(f"> {clean_line}", "info")
+    return on_line
+
+def run_command(cmd, cwd=None, timeout=None, log_func=None, progress=None):
+    """
+    Run shell command on the shared process runner (proc_runner.py): stdout and
+    stderr drained together, `timeout` enforced even if the tool goes silent.
+    If log_func provided, streams output line-by-line.
+    A flash_progress.ProgressTracker in `progress` sees every output line.
+    On a stage thread the tool is killed once the job is cancelled.
+    """
+    on_line = tool_line_handler(log_func, progress)
+    job = getattr(threading.current_thread(), "job", None)
+    with TRACER.span("run_command", argv=cmd, timeout=timeout) as span:
+        try:
+            result = proc_runner.run(cmd, cwd=cwd, timeout=timeout, on_line=on_line if (log_func or progress) else None,
+                                     cancel=(lambda: job.cancelled) if job is not None else None)
+        except Exception as e:
+            span.update(status="error", error=str(e))
+            return False, str(e)
+        span.update(exit_code=result.returncode, timed_out=result.timed_out, cancelled=result.cancelled,
+                    output_lines=len(result.lines))
+        if not result.ok:
+            span["status"] = "error"
+    if result.cancelled:
+        return False, "Cancelled"
+    if result.timed_out:
         return False, "Timeout"
-    except Exception as e:
-        return False, str(e)
+    if log_func or progress:
+        output = "\n".join(line.strip() for _, line in result.lines if line.strip())
+    else:
+        output = result.output
+    return result.returncode == 0, output
+
+def run_session_commands(watcher, cmds, timeout=None, log_func=None, progress=None):
+    """
+    run_command() for a TargetWatcher's persistent OpenOCD session: same
+    trace span, log lines and progress feed, no process spawn.
+    """
+    with TRACER.span("run_command", argv=["openocd-session"] + list(cmds), timeout=timeout) as span:
+        success, output = watcher.run(cmds, timeout=timeout or 60, on_line=tool_line_handler(log_func, progress))
+        span.update(exit_code=0 if success else 1, output_lines=len(output.splitlines()))
+        if not success:
+            span["status"] = "error"
+    return success, output
+
+# --- Adaptive SWD Clock ---
+# Fastest first; cheap clones with flying leads usually settle at 1000 kHz or below
+SWD_SPEEDS_KHZ = [4000, 2000, 1000, 500, 250]
+SWD_MAX_ATTEMPTS = 3  # step-downs per flash before giving up
+SWD_SPEEDUP_AFTER = 50        # successes at a stepped-down speed before one step faster is tried again
+SWD_SPEEDUP_AGE = 24 * 3600   # ... or seconds since that speed was settled
+PROBE_SPEED_FILE = os.path.join(CONFIG_DIR, "probe_speeds.json")
+PROBE_SPEEDS_LOCK = threading.Lock()
+
+def _load_probe_speeds():
+    try:
+        with open(PROBE_SPEED_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+PROBE_SPEEDS = _load_probe_speeds()  # "debugger:serial:chip" -> {"khz", "kbps", "updated", "streak", "since"}
+
+def probe_speed_key(debugger_type, chip_cfg, probe_serial=None):
+    return f"{debugger_type}:{probe_serial or 'default'}:{chip_cfg['name']}"
+
+def get_swd_speed_ladder(key, explore=True):
+    """
+    Speeds to try, starting from the last speed known to work for this probe/target.
+    A step-down is not for good: after SWD_SPEEDUP_AFTER successes or SWD_SPEEDUP_AGE
+    seconds at it, one step faster is tried first (explore=False: presence checks).
+    """
+    entry = PROBE_SPEEDS.get(key, {})
+    known = entry.get("khz")
+    if known not in SWD_SPEEDS_KHZ:
+        return list(SWD_SPEEDS_KHZ)
+    i = SWD_SPEEDS_KHZ.index(known)
+    if explore and i > 0 and (entry.get("streak", 0) >= SWD_SPEEDUP_AFTER or
+                              time.time() - entry.get("since", 0) >= SWD_SPEEDUP_AGE):
+        i -= 1
+    return SWD_SPEEDS_KHZ[i:]
+
+def remember_swd_speed(key, khz, kbps, first_try=True):
+    """Record a successful flash; the success streak restarts on a new speed or after a failed attempt"""
+    with PROBE_SPEEDS_LOCK:
+        prev = PROBE_SPEEDS.get(key, {})
+        if prev.get("khz") == khz and first_try:
+            streak, since = prev.get("streak", 0) + 1, prev.get("since", time.time())
+        else:
+            streak, since = 1, time.time()
+        PROBE_SPEEDS[key] = {"khz": khz, "kbps": round(kbps, 1), "updated": datetime.now().isoformat(timespec='seconds'),
+                             "streak": streak, "since": since}
+        try:
+            with open(PROBE_SPEED_FILE, "w") as f:
+                json.dump(PROBE_SPEEDS, f, indent=1)
+        except OSError:
+            pass
+
+# Flash / build progress (see flash_progress.py): published to the session status
+THROUGHPUT = flash_progress.ThroughputStats(os.path.join(CONFIG_DIR, "probe_throughput.json"))
+BUILD_UNITS = {}  # build_name -> files compiled by the last build (scales the build percentage)
+
+# Metrics (see metrics.py), served at /metrics in Prometheus text format
+METRICS = metrics.Registry()
+STAGE_SECONDS = METRICS.histogram("nrf5_stage_duration_seconds", "Duration of build and flash stages", ["stage"])
+JOBS_FINISHED = METRICS.counter("nrf5_jobs_finished_total", "Finished jobs by kind and final state", ["kind", "state"])
+ERRORS = METRICS.counter("nrf5_errors_total", "Failures by error type", ["type"])
+FLASHES = METRICS.counter("nrf5_flash_attempts_total", "Flash attempts by result", ["result"])
+ACTIVE_FLASHES = METRICS.gauge("nrf5_flashes_active", "Flashes in progress")
+ACTIVE_FLASHES.set(0)
+METRICS.gauge("nrf5_jobs_queued", "Jobs waiting in the queue", func=lambda: SCHEDULER.stats()["queued"])
+METRICS.gauge("nrf5_jobs_running", "Jobs running", func=lambda: SCHEDULER.stats()["running"])
+
+def current_job_id():
+    job = getattr(threading.current_thread(), "job", None)
+    return job.id if job else None
+
+def check_cancelled():
+    """Raise JobCancelled if the job of the calling (stage) thread has been cancelled"""
+    job = getattr(threading.current_thread(), "job", None)
+    if job is not None and job.cancelled:
+        raise JobCancelled()
+
+# Span timeline of every job (see tracing.py): /api/jobs/<id>/trace
+TRACER = tracing.Tracer(TRACES_DIR, resolve=current_job_id)
+
+@contextmanager
+def stage(name, **attrs):
+    """Time one build / flash stage (nrf5_stage_duration_seconds) and trace it as a span"""
+    with STAGE_SECONDS.time(stage=name), TRACER.span(name, **attrs) as span:
+        yield span
+
+def traced_job(handler):
+    """Scheduler handler wrapper: record the job's trace"""
+    def run(job):
+        with TRACER.trace(job.id, f"job:{job.kind}", kind=job.kind, session_id=job.session_id, probe=job.probe):
+            return handler(job)
+    return run
+
+# Opt-in sampling profiler and tracemalloc snapshots (see profiler.py), switched via /api/admin/*
+PROFILER = profiler.SamplingProfiler(PROFILES_DIR, os.path.join(CONFIG_DIR, "profiling.json"))
+MEMORY = profiler.MemoryTracer()
+
+def progress_publisher(session_id=None):
+    """on_update callback for a ProgressTracker: the snapshot becomes the session's `progress`"""
+    session_id = session_id or getattr(threading.current_thread(), "session_id", None) or "global"
+    return lambda snap: set_session_state(session_id, "progress", snap)
+
+def hex_data_size(hex_path):
+    """Number of payload bytes in an Intel HEX file (data records only)"""
+    total = 0
+    try:
+        with open(hex_path, "r") as f:
+            for line in f:
+                if line.startswith(":") and line[7:9] == "00":
+                    total += int(line[1:3], 16)
+    except (OSError, ValueError):
+        pass
+    return total
+
+def probe_lock(debugger_type, probe_serial=None):
+    """Cross-process lock of one physical probe"""
+    return PROBE_LOCKS.get(f"{probe_select.inventory_type(debugger_type)}:{probe_serial or 'default'}")
 
-# Helper to perform one flash attempt (Global)
-def perform_flash(CHIP_CFG, patch_hex, debugger_type, flash_sd=False, timeout_val=None, probe_only=False, session_id=None):
+def is_protection_error(msg):
+    m = msg.lower()
+    return "approtect" in m or "protected" in m or "locked" in m
+
+@TRACER.traced
+@PROFILER.profiled
+def perform_flash(CHIP_CFG, patch_hex, debugger_type, flash_sd=False, timeout_val=None, probe_only=False, session_id=None, watcher=None, probe_serial=None):
+    """
+    Flash with SWD clock negotiation: start at the fastest (or last known good)
+    speed and step down on link errors. Returns {"speed_khz", "kbps", "seconds"}.
+    """
+    key = probe_speed_key(debugger_type, CHIP_CFG, probe_serial)
+    ladder = get_swd_speed_ladder(key, explore=not probe_only)
+    if probe_only:
+        with probe_lock(debugger_type, probe_serial):
+            flash_once(CHIP_CFG, patch_hex, debugger_type, flash_sd, timeout_val, True, session_id, watcher, ladder[0], probe_serial=probe_serial)
+        return None
+
+    image_bytes = hex_data_size(patch_hex)
+    if flash_sd:
+        image_bytes += hex_data_size(os.path.join(PROJECT_ROOT, CHIP_CFG['sd_hex']))
+    probe = f"{debugger_type}:{probe_serial or 'default'}"
+    expected_bps = THROUGHPUT.get(probe).get("avg_bps") or (PROBE_SPEEDS.get(key, {}).get("kbps") or 0) * 1024 or None
+
+    last_error = None
+    for attempt, khz in enumerate(ladder[:SWD_MAX_ATTEMPTS]):
+        check_cancelled()
+        t0 = time.monotonic()
+        tracker = flash_progress.ProgressTracker("flash", image_bytes, expected_bps, on_update=progress_publisher(session_id))
+        try:
+            with probe_lock(debugger_type, probe_serial), stage("flash", speed_khz=khz), ACTIVE_FLASHES.track():
+                flash_once(CHIP_CFG, patch_hex, debugger_type, flash_sd, timeout_val, False, session_id, watcher, khz, progress=tracker,
+                           probe_serial=probe_serial)
+        except Exception as e:
+            tracker.finish(ok=False)
+            check_cancelled()  # the tool was killed for a cancel, not a link error
+            last_error = e
+            if is_protection_error(str(e)):
+                FLASHES.inc(result="chip_protected")
+                ERRORS.inc(type="chip_protected")
+                raise  # a slower clock will not help
+            FLASHES.inc(result="timeout" if "Timeout" in str(e) else "failed")
+            log(f"Flash failed at {khz} kHz, stepping down... | SWD 时钟降速重试", "warning", session_id=session_id)
+            continue
+        elapsed = max(time.monotonic() - t0, 1e-3)
+        tracker.finish()
+        FLASHES.inc(result="success")
+        kbps = image_bytes / 1024.0 / elapsed
+        remember_swd_speed(key, khz, kbps, first_try=attempt == 0)
+        # Prefer the rate the tool measured (pure write time) over wall-clock time
+        if tracker.measured:
+            THROUGHPUT.record(probe, sum(b for b, _ in tracker.measured), sum(t for _, t in tracker.measured), tracker.tool)
+        else:
+            THROUGHPUT.record(probe, image_bytes, elapsed, tracker.tool)
+        log(f"Throughput: {kbps:.1f} KB/s @ {khz} kHz ({image_bytes} bytes in {elapsed:.1f}s) | 刷写速率", "info", session_id=session_id)
+        return {"speed_khz": khz, "kbps": round(kbps, 1), "seconds": round(elapsed, 2),
+                "tool_bps": round(tracker.rate()) if tracker.rate() else None}
+    ERRORS.inc(type="flash_timeout" if "Timeout" in str(last_error) else "flash_failed")
+    raise last_error
+
+# Helper to perform one flash attempt at a fixed SWD clock
+def flash_once(CHIP_CFG, patch_hex, debugger_type, flash_sd=False, timeout_val=None, probe_only=False, session_id=None, watcher=None, speed_khz=4000, progress=None, probe_serial=None):
+    # Every command names the job's probe; otherwise the tool opens whichever it finds first
+    snr = probe_select.nrfjprog_args(probe_serial)
     if debugger_type == '1': # J-Link
         nrfjprog_success = False
         
         # nrfjprog is not good for probing, skips directly to JLinkExe if probing
-        if not probe_only: 
+        if not probe_only and toolchain.has_tool("nrfjprog"): 
             try:
                 if flash_sd:
-                    run_command(["nrfjprog", "-f", CHIP_CFG['family'], "--program", os.path.join(PROJECT_ROOT, CHIP_CFG['sd_hex']), "--chiperase"], timeout=10)
-                s, o = run_command(["nrfjprog", "-f", CHIP_CFG['family'], "--program", patch_hex, "--sectorerase", "--verify"], timeout=10)
+                    run_command(["nrfjprog", "-f", CHIP_CFG['family']] + snr + ["--clockspeed", str(speed_khz), "--program", os.path.join(PROJECT_ROOT, CHIP_CFG['sd_hex']), "--chiperase"], timeout=10)
+                s, o = run_command(["nrfjprog", "-f", CHIP_CFG['family']] + snr + ["--clockspeed", str(speed_khz), "--program", patch_hex, "--sectorerase", "--verify"], timeout=10, progress=progress)
                 if s:
-                    run_command(["nrfjprog", "-f", CHIP_CFG['family'], "--reset"], timeout=5)
+                    run_command(["nrfjprog", "-f", CHIP_CFG['family']] + snr + ["--reset"], timeout=5)
                     nrfjprog_success = True
                     log("SUCCESS (nrfjprog) | 刷写成功", "success")
             except: pass
 
         if not nrfjprog_success:
+            if not toolchain.has_tool("JLinkExe"):
+                raise Exception("JLinkExe not found. Install SEGGER J-Link Software. | 未找到 JLinkExe")
             # JLinkExe Logic
-            jlink_script_path = os.path.join(PROJECT_ROOT, "flash_cmd_web.jlink")
+            # One command file per flash: several probes may be flashing at once
+            fd, jlink_script_path = tempfile.mkstemp(prefix="flash_cmd_web_", suffix=".jlink")
+            os.close(fd)
             jlink_device = ""
             if CHIP_CFG['family'] == 'nrf51': jlink_device = "nRF51822_xxAA"
             elif CHIP_CFG['name'] == 'nRF52832': jlink_device = "nRF52832_xxAA"
             elif CHIP_CFG['name'] == 'nRF52810': jlink_device = "nRF52810_xxAA"
                 
             with open(jlink_script_path, "w") as f:
-                f.write(f"device {jlink_device}\\n")
-                f.write("si SWD\\n")
-                f.write("speed 4000\\n")
-                f.write("connect\\n")
+                f.write(f"device {jlink_device}\n")
+                f.write("si SWD\n")
+                f.write(f"speed {speed_khz}\n")
+                f.write("connect\n")
                 if probe_only:
-                    f.write("exit\\n") # Just connect and exit
+                    f.write("exit\n") # Just connect and exit
                 else:
-                    f.write("r\\n")
-                    f.write("h\\n")
+                    f.write("r\n")
+                    f.write("h\n")
                     if flash_sd:
                         sd_full_path = os.path.join(PROJECT_ROOT, CHIP_CFG['sd_hex'])
                         if CHIP_CFG['family'] == 'nrf52':
-                            f.write("w4 4001e504 2\\n") # ERASE
-                            f.write("w4 4001e50c 1\\n") # ERASEALL
-                            f.write("sleep 100\\n")
-                            f.write("w4 4001e504 0\\n")
-                            f.write("r\\n")
+                            f.write("w4 4001e504 2\n") # ERASE
+                            f.write("w4 4001e50c 1\n") # ERASEALL
+                            f.write("sleep 100\n")
+                            f.write("w4 4001e504 0\n")
+                            f.write("r\n")
                         else:
-                            f.write("erase\\n")
-                        f.write(f"loadfile {sd_full_path}\\n")
-                        f.write("r\\n")
-                    f.write(f"loadfile {patch_hex}\\n")
-                    f.write("r\\n")
-                    f.write("g\\n")
-                    f.write("exit\\n")
+                            f.write("erase\n")
+                        f.write(f"loadfile {sd_full_path}\n")
+                        f.write("r\n")
+                    f.write(f"loadfile {patch_hex}\n")
+                    f.write("r\n")
+                    f.write("g\n")
+                    f.write("exit\n")
             
             # Use timeout if provided
             t_jlink = timeout_val if timeout_val else 60
-            success, output = run_command(["JLinkExe", "-CommandFile", jlink_script_path], timeout=t_jlink)
+            success, output = run_command(["JLinkExe"] + probe_select.jlink_args(probe_serial) + ["-CommandFile", jlink_script_path], timeout=t_jlink, progress=progress)
             if os.path.exists(jlink_script_path): os.remove(jlink_script_path)
             
             if not success or "Cannot connect" in output or "FAILED" in output or "Could not connect" in output or "Failed to attach" in output or "Error occurred" in output:
@@ -266,6 +634,10 @@ def perform_flash(CHIP_CFG, patch_hex, debugger_type, flash_sd=False, timeout_va
             
     else: # OpenOCD based debuggers (ST-Link, DAPLink, etc.)
         interface = get_openocd_interface(debugger_type)
+        if not toolchain.has_tool("openocd"):
+            raise Exception("OpenOCD not found. Install openocd first. | 未找到 OpenOCD")
+        if not toolchain.interface_available(debugger_type):
+            raise Exception(f"OpenOCD interface config not found: {interface} | 未找到调试器配置")
         flash_family = CHIP_CFG['family']
         o_cmds = []
         if probe_only:
@@ -284,212 +656,167 @@ def perform_flash(CHIP_CFG, patch_hex, debugger_type, flash_sd=False, timeout_va
         
         # Logger for OpenOCD
         logger = lambda m, l: log(m, l, session_id=session_id) if session_id else None
-        success, output = run_command(["openocd", "-f", interface_cfg, "-f", CHIP_CFG['openocd_target'], "-c", "; ".join(o_cmds)], timeout=t_st, log_func=logger)
+        if watcher and watcher.persistent and not probe_only:
+            # Autoflash: reuse the already-open OpenOCD session (no process spawn)
+            session_cmds = [f"adapter speed {speed_khz}"] + [c for c in o_cmds if c not in ("init", "reset; exit")] + ["reset run"]
+            success, output = run_session_commands(watcher, session_cmds, timeout=t_st, log_func=logger, progress=progress)
+        else:
+            success, output = run_command(["openocd", "-f", interface_cfg] + probe_select.openocd_args(probe_serial) + ["-f", CHIP_CFG['openocd_target'], "-c", f"adapter speed {speed_khz}", "-c", "; ".join(o_cmds)], timeout=t_st, log_func=logger, progress=progress)
         if not success: raise Exception(f"OpenOCD ({interface}): {output}")
         if not probe_only:
             log("Flash programming complete. | 刷写成功 (Flashing Success)", "success", session_id=session_id)
             log(f"SUCCESS (OpenOCD/{interface})", "success", session_id=session_id)
 
+# --- Chip Identification Cache ---
+# (debugger_type, probe_serial) -> chip_ident result; dropped when a disconnect is observed
+CHIP_ID_CACHE = {}
+CHIP_ID_LOCK = threading.Lock()
+CHIP_ID_MAX_AGE = 60  # seconds; safety net for board swaps nobody observed
+CHIP_ID_BUDGET = 6.0  # latency budget for one identification session
+
+def invalidate_chip_cache(debugger_type=None, probe_serial=None):
+    """Forget cached identities (all, or for one probe) after a disconnect"""
+    with CHIP_ID_LOCK:
+        if debugger_type is None:
+            CHIP_ID_CACHE.clear()
+        else:
+            CHIP_ID_CACHE.pop((str(debugger_type), probe_serial or 'default'), None)
+
+def identify_chip(debugger_type, chip_cfg, probe_serial=None, use_cache=True):
+    """Read INFO.PART / DEVICEID / APPROTECT in one probe session (cached per probe)"""
+    key = (str(debugger_type), probe_serial or 'default')
+    if use_cache:
+        with CHIP_ID_LOCK:
+            cached = CHIP_ID_CACHE.get(key)
+        if cached and time.monotonic() - cached["_at"] < CHIP_ID_MAX_AGE:
+            return dict(cached, cached=True)
+
+    speed = get_swd_speed_ladder(probe_speed_key(debugger_type, chip_cfg, probe_serial), explore=False)[0]
+    lock = probe_lock(debugger_type, probe_serial)
+    if not lock.acquire(timeout=CHIP_ID_BUDGET):
+        return {"ok": False, "error_type": "probe_busy", "backend": None, "elapsed_ms": None, "cached": False,
+                "error": "调试器正被其他任务占用，请稍后重试。", "part": None, "name": None, "family": None,
+                "device_id": None, "approtect": None}
+    try:
+        result = chip_ident.identify(debugger_type, run_command,
+                                     interface_cfg=get_openocd_interface(debugger_type),
+                                     target_cfg=chip_cfg.get('openocd_target', 'target/nrf52.cfg'),
+                                     budget=CHIP_ID_BUDGET, speed_khz=min(speed, 1000),
+                                     has_tool=toolchain.has_tool, probe_serial=probe_serial)
+    finally:
+        lock.release()
+    with CHIP_ID_LOCK:
+        if result["ok"]:
+            CHIP_ID_CACHE[key] = dict(result, _at=time.monotonic())
+        else:
+            CHIP_ID_CACHE.pop(key, None)
+    return dict(result, cached=False)
+
+def usb_probes(debugger_type=None):
+    """Attached probes from the background USB inventory (started on first use)"""
+    USB_INVENTORY.start()
+    return USB_INVENTORY.list(debugger_type)
+
+def on_usb_change(added, removed):
+    for p in added:
+        log(f"USB probe attached: {p['name']} (SN {p['serial'] or '?'})", "info")
+    for p in removed:
+        log(f"USB probe removed: {p['name']} (SN {p['serial'] or '?'})", "warning")
+        invalidate_chip_cache(p['debugger'], p['serial'])
+        invalidate_chip_cache(p['debugger'])
+
+USB_INVENTORY = usb_inventory.UsbInventory()
+USB_INVENTORY.on_change(on_usb_change)
+
+def detect_debugger_name(debugger_type, probe_serial=None):
+    """Human readable name of the selected debugger (or None if not attached)"""
+    for p in usb_probes(probe_select.inventory_type(debugger_type)):
+        if not probe_serial or p['serial'] == probe_serial:
+            return p['name']
+    return None
+
+def default_probe_serial(debugger_type):
+    """Serial of the first attached probe of this type (keys speed memory / chip cache)"""
+    probes = usb_probes(probe_select.inventory_type(debugger_type))
+    return probes[0]['serial'] if probes else None
+
+@TRACER.traced
+@PROFILER.profiled
 def check_hardware_connection(config, chip_cfg):
     """
     Check debugger and chip connection before starting compilation.
+    The debugger comes from the USB inventory; the chip from one probe session.
     Returns: (success, debugger_info, chip_info, error_type, error_msg)
-    error_type: None, 'debugger_missing', 'chip_disconnected', 'chip_protected'
+    error_type: None, 'debugger_missing', 'chip_disconnected', 'chip_protected', 'probe_busy'
     """
     debugger_type = config.get('debugger', '2')
-    chip_id = config.get('chip', '1')
-    debugger_info = None
-    chip_info = None
+    probe_serial = config.get('probe_serial') or default_probe_serial(debugger_type)
     
-    # Step 1: Check debugger
-    try:
-        cmd = "ioreg -p IOUSB -l"
-        output = subprocess.check_output(cmd, shell=True).decode('utf-8')
-        
-        # Respect user selection in detection logic
-        detected_info = None
-        
-        # Helper to check strings
-        has_jlink = "J-Link" in output
-        has_stlink = "STLink" in output or "ST-Link" in output or "STLINK" in output or "stlink" in output.lower()
-        has_dap = any(k in output for k in ["CMSIS-DAP", "DAPLink", "Mbed"])
-
-        if debugger_type == '1': # J-Link
-            if has_jlink:
-                detected_info = "Segger J-Link"
-                if "J-Link OB" in output: detected_info = "Segger J-Link OB"
-                elif "J-Link EDU" in output: detected_info = "Segger J-Link EDU"
-                elif "J-Link Plus" in output: detected_info = "Segger J-Link Plus"
-        
-        elif debugger_type == '3': # DAPLink
-             if has_dap:
-                 detected_info = "DAPLink (CMSIS-DAP)"
-             # Fallback: if user selected DAPLink but we only see ST-Link (some ST-Links can be DAP compliant? usually not)
-        
-        elif debugger_type == '2': # ST-Link
-            if has_stlink:
-                detected_info = "ST-Link V2"
-                if "STLINK-V3" in output or "V3" in output: detected_info = "ST-Link V3"
-
-        # General Fallback if selected not found but connection check is requested?
-        # Actually better to stick to what user selected. 
-        # But for 'debugger_info' which is just used for display logs, we can use what we found.
-        # However, finding ST-Link when User selected DAPLink is confusing.
-        
-        debugger_info = detected_info
-
-
-    except Exception as e:
-        log(f"Debugger pre-check (ioreg) failed: {e}. Proceeding to probe...", "warning")
+    # Step 1: debugger from the USB inventory (in memory, no scan)
+    debugger_info = detect_debugger_name(debugger_type, probe_serial)
     
+    # Step 2: chip identity in one probe session
+    chip = identify_chip(debugger_type, chip_cfg, probe_serial, use_cache=config.get('use_chip_cache', True))
     # If debugger info is still None, default to generic
     if not debugger_info:
         if debugger_type == '1': debugger_info = "J-Link (Probing...)"
         elif debugger_type == '3': debugger_info = "DAPLink (Probing...)"
         else: debugger_info = "ST-Link (Probing...)"
     
-    # Step 2: Check chip connection
-    chip_family = chip_cfg['family']
-    target_chip = chip_cfg['name']
-    
-    if debugger_type == '1':  # J-Link
-        # Use nrfjprog to probe chip - MUST actually read memory to verify connection
-        try:
-            # First try to read FICR.INFO.PART to identify the actual chip
-            # nRF51: 0x10000100, nRF52: 0x10000100
-            # Try nrf52 first since it's more common
-            detected_chip = None
-            detected_family = None
-            
-            for try_family in ['nrf52', 'nrf51']:
-                success, output = run_command([
-                    "nrfjprog", "-f", try_family, "--memrd", "0x10000100", "--n", "4"
-                ], timeout=8)
-                
-                # Check for actual success (not just return code, but valid output)
-                if output.strip() and "0x10000100:" in output:
-                    # Parse the chip ID from output
-                    # Format: "0x10000100: 00051822" or "0x10000100: 0x00052810"
-                    try:
-                        lines = output.strip().split('\n')
-                        for line in lines:
-                            if '0x10000100:' in line:
-                                # Get the hex value after the colon
-                                hex_part = line.split(':')[-1].strip().split()[0]
-                                # Remove 0x prefix if present
-                                if hex_part.startswith('0x'):
-                                    hex_part = hex_part[2:]
-                                part_id = int(hex_part, 16)
-                                
-                                # Identify chip by part ID
-                                if part_id == 0x51822:
-                                    detected_chip = "nRF51822"
-                                    detected_family = "nrf51"
-                                elif part_id == 0x52832:
-                                    detected_chip = "nRF52832"
-                                    detected_family = "nrf52"
-                                elif part_id == 0x52810:
-                                    detected_chip = "nRF52810"
-                                    detected_family = "nrf52"
-                                elif part_id == 0x52840:
-                                    detected_chip = "nRF52840"
-                                    detected_family = "nrf52"
-                                elif part_id == 0x52811:
-                                    detected_chip = "nRF52811"
-                                    detected_family = "nrf52"
-                                elif part_id == 0x52833:
-                                    detected_chip = "nRF52833"
-                                    detected_family = "nrf52"
-                                
-                                if detected_chip:
-                                    break
-                    except Exception as e:
-                        pass
-                    
-                    if detected_chip:
-                        break
-            
-            if detected_chip:
-                # Chip detected successfully - return it for auto-selection
-                return True, debugger_info, detected_chip, None, None
-            else:
-                # Couldn't identify chip, try basic memory read
-                success, output = run_command([
-                    "nrfjprog", "-f", chip_family, "--memrd", "0x10000000", "--n", "4"
-                ], timeout=8)
-                
-                if success:
-                    chip_info = target_chip
-                    return True, debugger_info, chip_info, None, None
-                    
-                # Memory read failed - analyze the error
-                output_lower = output.lower()
-                
-                # Check for read protection
-                if "approtect" in output_lower or "read protection" in output_lower or "protected" in output_lower:
-                    return False, debugger_info, None, 'chip_protected', "芯片已被保护（APPROTECT 启用）。执行 nrfjprog -f nrf51 --recover 可恢复。"
-                
-                # Check for no connection
-                return False, debugger_info, None, 'chip_disconnected', "无法识别芯片型号。请检查连线。"
-                
-        except Exception as e:
-            return False, debugger_info, None, 'chip_disconnected', f"芯片检测异常: {str(e)}"
-            
-    else:  # OpenOCD based debuggers (ST-Link, DAPLink, etc.)
-        interface = get_openocd_interface(debugger_type)
-        try:
-            # Quick OpenOCD test
-            target_file = chip_cfg.get('openocd_target', 'target/nrf51.cfg')
-            success, output = run_command([
-                "openocd", "-f", interface, "-f", target_file,
-                "-c", "init; targets; shutdown"
-            ], timeout=8)
-            
-            if success:
-                output_lower = output.lower()
-                # Match various success indicators from OpenOCD
-                if any(pattern in output_lower for pattern in [
-                    "target halted", "cortex-m", "cortex_m", "processor detected",
-                    "target state", "nrf51", "nrf52", "breakpoints"
-                ]):
-                    chip_info = target_chip
-                    return True, debugger_info, chip_info, None, None
-                elif "TAP" in output or "JTAG" in output:
-                    chip_info = target_chip
-                    return True, debugger_info, chip_info, None, None
-            
-            # Parse error messages
-            output_lower = output.lower()
-            if "protected" in output_lower or "locked" in output_lower:
-                return False, debugger_info, None, 'chip_protected', "芯片已被保护。请使用 mass erase 解锁。"
-            elif "no swd" in output_lower or "transport" in output_lower:
-                return False, debugger_info, None, 'chip_disconnected', "无法识别芯片 SWD 接口。"
-            
-            return False, debugger_info, None, 'chip_disconnected', f"OpenOCD Error: {output[:100]}..."
-            
-        except Exception as e:
-            return False, debugger_info, None, 'chip_disconnected', f"OpenOCD Check Failed: {str(e)}"
-
+    if not chip["ok"]:
+        return False, debugger_info, None, chip["error_type"], chip["error"]
     
-    return True, debugger_info, chip_info, None, None
-
-def generate_firmware(config, chip_cfg=None):
+    detail = f"{chip['name']} ({chip['part']}), DEVICEID {chip['device_id'] or '?'}, {chip['elapsed_ms']} ms"
+    if chip.get("cached"): detail += ", cached"
+    log(f"Chip identified: {detail} | 芯片识别完成", "info")
+    if chip["approtect"]:
+        # The memory read went through, so the port is open now; a locked port fails identification instead
+        log("Protection is enabled in UICR, debug port still open - continuing | UICR 已启用读保护（调试口当前可访问），继续刷写", "warning")
+    return True, debugger_info, chip["name"], None, None
+
+# Device names handed to builds still running (their key / seed files may not exist yet)
+RESERVED_NAMES = set()
+NAMES_LOCK = threading.Lock()
+
+def device_name_taken(name, output_dir):
+    """True if a build is using `name`, or seeds, keys, bundles or a pooled identity carry it already"""
+    if name in RESERVED_NAMES:
+        return True
+    paths = [os.path.join(PROJECT_ROOT, "seeds", name)]
+    for d in {output_dir, CONFIG_DIR}:
+        paths += [os.path.join(d, f"{name}{ext}") for ext in ("_keyfile", "_devices.json", "_bundle.zip")]
+    if any(os.path.exists(p) for p in paths):
+        return True
+    with IDENTITY_POOLS_LOCK:
+        pools = list(IDENTITY_POOLS.values())
+    return any(name in pool.names() for pool in pools)
+
+def reserve_device_name(base_name, output_dir):
+    """base_name + timestamp (+ counter), unused anywhere; reserved until release_device_name()"""
+    # Add timestamp for uniqueness (format: YYYYMMDD_HHMMSS)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    device_name = f"{base_name}_{timestamp}"
+    with NAMES_LOCK:
+        # Pool producers and parallel builds can start several images within one second
+        suffix = 2
+        while device_name_taken(device_name, output_dir):
+            device_name = f"{base_name}_{timestamp}_{suffix}"
+            suffix += 1
+        RESERVED_NAMES.add(device_name)
+    return device_name
+
+def release_device_name(device_name):
+    with NAMES_LOCK:
+        RESERVED_NAMES.discard(device_name)
+
+@TRACER.traced
+@PROFILER.profiled
+def generate_firmware(config, chip_cfg=None, output_dir=None):
     """
     Core logic to generate a patched firmware bundle.
+    output_dir overrides the session/config directory (used by the identity pool).
     Returns: (success, result_dict, error_msg)
     """
-    # --- 1. Name Generation (with timestamp for uniqueness) ---
-    prefix = config.get('prefix', 'DEV')
-    start_num = int(config.get('start_num', 1))
-    padding = int(config.get('padding', 2))
-    
-    # Generate base device name
-    base_name = f"{prefix}{start_num:0{padding}d}"
-    
-    # Add timestamp for uniqueness (format: YYYYMMDD_HHMMSS)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    device_name = f"{base_name}_{timestamp}"
-    
     # Get initial Chip Config
     if not chip_cfg:
         chip_id = config.get('chip', '1')
@@ -500,7 +827,11 @@ def generate_firmware(config, chip_cfg=None):
 
     # Determine Output Directory (Session Isolation)
     session_id = config.get('session_id')
-    if session_id:
+    pooled = bool(output_dir)  # pool images are catalogued once claimed by a session
+    if output_dir:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+    elif session_id:
         # Isolated Session Directory - CREATE but DON'T DELETE existing files!
         output_dir = os.path.join(SESSIONS_DIR, session_id)
         if not os.path.exists(output_dir):
@@ -509,6 +840,19 @@ def generate_firmware(config, chip_cfg=None):
         # Fallback to global config dir (legacy behavior)
         output_dir = CONFIG_DIR
 
+    missing_tools = [t for t in ("make", "arm-none-eabi-objcopy") if not toolchain.has_tool(t)]
+    if missing_tools:
+        return False, None, f"Build toolchain missing: {', '.join(missing_tools)} | 缺少编译工具"
+
+    # --- 1. Name Generation (with timestamp for uniqueness) ---
+    prefix = config.get('prefix', 'DEV')
+    start_num = int(config.get('start_num', 1))
+    padding = int(config.get('padding', 2))
+    
+    # Generate base device name
+    base_name = f"{prefix}{start_num:0{padding}d}"
+    device_name = reserve_device_name(base_name, output_dir)
+    
     files_to_zip = [] # List of (abis_path, arcname)
     
     try:
@@ -547,7 +891,8 @@ def generate_firmware(config, chip_cfg=None):
             # Use sys.executable for compatibility
             # Output keys to session directory
             cmd = [sys.executable, gen_script, "-s", seed_hex, "-n", "200", "-p", device_name, "-o", output_dir]
-            success, output = run_command(cmd)
+            with stage("keygen"):
+                success, output = run_command(cmd)
             
             if success:
                 json_file = os.path.join(output_dir, f"{device_name}_devices.json")
@@ -564,36 +909,35 @@ def generate_firmware(config, chip_cfg=None):
             
             if not os.path.exists(key_file_path):
                 log(f"Keyfile missing. Generating...", "warning", session_id=session_id)
-                # Auto-gen logic
-                temp_dir = os.path.join(PROJECT_ROOT, "temp_keys_web")
-                if not os.path.exists(temp_dir): os.makedirs(temp_dir)
-                gen_script = os.path.join(PROJECT_ROOT, "heystack-nrf5x/tools/generate_keys.py")
-                key_count = config.get('key_count', 200)
-                # Ensure output path ends with slash
-                out_dir = temp_dir if temp_dir.endswith(os.sep) else temp_dir + os.sep
-                cmd = [sys.executable, gen_script, "-n", str(key_count), "-p", device_name, "-o", out_dir]
-                log(f"Generator Command: {' '.join(cmd)}", "info", session_id=session_id)
-                success, output = run_command(cmd)
-                if success:
+                # Auto-gen logic: a private temp dir per build, concurrent builds share nothing
+                temp_dir = tempfile.mkdtemp(prefix="keys_web_")
+                try:
+                    gen_script = os.path.join(PROJECT_ROOT, "heystack-nrf5x/tools/generate_keys.py")
+                    key_count = config.get('key_count', 200)
+                    # Ensure output path ends with slash
+                    out_dir = temp_dir if temp_dir.endswith(os.sep) else temp_dir + os.sep
+                    cmd = [sys.executable, gen_script, "-n", str(key_count), "-p", device_name, "-o", out_dir]
+                    log(f"Generator Command: {' '.join(cmd)}", "info", session_id=session_id)
+                    with stage("keygen"):
+                        success, output = run_command(cmd)
+                    if not success:
+                        return False, None, f"Keygen failed: {output}"
                     # Verify file exists before moving
                     kf_path = os.path.join(temp_dir, f"{device_name}_keyfile")
                     js_path = os.path.join(temp_dir, f"{device_name}_devices.json")
-                    
-                    if os.path.exists(kf_path):
-                        shutil.move(kf_path, output_dir)
-                        if os.path.exists(js_path):
-                            shutil.move(js_path, output_dir)
-                        shutil.rmtree(temp_dir)
-                        
-                        # Update paths to new location
-                        key_file_path = os.path.join(output_dir, key_filename)
-                        json_file = os.path.join(output_dir, f"{device_name}_devices.json")
-                        
-                        log("Keyfile generated and prepared. | 密钥文件已就绪", "success", session_id=session_id)
-                    else:
+                    if not os.path.exists(kf_path):
                         return False, None, f"Generator reported success but {device_name}_keyfile not found in {temp_dir}"
-                else:
-                    return False, None, f"Keygen failed: {output}"
+                    shutil.move(kf_path, output_dir)
+                    if os.path.exists(js_path):
+                        shutil.move(js_path, output_dir)
+                finally:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                
+                # Update paths to new location
+                key_file_path = os.path.join(output_dir, key_filename)
+                json_file = os.path.join(output_dir, f"{device_name}_devices.json")
+                
+                log("Keyfile generated and prepared. | 密钥文件已就绪", "success", session_id=session_id)
             
             # Prepare Static Zip
             # Ensure json_file points to the session directory if it was moved or generated there
@@ -620,18 +964,28 @@ def generate_firmware(config, chip_cfg=None):
         # We must lock the build process because 'make' uses a shared _build directory.
         log("Waiting for build lock... | 等待编译队列...", "info", session_id=session_id)
         
-
-        
-        # Clean BEFORE acquiring lock to ensure fresh build (faster than inside lock)
-        run_command(["make", "-C", make_dir, "clean"], timeout=30)
-        
+        check_cancelled()
+        lock_wait = time.perf_counter()
         with BUILD_LOCK:
+            STAGE_SECONDS.observe(time.perf_counter() - lock_wait, stage="build_lock_wait")
+            check_cancelled()  # cancelled while queued for the lock
+            # Clean inside the lock: outside it would wipe _build under another job's make
+            with stage("make_clean"):
+                run_command(["make", "-C", make_dir, "clean"], timeout=30)
+            
             log(f"Compiling firmware for {chip_cfg['name']}... | 正在编译固件...", "info", session_id=session_id)
             
             # Helper for streaming logs with session_id
             build_logger = lambda msg, level: log(msg, level, session_id=session_id)
+            tracker = flash_progress.ProgressTracker("build", total_units=BUILD_UNITS.get(chip_cfg['build_name']),
+                                                     on_update=progress_publisher(session_id))
             
-            success, output = run_command(cmd, timeout=120, log_func=build_logger)
+            with stage("compile"):
+                success, output = run_command(cmd, timeout=120, log_func=build_logger, progress=tracker)
+            tracker.finish(ok=success)
+            check_cancelled()
+            if success and tracker.units:
+                BUILD_UNITS[chip_cfg['build_name']] = tracker.units
             
             if not success:
                 log(f"Compile Error: {output[:200]}", "error", session_id=session_id)
@@ -659,26 +1013,27 @@ def generate_firmware(config, chip_cfg=None):
         
         # Ensure bin validation (sometimes make doesn't produce bin, so we make it from hex)
         if not os.path.exists(orig_bin):
-             run_command(["arm-none-eabi-objcopy", "-I", "ihex", "-O", "binary", orig_hex, orig_bin])
-        
-        with open(orig_bin, "rb") as f: fw_data = bytearray(f.read())
+            with stage("objcopy"):
+                run_command(["arm-none-eabi-objcopy", "-I", "ihex", "-O", "binary", orig_hex, orig_bin])
         
-        if config['mode'] == '1':
-            offset = fw_data.find(b"LinkyTagDynamicSeedPlaceholder!!")
-            if offset == -1: return False, None, "Seed Placeholder not found"
-            with open(seed_bin_file, "rb") as f: seed_data = f.read()
-            fw_data[offset : offset+len(seed_data)] = seed_data
-        else:
-            offset = fw_data.find(b"OFFLINEFINDINGPUBLICKEYHERE!")
-            if offset == -1: return False, None, "Key Placeholder not found"
-            with open(key_file_path, "rb") as f: key_data = f.read()
-            real_key = key_data[1:]
-            fw_data[offset : offset+len(real_key)] = real_key
+        with stage("patch"):
+            with open(orig_bin, "rb") as f: fw_data = bytearray(f.read())
             
-        with open(patch_bin, "wb") as f: f.write(fw_data)
+            if config['mode'] == '1':
+                with open(seed_bin_file, "rb") as f: seed_data = f.read()
+                if firmware_image.patch_placeholder(fw_data, firmware_image.SEED_PLACEHOLDER, seed_data) == -1:
+                    return False, None, "Seed Placeholder not found"
+            else:
+                with open(key_file_path, "rb") as f: key_data = f.read()
+                real_key = key_data[1:]
+                if firmware_image.patch_placeholder(fw_data, firmware_image.KEY_PLACEHOLDER, real_key) == -1:
+                    return False, None, "Key Placeholder not found"
+                
+            with open(patch_bin, "wb") as f: f.write(fw_data)
         
         # Use dynamic offset
-        run_command(["arm-none-eabi-objcopy", "-I", "binary", "-O", "ihex", "--change-addresses", chip_cfg['offset'], patch_bin, patch_hex])
+        with stage("objcopy"):
+            run_command(["arm-none-eabi-objcopy", "-I", "binary", "-O", "ihex", "--change-addresses", chip_cfg['offset'], patch_bin, patch_hex])
         log("Binary patched. | 配置注入完成", "success", session_id=session_id)
 
         # --- 4. Final Bundle Packing (After Compilation) ---
@@ -697,18 +1052,8 @@ def generate_firmware(config, chip_cfg=None):
         if os.path.exists(sd_path):
             log("Merging SoftDevice + App for WebUSB...", "info", session_id=session_id)
             try:
-                with open(sd_path, 'r') as f_sd:
-                    sd_lines = f_sd.readlines()
-                with open(patch_hex, 'r') as f_app:
-                    app_lines = f_app.readlines()
-                
-                # Filter out EOF record from SoftDevice (Generic Intel HEX EOF is :00000001FF)
-                # But safer to just remove any record type 01 (:.. .. .. 01 ..)
-                sd_lines = [l for l in sd_lines if not l.strip().startswith(':00000001FF')]
-                
-                with open(full_hex, 'w') as f_out:
-                    f_out.writelines(sd_lines)
-                    f_out.writelines(app_lines)
+                with stage("sd_merge"):
+                    firmware_image.merge_hex(sd_path, patch_hex, full_hex)
                 
                 # Update result to point to FULL hex for the frontend to use
                 patch_hex = full_hex
@@ -811,10 +1156,11 @@ pause
         bundle_filename = f"{device_name}_bundle.zip"
         bundle_path = os.path.join(output_dir, bundle_filename)
         
-        with zipfile.ZipFile(bundle_path, 'w') as zf:
-            for file_path, arcname in files_to_zip:
-                if os.path.exists(file_path):
-                    zf.write(file_path, arcname)
+        with stage("zip"):
+            zip_stream.write_zip(bundle_path, [(arcname, file_path) for file_path, arcname in files_to_zip],
+                                 config.get('compression', BUNDLE_COMPRESSION))
+        if not pooled:
+            BUNDLES.add(bundle_path, session_id, chip_cfg['name'])
         
         log(f"Bundle created: {bundle_filename} | 资源包已打包", "info")
 
@@ -826,47 +1172,56 @@ pause
             "chip_cfg": chip_cfg
         }, None
 
+    except JobCancelled:
+        raise
     except Exception as e:
         return False, None, str(e)
+    finally:
+        release_device_name(device_name)
 
 @app.route('/api/flash', methods=['POST'])
 def api_flash():
-    if STATE["is_flashing"]:
-        return jsonify({"error": "Busy"}), 400
-    
     config = request.json
     if not config:
         return jsonify({"error": "Invalid JSON body"}), 400
     
     session_id = config.get('session_id')
-    STATE["is_flashing"] = True
-    set_session_state(session_id, "is_flashing", True)  # CRITICAL: Set session-level flag
-    STATE["log_history"] = [] # Clear logs
-    
-    # Run flashing in background thread
-    thread = threading.Thread(target=flash_task, args=(config,))
-    thread.daemon = True
-    thread.start()
+    if config.get('chip', '1') not in CHIP_MAP:
+        return jsonify({"error": f"Invalid Chip ID: {config.get('chip')}"}), 400
     
-    return jsonify({"success": True, "message": "Flash process started"})
+    # Queued, not refused: the scheduler starts it once the session and probe are free
+    config['probe_serial'], probe = resolve_job_probe(config.get('debugger', '2'), config.get('probe_serial'))
+    job = SCHEDULER.submit("flash", config, session_id=session_id, probe=probe,
+                           priority=config.get('priority', 0))
+    position = SCHEDULER.position(job)
+    if position and position > 1:
+        log(f"Flash job queued at position {position} | 任务已排队", "info", session_id=session_id)
+    return jsonify({"success": True, "message": "Flash job queued", "job_id": job.id, "position": position})
+
+def resolve_job_probe(debugger_type, probe_serial=None):
+    """
+    (probe serial the job's tools use, per-probe concurrency key): one job
+    drives a given probe at a time, and it is the probe the tools open.
+    """
+    return probe_select.resolve(usb_probes(probe_select.inventory_type(debugger_type)), debugger_type, probe_serial)
 
-def flash_task(config):
-    # Set session_id for this thread (propagates to log function automatically)
+def run_flash_job(job):
+    return flash_task(job.payload, job)
+
+@TRACER.traced
+@PROFILER.profiled
+def flash_task(config, job):
+    # log() picks the session up from the job thread (set by the scheduler)
     session_id = config.get('session_id')
-    threading.current_thread().session_id = session_id
 
-    # Logs are cleared in api_flash now to ensure fresh start
-    STATE["status_message"] = "Initializing..."
-    STATE["last_generated_file"] = None
+    set_status("Initializing...")
     
     # Get initial Chip Config (may be overridden by auto-detection)
     chip_id = config.get('chip', '1')
     CHIP_CFG = CHIP_MAP.get(chip_id)
     if not CHIP_CFG:
         log(f"Invalid Chip ID: {chip_id}", "error")
-        STATE["is_flashing"] = False
-        set_session_state(config.get('session_id'), "is_flashing", False)  # Also update session
-        return
+        raise JobFailed(f"Invalid Chip ID: {chip_id}")
 
     try:
         log("-" * 40, "info")
@@ -874,100 +1229,222 @@ def flash_task(config):
         log("-" * 40, "info")
         
         # --- 0. Hardware Pre-Check (BEFORE compiling!) ---
-        STATE["status_message"] = "Checking Hardware..."
+        set_status("Checking Hardware...")
         log("Checking debugger & chip connection... | 正在检测调试器与芯片连接...", "info")
         
-        hw_success, debugger_info, detected_chip, error_type, error_msg = check_hardware_connection(config, CHIP_CFG)
+        with stage("hardware_check"):
+            hw_success, debugger_info, detected_chip, error_type, error_msg = SCHEDULER.run_stage(job, "flash", check_hardware_connection, config, CHIP_CFG)
         
         if debugger_info:
             log(f"Debugger: {debugger_info} ✓ | 调试器已就绪", "success")
-            STATE["status_message"] = f"Debugger: {debugger_info}"
+            set_status(f"Debugger: {debugger_info}")
         
         if not hw_success:
+            ERRORS.inc(type=error_type or "hardware_check")
             if error_type == 'debugger_missing':
-                STATE["status_message"] = f"ERROR: Debugger Not Found"
+                set_status(f"ERROR: Debugger Not Found")
                 log(f"DEBUGGER ERROR: {error_msg}", "error")
             elif error_type == 'chip_disconnected':
-                STATE["status_message"] = f"ERROR: Chip Disconnected"
+                set_status(f"ERROR: Chip Disconnected")
                 log(f"CHIP ERROR: {error_msg}", "error")
             elif error_type == 'chip_protected':
-                STATE["status_message"] = f"ERROR: Chip Protected"
+                set_status(f"ERROR: Chip Protected")
                 log(f"PROTECTION ERROR: {error_msg}", "error")
             else:
-                STATE["status_message"] = f"ERROR: Hardware Check Failed"
+                set_status(f"ERROR: Hardware Check Failed")
                 log(f"HARDWARE ERROR: {error_msg}", "error")
-            
-            STATE["is_flashing"] = False
-            return
+            raise JobFailed(error_msg)
         
         # --- Auto-select chip config based on detected chip ---
         if detected_chip and detected_chip in CHIP_NAME_TO_KEY:
             auto_chip_id = CHIP_NAME_TO_KEY[detected_chip]
             CHIP_CFG = CHIP_MAP.get(auto_chip_id, CHIP_CFG)
         
-        STATE["status_message"] = f"Chip: {CHIP_CFG['name']}"
+        set_status(f"Chip: {CHIP_CFG['name']}")
         log(f"Chip: {CHIP_CFG['name']} ✓ | 芯片已就绪", "success")
         log("[感知系统] 硬件链路验证通过，正在启动智能构建流程... | [Sensing] Link verified. Starting smart build process...", "success")
         
-        # --- 1. Generate Firmware ---
-        STATE["status_message"] = "Generating Firmware..."
-        success, result, err = generate_firmware(config, CHIP_CFG)
-        if not success:
-            raise Exception(err)
-            
-        device_name = result["device_name"]
-        patch_hex = result["patch_hex"]
-        CHIP_CFG = result["chip_cfg"] # Update CHIP_CFG in case it was auto-detected
-        # STATE["current_device"] and STATE["last_generated_file"] removed for session isolation
-        
         autoflash = config.get('autoflash', False)
+        pool = None
+        result = {}
+        if autoflash and config.get('identity_pool', False):
+            # --- 1. Unique identity per board: images come from the pre-generated pool ---
+            pool = get_identity_pool(config, CHIP_CFG)
+            stats = pool.stats()
+            log(f"Identity pool: {stats['ready']} ready (low {stats['low']} / high {stats['high']}) | 身份池已就绪", "info")
+            patch_hex = None
+        else:
+            # --- 1. Generate Firmware ---
+            set_status("Generating Firmware...")
+            success, result, err = SCHEDULER.run_stage(job, "build", generate_firmware, config, CHIP_CFG)
+            if not success:
+                ERRORS.inc(type="build_failed")
+                raise Exception(err)
+                
+            device_name = result["device_name"]
+            patch_hex = result["patch_hex"]
+            CHIP_CFG = result["chip_cfg"] # Update CHIP_CFG in case it was auto-detected
+        
         if autoflash:
-            STATE["status_message"] = "Waiting for Device..."
+            set_status("Waiting for Device...")
             log("Waiting for connection...", "warning")
         else:
-            STATE["status_message"] = "Flashing..."
+            set_status("Flashing...")
             log("Flashing device...", "info")
 
-        # Loop for auto-flash or run once
-        while True:
-            if STATE["stop_signal"]: break
+        if autoflash:
+            # Event-driven production loop: flash on insertion, wait for removal
+            autoflash_loop(CHIP_CFG, patch_hex, config, session_id, pool=pool, job=job)
+        else:
+            # Perform the flash (single run)
+            flash_info = SCHEDULER.run_stage(job, "flash", perform_flash, CHIP_CFG, patch_hex, config['debugger'], config.get('flash_sd', False), probe_only=False, session_id=session_id, probe_serial=config.get('probe_serial'))
+            time.sleep(0.5)
             
-            try:
-                # Perform the flash
-                perform_flash(CHIP_CFG, patch_hex, config['debugger'], config.get('flash_sd', False), probe_only=False, session_id=session_id)
-                time.sleep(0.5)
-                
-                if autoflash:
-                    STATE["status_message"] = "Cycle Complete. Remove device."
-                    log("Cycle Done. Re-insert new device...", "info")
-                    time.sleep(3) # Debounce
-                else:
-                    STATE["status_message"] = "Success"
-                    # Set download URL for frontend
-                    bundle_file = result.get("bundle_file")
-                    if bundle_file:
-                        download_url = f"/api/session_download/{session_id}/{bundle_file}"
-                        set_session_state(session_id, "download_url", download_url)
-                        log(f"SUCCESS (OpenOCD/config/daplink.cfg) | 刷写成功！", "success", session_id=session_id)
-                        log(f"下载链接已就绪: {bundle_file}", "success", session_id=session_id)
-                    break # Single run done
-                    
-            except Exception as e:
-                # Wait and retry for autoflash if it's a connection error
-                if autoflash:
-                    time.sleep(1)
-                    continue
-                else:
-                    raise e
-
+            set_status("Success")
+            # Set download URL for frontend
+            bundle_file = result.get("bundle_file")
+            if bundle_file:
+                download_url = f"/api/session_download/{session_id}/{bundle_file}"
+                set_session_state(session_id, "download_url", download_url)
+                log(f"SUCCESS (OpenOCD/config/daplink.cfg) | 刷写成功！", "success", session_id=session_id)
+                log(f"下载链接已就绪: {bundle_file}", "success", session_id=session_id)
+            return {"device_name": result.get("device_name"), "bundle_file": bundle_file, "flash": flash_info}
+
+    except JobFailed:
+        raise
+    except JobCancelled:
+        log("Job cancelled. | 任务已取消", "warning")
+        set_status("Cancelled")
+        raise
     except Exception as e:
         log(f"ERROR: {str(e)}", "error")
-        STATE["status_message"] = "Error"
-    finally:
-        session_id = config.get('session_id')
-        STATE["is_flashing"] = False
-        set_session_state(session_id, "is_flashing", False)  # CRITICAL: Notify frontend
-        STATE["stop_signal"] = False
+        set_status("Error")
+        invalidate_chip_cache(config.get('debugger', '2'), config.get('probe_serial'))
+        raise
+
+
+def create_target_watcher(chip_cfg, debugger_type, probe_serial=None):
+    """Build a presence watcher; OpenOCD debuggers get a persistent probe session"""
+    if debugger_type == '1':  # J-Link: JLinkExe cannot hold a session, probe by connect/exit
+        def probe():
+            try:
+                perform_flash(chip_cfg, None, debugger_type, probe_only=True, timeout_val=3, probe_serial=probe_serial)
+                return True
+            except Exception:
+                return False
+        watcher = TargetWatcher(probe_func=probe)
+    else:
+        interface = get_openocd_interface(debugger_type)
+        def probe():
+            success, _ = run_command(["openocd", "-f", interface] + probe_select.openocd_args(probe_serial) +
+                                     ["-f", chip_cfg['openocd_target'], "-c", "init; exit"], timeout=3)
+            return success
+        select = probe_select.openocd_select(probe_serial)
+        watcher = TargetWatcher(interface, chip_cfg['openocd_target'], cwd=PROJECT_ROOT, probe_func=probe,
+                                extra_cmds=[select] if select else None)
+
+    if watcher.start():
+        log("Persistent probe session ready (fast insertion detection). | 探针常驻会话已就绪", "info")
+    else:
+        log("Persistent probe session unavailable, falling back to polling. | 无法建立常驻会话，改用轮询检测", "warning")
+    return watcher
+
+def record_cycle(session_id, cycle):
+    """Keep the latest autoflash cycle timings per session"""
+    stats = get_session_state(session_id, "cycle_stats", [])
+    stats.append(cycle)
+    set_session_state(session_id, "cycle_stats", stats[-100:])
+
+def get_identity_pool(config, chip_cfg):
+    """Return (and start) the identity pool for this chip + image config"""
+    pool_config = dict(config)
+    pool_config['chip'] = CHIP_NAME_TO_KEY.get(chip_cfg['name'], config.get('chip', '1'))
+    for k in ('session_id', 'autoflash', 'debugger', 'flash_sd'):
+        pool_config.pop(k, None)
+    key = pool_key(pool_config)
+    with IDENTITY_POOLS_LOCK:
+        pool = IDENTITY_POOLS.get(key)
+        if not pool:
+            produce = lambda cfg, out_dir: generate_firmware(cfg, CHIP_MAP[cfg['chip']], output_dir=out_dir)
+            pool = IdentityPool(os.path.join(POOL_DIR, key), pool_config, produce,
+                                low=config.get('pool_low', 2), high=config.get('pool_high', 5), log_func=log)
+            IDENTITY_POOLS[key] = pool
+    pool.start()
+    return pool
+
+def next_pool_image(pool, chip_cfg, config):
+    """Pop a fresh identity; generate inline only if the pool has run dry"""
+    entry = pool.pop()
+    if entry:
+        return entry
+    log("Identity pool empty, generating inline... | 身份池已空，正在即时生成", "warning")
+    success, result, err = generate_firmware(pool.config, chip_cfg, output_dir=os.path.join(pool.pool_dir, "inline_" + datetime.now().strftime('%Y%m%d_%H%M%S_%f')))
+    if not success:
+        raise Exception(err)
+    return dict(result, dir=os.path.dirname(result["bundle_path"]))
+
+def autoflash_loop(chip_cfg, patch_hex, config, session_id, pool=None, job=None):
+    """Flash every board as soon as it is clamped; wait for removal between cycles (until the job is cancelled)"""
+    should_stop = lambda: job is not None and job.cancelled
+    # The watcher's session holds the probe for the whole production run
+    with probe_lock(config['debugger'], config.get('probe_serial')):
+        watcher = create_target_watcher(chip_cfg, config['debugger'], config.get('probe_serial'))
+        cycle_no = 0
+        idle_since = time.monotonic()
+        try:
+            while not should_stop():
+                set_status("Waiting for Device...")
+                if not watcher.wait_for_insertion(should_stop):
+                    break
+                t_detect = time.monotonic()
+                cycle_no += 1
+                set_status("Flashing...")
+                log(f"Device #{cycle_no} detected. Flashing... | 检测到设备，开始刷写", "info")
+            
+                entry = None
+                flash_info = None
+                t_flash = time.monotonic()
+                try:
+                    if pool:
+                        entry = next_pool_image(pool, chip_cfg, config)
+                        patch_hex = entry["patch_hex"]
+                        t_flash = time.monotonic()
+                        log(f"Identity: {entry['device_name']} | 分配设备身份", "accent")
+                    flash_info = perform_flash(chip_cfg, patch_hex, config['debugger'], config.get('flash_sd', False), probe_only=False, session_id=session_id, watcher=watcher, probe_serial=config.get('probe_serial'))
+                    ok = True
+                except Exception as e:
+                    ok = False
+                    log(f"Cycle #{cycle_no} failed: {e} | 本次刷写失败，请重新放置设备", "warning")
+                t_done = time.monotonic()
+            
+                if entry:
+                    # Identities are never reused, even if the flash failed part-way
+                    bundle_path = pool.claim(entry, os.path.join(SESSIONS_DIR, session_id) if session_id else CONFIG_DIR)
+                    BUNDLES.add(bundle_path, session_id, chip_cfg['name'])
+                    if ok and session_id:
+                        set_session_state(session_id, "download_url", f"/api/session_download/{session_id}/{os.path.basename(bundle_path)}")
+            
+                record_cycle(session_id, {
+                    "cycle": cycle_no,
+                    "success": ok,
+                    "idle_s": round(t_detect - idle_since, 3),
+                    "detect_to_flash_ms": round((t_flash - t_detect) * 1000, 1),
+                    "flash_s": round(t_done - t_flash, 3),
+                    "speed_khz": flash_info["speed_khz"] if flash_info else None,
+                    "kbps": flash_info["kbps"] if flash_info else None,
+                })
+                if not ok:
+                    invalidate_chip_cache(config['debugger'], config.get('probe_serial'))
+                if ok:
+                    set_status("Cycle Complete. Remove device.")
+                    log(f"Cycle #{cycle_no} done in {t_done - t_detect:.2f}s. Remove device... | 请取下设备", "info")
+            
+                # Wait until the board is unclamped before arming the next cycle
+                watcher.wait_for_removal(should_stop)
+                invalidate_chip_cache(config['debugger'], config.get('probe_serial'))
+                idle_since = time.monotonic()
+        finally:
+            watcher.close()
 
 
 # --- Routes ---
@@ -977,37 +1454,339 @@ def home():
     return render_template('index.html')
 
 @app.route('/api/stop', methods=['POST'])
+@app.route('/api/flash/cancel', methods=['POST'])
 def api_stop():
-    STATE["stop_signal"] = True
-    return jsonify({"status": "stopping"})
+    """Cancel one job (job_id), every job of a session (session_id), or everything"""
+    data = request.get_json(silent=True) or {}
+    job_id = data.get('job_id') or request.args.get('job_id')
+    session_id = data.get('session_id') or request.args.get('session_id')
+    if job_id:
+        cancelled = int(SCHEDULER.cancel(job_id))
+    else:
+        cancelled = SCHEDULER.cancel_session(session_id)
+    return jsonify({"status": "stopping", "cancelled": cancelled})
+
+@app.route('/api/jobs')
+def api_jobs():
+    """Queued, running and recent jobs (optionally of one session / in given states)"""
+    session_id = request.args.get('session_id')
+    states = [s for s in request.args.get('state', '').split(',') if s] or None
+    jobs = SCHEDULER.list(session_id, states)
+    return jsonify({"jobs": [job_info(j) for j in jobs], "stats": SCHEDULER.stats()})
+
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    job = SCHEDULER.get(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job_info(job))
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_job_cancel(job_id):
+    if not SCHEDULER.get(job_id):
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify({"success": SCHEDULER.cancel(job_id)})
+
+@app.route('/api/jobs/<job_id>/trace')
+def api_job_trace(job_id):
+    """Span timeline of a job; ?format=otlp for OpenTelemetry JSON"""
+    try:
+        trace = TRACER.load(job_id)
+    except ValueError:
+        return jsonify({"error": "Invalid job id"}), 400
+    if not trace:
+        return jsonify({"error": "No trace for this job"}), 404
+    if request.args.get('format') == 'otlp':
+        return jsonify(tracing.to_otlp(trace))
+    return jsonify(trace)
+
+def job_info(job):
+    return dict(job.to_dict(), position=SCHEDULER.position(job))
 
 @app.route('/api/logs')
 def api_logs():
+    """Polling fallback for /api/stream"""
     session_id = request.args.get('session_id', 'global')
     start = int(request.args.get('start', 0))
     
-    session_logs = STATE["logs"].get(session_id, [])
-    new_logs = session_logs[start:]
-    
-    # Get session-specific is_flashing status
-    session_state = STATE["session_state"].get(session_id, {})
-    is_flashing = session_state.get("is_flashing", False)
-    
-    # Get session-specific download_url
-    download_url = session_state.get("download_url", None)
-    
-    return jsonify({
-        "logs": new_logs, 
-        "next_index": len(session_logs),
-        "status_message": STATE["status_message"],
-        "is_flashing": is_flashing,
-        "download_url": download_url
-    })
+    new_logs, next_index, missed = read_logs(session_id, start)
+    return jsonify(dict(session_status(session_id), logs=new_logs, next_index=next_index, missed=missed))
+
+def read_logs(session_id, start):
+    """Log entries with seq >= `start`, the cursor to resume from, and how many fell off the ring"""
+    if STORE:
+        return STORE.read_logs(session_id, start)
+    return get_log_ring(session_id).read(start)
+
+def session_status(session_id):
+    """Status fields pushed/polled alongside the logs"""
+    session_state = session_state_of(session_id)
+    if "status_message" not in session_state:
+        session_state = dict(session_state, status_message=get_session_state("global", "status_message", "Ready"))
+    return {
+        "status_message": session_state["status_message"],
+        "is_flashing": session_state.get("is_flashing", False),   # session-specific
+        "download_url": session_state.get("download_url", None),  # session-specific
+        "job": session_state.get("job"),
+        "progress": flash_progress.estimate(session_state.get("progress")),  # phase, percent, bytes_per_s, eta_s
+        "last_cycle": (session_state.get("cycle_stats") or [None])[-1]
+    }
+
+@app.route('/api/stream')
+def api_stream():
+    """
+    Server-Sent Events: pushes `log` and `status` events as they happen.
+    Resume with ?cursor=N or the Last-Event-ID header sent by EventSource on reconnect.
+    """
+    session_id = request.args.get('session_id', 'global')
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor', 0)
+    try:
+        cursor = int(cursor)
+    except ValueError:
+        cursor = 0
+
+    def sse(event, data, event_id=None):
+        head = f"id: {event_id}\n" if event_id is not None else ""
+        return f"{head}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def generate(cursor):
+        last_status = None
+        last_send = time.monotonic()
+        yield "retry: 2000\n\n"
+        while True:
+            seen_version = STATE_VERSION
+            entries, next_index, missed = read_logs(session_id, cursor)
+            if entries or missed:
+                cursor = next_index
+                yield sse("log", {"logs": entries, "next_index": cursor, "missed": missed}, event_id=cursor)
+                last_send = time.monotonic()
+            status = session_status(session_id)
+            if status != last_status:
+                last_status = status
+                yield sse("status", status, event_id=cursor)
+                last_send = time.monotonic()
+            if time.monotonic() - last_send > 15:
+                yield ": keep-alive\n\n"  # keeps proxies from closing idle streams
+                last_send = time.monotonic()
+            with STATE_CHANGED:
+                if STATE_VERSION == seen_version:
+                    STATE_CHANGED.wait(1.0)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(generate(cursor), mimetype="text/event-stream", headers=headers)
+
+@app.route('/api/stats/throughput')
+def api_stats_throughput():
+    """Measured flash throughput per probe (bytes/s: last, min, max, average)"""
+    return jsonify(THROUGHPUT.snapshot())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Stage durations, error counters and queue gauges (Prometheus text format)"""
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/api/stats/memory')
+def api_stats_memory():
+    """Log buffer / session memory usage (of the shared store in production mode)"""
+    rings = list(STATE["logs"].values())
+    stats = {
+        "sessions": len(rings),
+        "session_states": len(STATE["session_state"]),
+        "log_entries": sum(len(r) for r in rings),
+        "log_bytes_approx": sum(r.approx_bytes() for r in rings),
+        "dropped_entries": sum(r.dropped for r in rings),
+        "evicted_sessions": STATE["evicted_sessions"],
+        "ring_capacity": LOG_RING_CAPACITY,
+        "session_ttl_s": SESSION_TTL,
+        "rss_bytes": process_rss_bytes(),
+        "log_writer": LOG_WRITER.stats(),
+        "state_store": STORE.stats() if STORE else None
+    }
+    if STORE:
+        # Sessions and logs live in the store; the in-process rings stay empty
+        store = stats["state_store"]
+        stats.update(sessions=store["sessions"], session_states=store["sessions"],
+                     log_entries=store["log_entries"], log_bytes_approx=store["bytes"])
+    return jsonify(stats)
+
+# --- Admin: profiling and memory snapshots ---
+def admin_token():
+    try:
+        with open(ADMIN_TOKEN_FILE, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+PROXY_HEADERS = ("X-Forwarded-For", "X-Real-IP", "Forwarded")
+
+def admin_required(view):
+    """Hidden (404) unless ADMIN_TOKEN_FILE exists; 403 without the token, from another machine or through a proxy"""
+    @functools.wraps(view)
+    def check(*args, **kwargs):
+        token = admin_token()
+        if not token:
+            abort(404)
+        if ADMIN_LOCAL_ONLY and (request.remote_addr not in ("127.0.0.1", "::1")
+                                 or any(h in request.headers for h in PROXY_HEADERS)):
+            # Behind a local reverse proxy every request arrives from 127.0.0.1,
+            # so a forwarded request cannot be told apart from a remote one
+            return jsonify({"error": "Admin endpoints are local only"}), 403
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+            return jsonify({"error": "Invalid admin token"}), 403
+        return view(*args, **kwargs)
+    return check
+
+@app.before_request
+def profile_request():
+    """Profile the request if its endpoint or URL rule is a profiling target"""
+    rule = request.url_rule.rule if request.url_rule else None
+    if PROFILER.wants(request.endpoint) or PROFILER.wants(rule):
+        g.profile = PROFILER.begin(f"{request.method} {rule}")
+
+@app.teardown_request
+def finish_request_profile(error=None):
+    PROFILER.finish(g.pop("profile", None), error)
+
+@app.route('/api/admin/profiling', methods=['GET', 'POST'])
+@admin_required
+def api_admin_profiling():
+    """
+    GET: switch state, running and recent profiles, stored files.
+    POST {"targets": ["flash_task", "generate_firmware", "/api/history"], "duration": 600, "interval_ms": 10}:
+    profile those functions / endpoints (name or URL rule) for `duration` seconds; no targets switches it off.
+    """
+    if request.method == 'POST':
+        config = request.json or {}
+        targets = config.get('targets') or []
+        if not isinstance(targets, list) or not all(isinstance(t, str) for t in targets):
+            return jsonify({"error": "targets must be a list of names"}), 400
+        try:
+            PROFILER.configure(targets, float(config.get('duration', 600)), float(config.get('interval_ms', 10)) / 1000)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        log(f"Profiling {', '.join(targets) or 'off'} | 性能剖析设置已更新", "info")
+    return jsonify(dict(PROFILER.status(), files=PROFILER.files()))
+
+@app.route('/api/admin/profiling/<name>')
+@admin_required
+def api_admin_profile_file(name):
+    """One stored profile (collapsed stacks, for flamegraph.pl / speedscope)"""
+    path = PROFILER.path(name)
+    if not path:
+        return jsonify({"error": "No such profile"}), 404
+    return send_from_directory(PROFILES_DIR, name, mimetype="text/plain", as_attachment=True)
+
+@app.route('/api/admin/memory', methods=['GET', 'POST'])
+@admin_required
+def api_admin_memory():
+    """
+    GET: tracemalloc state. POST {"action": "start", "frames": 25} starts tracing
+    with a baseline snapshot, "snapshot" takes a new baseline, "stop" ends it.
+    """
+    if request.method == 'GET':
+        return jsonify(MEMORY.status())
+    config = request.json or {}
+    action = config.get('action')
+    try:
+        if action == 'start':
+            result = MEMORY.start(max(1, int(config.get('frames', 25))))
+        elif action == 'snapshot':
+            result = MEMORY.snapshot()
+        elif action == 'stop':
+            result = MEMORY.stop()
+        else:
+            return jsonify({"error": "action must be start, snapshot or stop"}), 400
+    except (RuntimeError, TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    log(f"tracemalloc {action} | 内存追踪: {action}", "info")
+    return jsonify(result)
+
+@app.route('/api/admin/memory/diff')
+@admin_required
+def api_admin_memory_diff():
+    """Allocations grown since the baseline: ?group_by=lineno|filename|traceback&limit=25&reset=1"""
+    group_by = request.args.get('group_by', 'lineno')
+    if group_by not in ('lineno', 'filename', 'traceback'):
+        return jsonify({"error": "group_by must be lineno, filename or traceback"}), 400
+    try:
+        limit = int(request.args.get('limit', 25))
+        return jsonify(MEMORY.diff(group_by, limit, request.args.get('reset') == '1'))
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+@app.route('/api/chip_id')
+def api_chip_id():
+    """Identify the attached chip (cached per probe until a disconnect is seen)"""
+    debugger = request.args.get('debugger', '2')
+    chip_cfg = CHIP_MAP.get(request.args.get('chip', '2'), CHIP_MAP['2'])
+    fresh = request.args.get('refresh', 'false').lower() == 'true'
+    return jsonify(identify_chip(debugger, chip_cfg, request.args.get('probe_serial'), use_cache=not fresh))
+
+@app.route('/api/toolchain')
+def api_toolchain():
+    """Cached toolchain capability scan"""
+    return jsonify(toolchain.snapshot())
+
+@app.route('/api/toolchain/refresh', methods=['POST'])
+def api_toolchain_refresh():
+    """Re-run the capability scan now (e.g. after installing a tool)"""
+    return jsonify(toolchain.scan(OPENOCD_INTERFACES, PROJECT_ROOT))
+
+@app.route('/api/probe_speeds')
+def api_probe_speeds():
+    """Best known SWD clock and throughput per probe/target"""
+    return jsonify(PROBE_SPEEDS)
+
+@app.route('/api/identity_pool')
+def api_identity_pool():
+    """Status of all pre-generated identity pools"""
+    return jsonify({key: pool.stats() for key, pool in IDENTITY_POOLS.items()})
+
+ETAG_CACHE = {}  # path -> (size, mtime_ns, etag)
+ETAG_LOCK = threading.Lock()
+
+def file_etag(path):
+    """Content hash of a file, recomputed only when its size or mtime changes"""
+    st = os.stat(path)
+    with ETAG_LOCK:
+        cached = ETAG_CACHE.get(path)
+    if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+        return cached[2]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    etag = h.hexdigest()[:32]
+    with ETAG_LOCK:
+        ETAG_CACHE[path] = (st.st_size, st.st_mtime_ns, etag)
+    return etag
+
+def send_download(directory, filename):
+    """
+    Send a file as an attachment with a content-hash ETag. send_file answers
+    If-None-Match with 304 and Range with 206, and hands the body to the
+    server's file_wrapper (sendfile under gunicorn); with DOWNLOAD_OFFLOAD
+    the proxy sends the bytes instead.
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    etag = file_etag(path)
+    if DOWNLOAD_OFFLOAD != "x-accel":
+        return send_from_directory(directory, filename, as_attachment=True, etag=etag)
+    rv = Response(mimetype='application/octet-stream')
+    rv.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX + quote(os.path.relpath(path, PROJECT_ROOT))
+    rv.headers['Content-Disposition'] = f"attachment; filename={os.path.basename(path)}"
+    rv.cache_control.no_cache = True
+    rv.set_etag(etag)
+    return rv.make_conditional(request)
 
 @app.route('/api/download/<path:filename>')
 def api_download(filename):
     """Serve global config files"""
-    return send_from_directory(CONFIG_DIR, filename, as_attachment=True)
+    return send_download(CONFIG_DIR, filename)
 
 @app.route('/api/session_download/<session_id>/<path:filename>')
 def api_session_download(session_id, filename):
@@ -1016,79 +1795,66 @@ def api_session_download(session_id, filename):
     if not session_id.isalnum(): return "Invalid session ID", 400
     
     session_dir = os.path.join(SESSIONS_DIR, session_id)
-    return send_from_directory(session_dir, filename, as_attachment=True)
+    if filename.endswith("_bundle.zip"):
+        BUNDLES.touch('session', session_id, filename)  # most recently used: evicted last
+    return send_download(session_dir, filename)
+
+@app.route('/api/storage')
+def api_storage():
+    """Disk usage of user_sessions/, quotas and the last GC report"""
+    return jsonify(STORAGE.usage())
+
+@app.route('/api/storage/gc', methods=['POST'])
+def api_storage_gc():
+    """Run the storage collector now; returns the bytes reclaimed"""
+    return jsonify(STORAGE.collect())
 
 @app.route('/api/history')
 def api_history():
-    """List generated device bundles - session-isolated by default, global if requested"""
+    """
+    List generated device bundles from the catalog - session-isolated by default, global if requested.
+    Filters: prefix, chip (id or name), since / until (YYYY-MM-DD or unix time).
+    Paginated: limit (default 100) and cursor (the `next` token of the previous page).
+    """
     session_id = request.args.get('session_id')  # Get session_id from query params
     show_all = request.args.get('show_all', 'false').lower() == 'true'  # Optional: show all files
+    if not show_all and not session_id:
+        return jsonify({"files": [], "next": None, "total": 0})
     
-    files = []
+    chip = request.args.get('chip')
+    if chip in CHIP_MAP:
+        chip = CHIP_MAP[chip]['name']
     try:
-        if show_all:
-            # Global mode: show all files (legacy behavior)
-            # 1. Scan global CONFIG_DIR for legacy bundles
-            pattern = os.path.join(CONFIG_DIR, "*_bundle.zip")
-            for fpath in glob.glob(pattern):
-                fname = os.path.basename(fpath)
-                name = fname.replace("_bundle.zip", "")
-                ts = os.path.getmtime(fpath)
-                time_str = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
-                files.append({
-                    "name": name,
-                    "filename": fname,
-                    "time": time_str,
-                    "ts": ts,
-                    "source": "global"
-                })
-            
-            # 2. Scan all session directories
-            if os.path.exists(SESSIONS_DIR):
-                for sid in os.listdir(SESSIONS_DIR):
-                    session_path = os.path.join(SESSIONS_DIR, sid)
-                    if not os.path.isdir(session_path):
-                        continue
-                    
-                    session_pattern = os.path.join(session_path, "*_bundle.zip")
-                    for fpath in glob.glob(session_pattern):
-                        fname = os.path.basename(fpath)
-                        name = fname.replace("_bundle.zip", "")
-                        ts = os.path.getmtime(fpath)
-                        time_str = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
-                        files.append({
-                            "name": name,
-                            "filename": fname,
-                            "time": time_str,
-                            "ts": ts,
-                            "source": "session",
-                            "session_id": sid
-                        })
-        else:
-            # Session-isolated mode: show only this session's files
-            if session_id and os.path.exists(SESSIONS_DIR):
-                session_path = os.path.join(SESSIONS_DIR, session_id)
-                if os.path.isdir(session_path):
-                    session_pattern = os.path.join(session_path, "*_bundle.zip")
-                    for fpath in glob.glob(session_pattern):
-                        fname = os.path.basename(fpath)
-                        name = fname.replace("_bundle.zip", "")
-                        ts = os.path.getmtime(fpath)
-                        time_str = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
-                        files.append({
-                            "name": name,
-                            "filename": fname,
-                            "time": time_str,
-                            "ts": ts,
-                            "source": "session",
-                            "session_id": session_id
-                        })
-        
-        # Sort by latest first
-        files.sort(key=lambda x: x['ts'], reverse=True)
-    except Exception as e:
-        log(f"History fetch error: {e}", "error")
-    return jsonify({"files": files})
+        files, next_token, total = BUNDLES.query(
+            session_id=None if show_all else session_id,
+            prefix=request.args.get('prefix') or None,
+            chip=chip or None,
+            since=parse_history_date(request.args.get('since')),
+            until=parse_history_date(request.args.get('until'), end_of_day=True),
+            limit=request.args.get('limit', 100),
+            cursor=request.args.get('cursor') or None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"files": files, "next": next_token, "total": total})
+
+def parse_history_date(value, end_of_day=False):
+    """YYYY-MM-DD (local time) or unix seconds -> timestamp; a bare `until` date includes that day"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}")
+    return day.timestamp() + (86400 if end_of_day else 0)
+
+@app.route('/api/history/reindex', methods=['POST'])
+def api_history_reindex():
+    """Rescan bundle directories (e.g. after files were copied in or removed by hand)"""
+    return jsonify({"success": True, "bundles": BUNDLES.rebuild()})
 
 @app.route('/api/history/delete', methods=['POST'])
 def api_delete_history():
@@ -1126,6 +1892,7 @@ def api_delete_history():
                 deleted.append(fname)
             else:
                 errors.append(f"Not found: {fname}")
+            BUNDLES.remove('session' if source == 'session' and session_id else 'global', session_id, fname)
         except Exception as e:
             errors.append(f"Error {fname}: {str(e)}")
             
@@ -1133,27 +1900,64 @@ def api_delete_history():
 
 @app.route('/api/history/archive', methods=['POST'])
 def api_archive_history():
-    """Zip multiple selected bundles into one"""
-    data = request.json
-    filenames = data.get('filenames', [])
-    if not filenames:
+    """
+    Prepare a batch download of the selected bundles. Nothing is zipped here:
+    the selection is saved and the returned download_url streams the archive.
+    """
+    data = request.json or {}
+    files = data.get('files') or data.get('filenames', [])  # dicts with source/session_id, or bare global names
+    selection = []
+    for file_info in files:
+        if isinstance(file_info, str):
+            file_info = {"filename": file_info}
+        fname = file_info.get('filename') or ''
+        session_id = file_info.get('session_id')
+        if os.sep in fname or '..' in fname or not fname.endswith('_bundle.zip'):
+            return jsonify({"error": f"Invalid file: {fname}"}), 400
+        if file_info.get('source') == 'session' and session_id:
+            if not session_id.isalnum():
+                return jsonify({"error": "Invalid session ID"}), 400
+            selection.append({"filename": fname, "source": "session", "session_id": session_id})
+        else:
+            selection.append({"filename": fname, "source": "global"})
+    if not selection:
         return jsonify({"error": "No files selected"}), 400
-        
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    archive_name = f"Batch_Keys_{timestamp}.zip"
-    archive_path = os.path.join(CONFIG_DIR, archive_name)
-    
+    compression = data.get('compression', ARCHIVE_COMPRESSION)
     try:
-        with zipfile.ZipFile(archive_path, 'w') as zf:
-            for fname in filenames:
-                fpath = os.path.join(CONFIG_DIR, fname)
-                if os.path.exists(fpath):
-                    # Store as flat file inside zip
-                    zf.write(fpath, fname) 
-        
-        return jsonify({"success": True, "download_url": f"/download/{archive_name}"})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        zip_stream.compression_method(compression)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    token = BUNDLES.save_archive(selection)
+    return jsonify({"success": True, "download_url": f"/api/history/archive/{token}?compression={compression}"})
+
+@app.route('/api/history/archive/<token>')
+def api_archive_download(token):
+    """Stream a prepared batch archive straight into the response (no temporary file)"""
+    selection = BUNDLES.archive(token)
+    if selection is None:
+        return "Archive link expired | 下载链接已过期", 404
+    compression = request.args.get('compression', ARCHIVE_COMPRESSION)
+    try:
+        zip_stream.compression_method(compression)
+    except ValueError as e:
+        return str(e), 400
+
+    members, seen = [], set()
+    for f in selection:
+        if f['source'] == 'session':
+            fpath = os.path.join(SESSIONS_DIR, f['session_id'], f['filename'])
+            BUNDLES.touch('session', f['session_id'], f['filename'])
+        else:
+            fpath = os.path.join(CONFIG_DIR, f['filename'])
+        # Same device name in two sessions: keep both, the second one in a sub folder
+        arcname = f['filename'] if f['filename'] not in seen else f"{f.get('session_id', 'global')}/{f['filename']}"
+        seen.add(f['filename'])
+        members.append((arcname, fpath))
+
+    archive_name = f"Batch_Keys_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return Response(zip_stream.stream_zip(members, compression), mimetype='application/zip',
+                    headers={"Content-Disposition": f"attachment; filename={archive_name}"})
 
 @app.route('/api/detect_debugger')
 def api_detect_debugger():
@@ -1164,49 +1968,24 @@ def api_detect_debugger():
     If Server is Cloud, it CANNOT check User's USB.
     So this endpoint is only relevant for LOCAL deployment.
     """
-    try:
-        # Check USB devices using system_profiler on macOS
-        cmd = "ioreg -p IOUSB -l"
-        output = subprocess.check_output(cmd, shell=True).decode('utf-8')
-        
-        # Tighten the check to avoid false positives from "Host", "System", etc.
-        # REMOVED "STM32" because some USB Hubs identify as "STM32 Virtual COM Port" but are NOT debuggers.
-        # ST-Link debuggers usually have "STLink" or "ST-Link" in their name.
-        # REMOVED .lower() check to avoid matching random system strings containing "stlink" (unlikely but possible).
-        is_st = "STLink" in output or "ST-Link" in output or "STLINK" in output
-        is_jlink = "J-Link" in output
-        is_dap = "CMSIS-DAP" in output or "DAPLink" in output or "Mbed" in output
-        
-        connected = is_st or is_jlink or is_dap
-        
-        available = []
-        if is_jlink: available.append('1')
-        if is_dap: available.append('3')
-        if is_st: available.append('2')
-
-        debugger_name = None
-        debugger_id = None
-        
-        # Priority Logic: J-Link > DAPLink > ST-Link
-        if is_jlink: 
-            debugger_name = "Segger J-Link"
-            debugger_id = '1'
-        elif is_dap:
-            debugger_name = "DAPLink (CMSIS-DAP)"
-            debugger_id = '3'
-        elif is_st: 
-            debugger_name = "ST-Link"
-            debugger_id = '2'
-            
-        return jsonify({
-            "detected": connected,
-            "connected": connected,
-            "debugger": debugger_id,
-            "name": debugger_name,
-            "available": available
-        })
-    except Exception as e:
-        return jsonify({"detected": False, "connected": False, "error": str(e)})
+    probes = usb_probes()
+    available = []
+    for p in probes:
+        if p['debugger'] not in available:
+            available.append(p['debugger'])
+    
+    # Priority Logic: J-Link > DAPLink > ST-Link (inventory is already sorted that way)
+    first = probes[0] if probes else None
+    inventory = USB_INVENTORY.snapshot()
+    return jsonify({
+        "detected": bool(probes),
+        "connected": bool(probes),
+        "debugger": first['debugger'] if first else None,
+        "name": first['name'] if first else None,
+        "available": available,
+        "probes": probes,
+        "error": inventory["error"]
+    })
 
 
 @app.route('/api/generate', methods=['POST'])
@@ -1214,12 +1993,39 @@ def api_generate():
     """
     Cloud Firmware Generation Endpoint.
     Compiles firmware and patches it, returns HEX content.
-    Does NOT flash.
+    Does NOT flash. The build runs as a queued job on the build worker pool.
     """
     config = request.json
     session_id = config.get('session_id')  # Get session_id from request
-    set_session_state(session_id, "is_flashing", True)  # Mark busy during build
+    if config.get('chip', '1') not in CHIP_MAP:
+        return jsonify({"success": False, "error": "Invalid Chip ID"}), 400
     
+    # requeue=False: after a restart nobody is waiting for the response any more
+    job = SCHEDULER.submit("generate", config, session_id=session_id, priority=config.get('priority', 0), requeue=False)
+    finished = SCHEDULER.wait(job, GENERATE_WAIT)
+    if not finished:
+        SCHEDULER.cancel(job.id)
+        return jsonify({"success": False, "error": "Build queue timeout", "job_id": job.id}), 504
+    job = finished
+    if job.state != "succeeded":
+        return jsonify({"success": False, "error": job.error or job.state, "job_id": job.id}), 500
+    
+    result = job.result
+    response = {
+        "success": True, 
+        "manifest": result.get("manifest"),  # for the bridge: block hashes, see /api/content/pack
+        "device_name": result["device_name"],
+        "bundle_url": result["bundle_url"],
+        "job_id": job.id
+    }
+    if config.get('hex', True):  # bridge-only clients can skip the full hex text
+        with open(result["patch_hex"], 'r') as f:
+            response["hex"] = f.read()
+    return jsonify(response)
+
+def run_generate_job(job):
+    config = job.payload
+    session_id = job.session_id
     try:
         # Get chip config
         chip_id = config.get('chip', '1')
@@ -1229,35 +2035,43 @@ def api_generate():
         log(f"[Cloud] Requesting firmware...", "accent")
         
         # 1. Generate & Compile
-        success, result, err = generate_firmware(config, CHIP_CFG)
+        success, result, err = SCHEDULER.run_stage(job, "build", generate_firmware, config, CHIP_CFG)
         if not success: raise Exception(err)
-        
-        # 2. Read HEX content
-        hex_file = result["patch_hex"]
-        with open(hex_file, 'r') as f:
-            hex_content = f.read()
             
         # Determine Download URL base
-        sess_id = config.get('session_id')
         filename = os.path.basename(result['bundle_file'])
         
-        if sess_id:
-            dl_url = f"/api/session_download/{sess_id}/{filename}"
+        if session_id:
+            dl_url = f"/api/session_download/{session_id}/{filename}"
         else:
             dl_url = f"/api/download/{filename}"
             
-        return jsonify({
-            "success": True, 
-            "hex": hex_content,
-            "device_name": result["device_name"],
-            "bundle_url": dl_url
-        })
+        with open(result["patch_hex"], 'r') as f:
+            manifest = CONTENT.put_image(f.read())
+        return {"device_name": result["device_name"], "patch_hex": result["patch_hex"], "bundle_url": dl_url,
+                "manifest": manifest}
         
+    except JobCancelled:
+        raise
     except Exception as e:
         log(f"[Cloud] Build Error: {str(e)}", "error")
-        return jsonify({"success": False, "error": str(e)}), 500
-    finally:
-        set_session_state(session_id, "is_flashing", False)
+        raise
+
+@app.route('/api/content/pack', methods=['POST'])
+def api_content_pack():
+    """
+    Compressed binary pack of firmware blocks by hash (content_store.pack), for
+    the browser to pass on to the bridge. Payload: { "hashes": [...] }
+    """
+    hashes = (request.json or {}).get('hashes', [])
+    try:
+        blocks = [(h, CONTENT.get(h)) for h in hashes]
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    unknown = [h for h, data in blocks if data is None]
+    if unknown:
+        return jsonify({"error": "Unknown blocks", "missing": unknown}), 404
+    return Response(content_store.pack(blocks), mimetype='application/octet-stream')
 
 @app.route('/api/flash_hex', methods=['POST'])
 def api_flash_hex():
@@ -1265,10 +2079,8 @@ def api_flash_hex():
     Accepts arbitrary HEX data to flash using local backend (OpenOCD/JLink).
     Design for 'Hybrid Mode': Cloud Generate -> Frontend -> Local Flash.
     Payload: { "hex": "...", "chip_name": "nRF51822", "debugger": "2" }
+    Returns a job_id to poll via /api/jobs/<id>.
     """
-    if STATE["is_flashing"]:
-        return jsonify({"error": "Already flashing"}), 400
-        
     data = request.json
     hex_content = data.get('hex')
     chip_name = data.get('chip_name', 'nRF52832') # Default to nRF52832
@@ -1276,6 +2088,22 @@ def api_flash_hex():
     
     if not hex_content: return jsonify({"error": "Missing hex content"}), 400
     
+    # Save temp hex (one file per job, kept until the job has run)
+    fd, tmp_hex = tempfile.mkstemp(suffix=".hex", dir=JOBS_DIR)
+    with os.fdopen(fd, "w") as f:
+        f.write(hex_content)
+    
+    probe_serial, probe = resolve_job_probe(debugger, data.get('probe_serial'))
+    payload = {"hex_path": tmp_hex, "chip_name": chip_name, "debugger": debugger, "probe_serial": probe_serial}
+    job = SCHEDULER.submit("flash_hex", payload, session_id=data.get('session_id'), probe=probe,
+                           priority=data.get('priority', 0))
+    return jsonify({"success": True, "job_id": job.id, "position": SCHEDULER.position(job)})
+
+def run_flash_hex_job(job):
+    payload = job.payload
+    chip_name = payload['chip_name']
+    tmp_hex = payload['hex_path']
+    
     # Resolve chip config
     target_chip = None
     for k, v in CHIP_MAP.items():
@@ -1286,29 +2114,52 @@ def api_flash_hex():
         log(f"Chip name '{chip_name}' not found, defaulting to nRF52832", "warning")
         target_chip = CHIP_MAP['2'] # Default to nRF52832 if not found
     
-    # Save temp hex
-    tmp_hex = os.path.join(PROJECT_ROOT, "temp_flash.hex")
-    with open(tmp_hex, "w") as f:
-        f.write(hex_content)
-        
-    def run_flash():
-        STATE["is_flashing"] = True
-        STATE["status_message"] = "Local Flashing..."
-        try:
-            log(f"Starting Local Flash for {chip_name}...", "info")
-            perform_flash(target_chip, tmp_hex, debugger, flash_sd=False, probe_only=False)
-            STATE["status_message"] = "Flash Complete"
-        except Exception as e:
-            log(f"Local Flash Error: {str(e)}", "error")
-            STATE["status_message"] = "Error"
-        finally:
-            STATE["is_flashing"] = False
-            if os.path.exists(tmp_hex): os.remove(tmp_hex)
-            
-    t = threading.Thread(target=run_flash)
-    t.start()
-    
-    return jsonify({"success": True})
+    set_status("Local Flashing...")
+    try:
+        log(f"Starting Local Flash for {chip_name}...", "info")
+        flash_info = SCHEDULER.run_stage(job, "flash", perform_flash, target_chip, tmp_hex, payload['debugger'], flash_sd=False, probe_only=False, session_id=job.session_id, probe_serial=payload.get('probe_serial'))
+        set_status("Flash Complete")
+        return flash_info
+    except JobCancelled:
+        set_status("Cancelled")
+        raise
+    except Exception as e:
+        log(f"Local Flash Error: {str(e)}", "error")
+        set_status("Error")
+        raise
+    finally:
+        if os.path.exists(tmp_hex): os.remove(tmp_hex)
+
+def on_job_change(job):
+    """Mirror the session's current job into its state (drives is_flashing in the UI)"""
+    sid = job.session_id
+    if not sid:
+        return
+    set_session_state(sid, "is_flashing", SCHEDULER.session_active(sid))
+    set_session_state(sid, "job", {"id": job.id, "kind": job.kind, "state": job.state, "stage": job.stage,
+                                   "position": SCHEDULER.position(job)})
+    if job.state == "cancelled" and not job.started:
+        set_status("Cancelled", sid)
+
+def discard_job_files(job):
+    """Queued flash_hex jobs cancelled before running still own their temp hex"""
+    if job.kind == "flash_hex" and job.state == "cancelled" and not job.started:
+        path = (job.payload or {}).get("hex_path")
+        if path and os.path.exists(path):
+            os.remove(path)
+
+def count_finished_job(job):
+    if job.state in FINAL_STATES:
+        JOBS_FINISHED.inc(kind=job.kind, state=job.state)
+
+SCHEDULER = JobScheduler({"flash": traced_job(run_flash_job), "flash_hex": traced_job(run_flash_hex_job),
+                          "generate": traced_job(run_generate_job)},
+                         persist_path=JOBS_FILE, max_running=MAX_RUNNING_JOBS,
+                         per_session=JOBS_PER_SESSION, per_probe=JOBS_PER_PROBE,
+                         stage_workers={"build": BUILD_WORKERS, "flash": FLASH_WORKERS}, log_func=log)
+SCHEDULER.on_change(on_job_change)
+SCHEDULER.on_change(discard_job_files)
+SCHEDULER.on_change(count_finished_job)
 
 
 
@@ -1317,23 +2168,97 @@ def api_clear_logs():
     """Clear logs for a session or global"""
     session_id = request.args.get('session_id')
     
-    if session_id:
+    # Sequence numbers keep counting, so client cursors stay valid
+    if STORE:
+        STORE.clear_logs(session_id or "global")
+    elif session_id:
         if session_id in STATE["logs"]:
-            STATE["logs"][session_id] = []
+            STATE["logs"][session_id].clear()
     else:
-        STATE["logs"]["global"] = []
-        
-    STATE["status_message"] = "Ready"
+        get_log_ring("global").clear()
+    set_status("Ready", session_id or "global")
     return jsonify({"success": True})
 
 
+STORAGE = StorageManager(SESSIONS_DIR, session_quota=SESSION_QUOTA_BYTES, global_quota=STORAGE_QUOTA_BYTES,
+                         intermediate_ttl=INTERMEDIATE_TTL,
+                         is_busy=lambda sid: SCHEDULER.session_active(sid),
+                         last_used=BUNDLES.last_used,
+                         on_remove=lambda sid, fname: BUNDLES.remove('session', sid, fname),
+                         log_func=log)
+
+SERVICES_LOCK = file_lock.FileLock(os.path.join(LOCKS_DIR, "services.lock"))
+SERVICES_RETRY = 2  # seconds between takeover attempts of the other workers
+
+def use_state_store(path=STATE_DB):
+    """Keep sessions, logs and jobs in the shared SQLite store (multi-process serving)"""
+    global STORE
+    STORE = StateStore(path)
+    SCHEDULER.store = STORE
+    return STORE
+
+def start_background_services():
+    """Start the long-running helpers used by the web tool (single-process server)"""
+    toolchain.scan_async(OPENOCD_INTERFACES, PROJECT_ROOT)
+    start_dispatch_services()
+
+def start_worker_services():
+    """
+    Production worker: every worker serves requests and queues jobs in the
+    shared store, but only the one holding SERVICES_LOCK runs the job
+    dispatcher - and with it the identity pools, target watchers, per-probe
+    limits and SWD speed memory - plus the housekeeping loops. When that
+    worker exits, another one takes over.
+    """
+    toolchain.scan_async(OPENOCD_INTERFACES, PROJECT_ROOT)
+    def elect():
+        while not SERVICES_LOCK.acquire(blocking=False):
+            time.sleep(SERVICES_RETRY)
+        log(f"Worker {os.getpid()} runs the job dispatcher | 该工作进程负责任务调度", "info")
+        start_dispatch_services()
+    t = threading.Thread(target=elect, name="services-election")
+    t.daemon = True
+    t.start()
+
+def start_dispatch_services():
+    """Job dispatcher and housekeeping: run by exactly one process"""
+    USB_INVENTORY.start()
+    SCHEDULER.start()
+    if BUNDLES.is_empty():
+        # First start with the catalog: index the bundles already on disk
+        indexer = threading.Thread(target=BUNDLES.rebuild, name="bundle-indexer")
+        indexer.daemon = True
+        indexer.start()
+    evictor = threading.Thread(target=session_evictor_loop, name="session-evictor")
+    evictor.daemon = True
+    evictor.start()
+    STORAGE.start(STORAGE_GC_INTERVAL)
+
+
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="nRF5 AirTag Web Tool")
+    parser.add_argument("--production", action="store_true",
+                        help="multi-worker server (gunicorn) with shared SQLite state | 生产模式")
+    parser.add_argument("--workers", type=int, default=4, help="worker processes (production mode)")
+    parser.add_argument("--threads", type=int, default=32, help="threads per worker; each open log stream holds one")
+    parser.add_argument("--port", type=int, default=52810)
+    args = parser.parse_args()
+
     if not os.path.exists(os.path.join(PROJECT_ROOT, 'templates')):
         os.makedirs(os.path.join(PROJECT_ROOT, 'templates'))
     if not os.path.exists(CONFIG_DIR):
         os.makedirs(CONFIG_DIR)
-        
-    log("nRF5 AirTag Web Tool Started at https://0.0.0.0:52810", "success")
+
+    if args.production:
+        import production_server
+        print(f"nRF5 AirTag Web Tool (production, {args.workers} workers) at https://0.0.0.0:{args.port}")
+        production_server.serve(f"0.0.0.0:{args.port}", args.workers, args.threads,
+                                os.path.join(PROJECT_ROOT, 'cert.pem'), os.path.join(PROJECT_ROOT, 'key.pem'))
+        sys.exit(0)
+
+    start_background_services()
+    log(f"nRF5 AirTag Web Tool Started at https://0.0.0.0:{args.port}", "success")
     # For LAN access with WebUSB (DapLink), HTTPS is required.
     # We use the generated self-signed certificates.
-    app.run(host='0.0.0.0', port=52810, ssl_context=('cert.pem', 'key.pem'))
+    app.run(host='0.0.0.0', port=args.port, ssl_context=('cert.pem', 'key.pem'), threaded=True)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Probe selection for the flash / identify tools.
+
+Left to themselves, openocd, JLinkExe and nrfjprog open whichever probe of
+their type they find first, so two jobs meant for two probes can end up
+driving the same one. A job is therefore bound to one probe serial when it
+is queued (the requested one, or the first attached probe of that type),
+the scheduler's per-probe lock key is derived from that serial, and every
+tool command line of the job names the same serial.
+"""
+
+JLINK_TYPES = ('1', '4')  # J-Link via JLinkExe / nrfjprog, J-Link via OpenOCD
+
+
+def inventory_type(debugger_type):
+    """usb_inventory debugger id of the physical probe behind `debugger_type`"""
+    return '1' if str(debugger_type) in JLINK_TYPES else str(debugger_type)
+
+
+def resolve(probes, debugger_type, probe_serial=None):
+    """
+    (serial the tools are pointed at, scheduler lock key). `probes` is the
+    inventory list for inventory_type(debugger_type). Without a serial the
+    tools cannot be pointed at a probe, so all such jobs of the type share
+    one key.
+    """
+    kind = inventory_type(debugger_type)
+    if not probe_serial and probes:
+        probe_serial = probes[0].get('serial')
+    return probe_serial or None, f"{kind}:{probe_serial or 'default'}"
+
+
+def openocd_select(probe_serial):
+    """OpenOCD config command (before `init`) binding the adapter to one probe"""
+    return f"adapter serial {probe_serial}" if probe_serial else None
+
+
+def openocd_args(probe_serial):
+    cmd = openocd_select(probe_serial)
+    return ["-c", cmd] if cmd else []
+
+
+def jlink_args(probe_serial):
+    return ["-SelectEmuBySN", str(probe_serial)] if probe_serial else []
+
+
+def nrfjprog_args(probe_serial):
+    # --snr takes the J-Link serial as a number (USB serials are zero padded)
+    if probe_serial and str(probe_serial).isdigit():
+        return ["--snr", str(int(probe_serial))]
+    return []
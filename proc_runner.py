@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Asyncio process runner for build and flash tools.
+
+All child processes are driven by one event loop in a background thread:
+stdout and stderr are drained concurrently (a tool that fills one pipe
+can never stall on the other), and the timeout is wall-clock - a hung
+OpenOCD that prints nothing is still stopped on time. On timeout the
+whole process group gets SIGTERM, then SIGKILL after `kill_grace`
+seconds (make's compiler children go with it). The same happens as soon
+as an optional `cancel()` callable returns True (a cancelled job).
+
+`run()` is the blocking entry point for worker threads; output lines are
+handed to `on_line` in the calling thread, so thread-bound state such as
+the log session keeps working. Async code can await `run_async()`.
+"""
+import os
+import sys
+import queue
+import signal
+import atexit
+import asyncio
+import threading
+import time
+
+KILL_GRACE = 2.0              # seconds between SIGTERM and SIGKILL
+CANCEL_POLL = 0.2             # seconds between cancel() checks
+LINE_LIMIT = 1024 * 1024      # longest output line read in one piece
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+_running = set()              # live asyncio Process objects (killed at exit)
+
+
+class ProcResult:
+    def __init__(self, returncode, stdout, stderr, lines, timed_out, seconds, cancelled=False):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.lines = lines          # [(stream, line)] in arrival order
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        self.seconds = seconds
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    @property
+    def output(self):
+        """stdout then stderr, the way run_command() always reported it"""
+        return (self.stdout + "\n" + self.stderr).strip()
+
+
+def get_loop():
+    """The shared event loop, started on first use"""
+    global _loop, _loop_pid
+    with _loop_lock:
+        # A forked worker (gunicorn) inherits the loop object but not its thread
+        if _loop is None or _loop.is_closed() or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()  # Proactor on Windows: supports subprocesses
+            t = threading.Thread(target=loop.run_forever, name="proc-runner")
+            t.daemon = True
+            t.start()
+            _loop, _loop_pid = loop, os.getpid()
+        return _loop
+
+
+async def _drain(stream, name, sink, on_line):
+    while True:
+        try:
+            raw = await stream.readline()
+        except ValueError:
+            raw = b"[line longer than LINE_LIMIT dropped]"  # the reader skipped it; keep draining
+        if not raw:
+            return
+        line = raw.decode("utf-8", errors="replace").rstrip("\r\n")
+        sink.append(line)
+        if on_line:
+            on_line(name, line)
+
+
+def _signal(proc, sig):
+    try:
+        if sys.platform != "win32":
+            os.killpg(proc.pid, sig)  # the child leads its own group (start_new_session)
+        elif sig == signal.SIGTERM:
+            proc.terminate()
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+
+async def run_async(cmd, cwd=None, timeout=None, on_line=None, kill_grace=KILL_GRACE, env=None, cancel=None):
+    """
+    Run `cmd` to completion, `timeout` seconds or until cancel() returns
+    True. on_line(stream, line) is called on the loop for every output
+    line. Returns a ProcResult.
+    """
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, cwd=cwd, env=env, stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        limit=LINE_LIMIT, start_new_session=sys.platform != "win32")
+    _running.add(proc)
+    out, err, lines = [], [], []
+
+    def record(name, line):
+        lines.append((name, line))
+        if on_line:
+            on_line(name, line)
+
+    task = asyncio.ensure_future(asyncio.gather(_drain(proc.stdout, "stdout", out, record),
+                                                _drain(proc.stderr, "stderr", err, record),
+                                                proc.wait()))
+    timed_out = cancelled = False
+    deadline = None if timeout is None else started + timeout
+    try:
+        while True:
+            wait = CANCEL_POLL if cancel else None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+                wait = remaining if wait is None else min(wait, remaining)
+            done, _ = await asyncio.wait({task}, timeout=wait)
+            if done:
+                break
+            if cancel and cancel():
+                cancelled = True
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                timed_out = True
+                break
+        if not done:
+            for sig in (signal.SIGTERM, getattr(signal, "SIGKILL", signal.SIGTERM)):
+                _signal(proc, sig)
+                done, _ = await asyncio.wait({task}, timeout=kill_grace)
+                if done:
+                    break
+            if not done:
+                # Killed, but a grandchild still holds the pipes open: stop reading
+                task.cancel()
+                await proc.wait()
+        if done:
+            task.result()
+    finally:
+        _running.discard(proc)
+    return ProcResult(proc.returncode, "\n".join(out), "\n".join(err), lines, timed_out,
+                      time.monotonic() - started, cancelled)
+
+
+def run(cmd, cwd=None, timeout=None, on_line=None, kill_grace=KILL_GRACE, env=None, cancel=None):
+    """
+    Blocking run on the shared loop. on_line(stream, line) runs in the
+    calling thread as lines arrive; cancel() is polled on the loop.
+    Raises OSError if `cmd` cannot start.
+    """
+    lines = queue.Queue() if on_line else None
+    future = asyncio.run_coroutine_threadsafe(
+        run_async(cmd, cwd, timeout, (lambda s, l: lines.put((s, l))) if lines else None, kill_grace, env, cancel),
+        get_loop())
+    if lines:
+        while True:
+            try:
+                on_line(*lines.get(timeout=0.1))
+            except queue.Empty:
+                if future.done():
+                    break
+        while not lines.empty():
+            on_line(*lines.get_nowait())
+    return future.result()
+
+
+@atexit.register
+def _kill_running():
+    # Children run in their own sessions and would outlive a Ctrl-C'd server
+    for proc in list(_running):
+        _signal(proc, getattr(signal, "SIGKILL", signal.SIGTERM))
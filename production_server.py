@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Production serving for the web tool: gunicorn with several worker
+processes, threaded workers (log streams stay open), TLS and keep-alive.
+
+Workers share sessions, logs and the job queue through the SQLite store
+(state_store.py). Every worker queues jobs; only one of them (elected
+through a lock file) dispatches and runs them, see start_worker_services().
+Started by `python3 nrf5_airtag_web.py --production`.
+"""
+import os
+import sys
+
+KEEPALIVE = 5       # seconds an idle keep-alive connection is held open
+GRACEFUL_TIMEOUT = 30
+
+
+def serve(bind, workers=4, threads=32, certfile=None, keyfile=None, store_path=None):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("Production mode needs gunicorn: pip3 install gunicorn | 生产模式需要安装 gunicorn")
+
+    def load_web():
+        # Imported fresh in every worker so no thread or DB handle crosses the fork
+        import nrf5_airtag_web as web
+        if web.STORE is None:
+            web.use_state_store(store_path or web.STATE_DB)
+        return web
+
+    def post_worker_init(worker):
+        web = load_web()
+        web.start_worker_services()
+        web.log(f"Worker {os.getpid()} ready | 工作进程已启动", "info")
+
+    options = {
+        "bind": bind,
+        "workers": workers,
+        "worker_class": "gthread",
+        "threads": threads,
+        "keepalive": KEEPALIVE,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "timeout": 0,  # builds and SSE streams are long; gthread workers heartbeat on their own
+        "post_worker_init": post_worker_init,
+        "accesslog": None,
+    }
+    if certfile and keyfile and os.path.exists(certfile) and os.path.exists(keyfile):
+        options["certfile"] = certfile
+        options["keyfile"] = keyfile
+
+    class WebApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return load_web().app
+
+    WebApplication().run()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Opt-in sampling profiler and tracemalloc snapshots for a running server.
+
+SamplingProfiler records wall-clock stacks of selected requests and jobs:
+while one of the targets runs (a function wrapped with @profiled, or a
+request the web app hands to begin()), a sampler thread reads the stack of
+its thread every `interval` seconds, plus the stacks of stage worker
+threads running for the same job. Each run is written to
+root/<time>_<label>_<pid>_<n>.folded in the collapsed-stack format
+("frame;frame;frame count") that flamegraph.pl, speedscope and inferno
+read; identical stacks from several files can simply be concatenated.
+
+The targets live in a small settings file, so every worker process of a
+multi-process server follows the same switch and it expires on its own.
+Nothing is sampled while no target runs.
+
+MemoryTracer wraps tracemalloc: start(), a baseline snapshot, and diffs
+of the current heap against it grouped by line or traceback.
+"""
+import os
+import re
+import sys
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from collections import Counter, deque
+
+DEFAULT_INTERVAL = 0.01   # 100 samples per second per profiled thread
+MIN_INTERVAL = 0.001
+MAX_DEPTH = 128
+SETTINGS_TTL = 1.0        # seconds between re-reads of the settings file
+LABEL_RE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame, root_code=None):
+    """Frames from the outermost (or from the first frame running `root_code`) to `frame`, ';'-joined"""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        if frame.f_code is root_code:
+            break
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profile:
+    def __init__(self, label, thread_id, job=None, root_code=None):
+        self.label = label
+        self.thread_id = thread_id
+        self.job = job
+        self.root_code = root_code
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.stacks = Counter()
+        self.samples = 0
+
+
+class SamplingProfiler:
+    """Profiles of the targets in `settings_file`, written to `root` (the newest `keep` are kept)"""
+
+    def __init__(self, root, settings_file, keep=200):
+        self.root = root
+        self.settings_file = settings_file
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.active = {}          # thread id -> Profile
+        self.thread = None
+        self.recent = deque(maxlen=50)
+        self.count = 0
+        self._settings = {}
+        self._settings_mtime = None
+        self._settings_checked = 0
+        os.makedirs(root, exist_ok=True)
+
+    # --- Switch ---
+    def settings(self):
+        """{"targets": [...], "until": unix time, "interval": s}; re-read at most every SETTINGS_TTL"""
+        now = time.monotonic()
+        if now - self._settings_checked >= SETTINGS_TTL:
+            self._settings_checked = now
+            try:
+                mtime = os.path.getmtime(self.settings_file)
+            except OSError:
+                mtime = None
+            if mtime != self._settings_mtime:
+                try:
+                    with open(self.settings_file, "r") as f:
+                        self._settings = json.load(f)
+                except (OSError, ValueError):
+                    self._settings = {}
+                self._settings_mtime = mtime
+        return self._settings
+
+    def configure(self, targets, duration, interval=DEFAULT_INTERVAL):
+        """Profile `targets` for the next `duration` seconds; no targets switches profiling off"""
+        settings = {"targets": sorted(set(targets)), "until": time.time() + duration if targets else 0,
+                    "interval": max(MIN_INTERVAL, interval)}
+        tmp = f"{self.settings_file}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(settings, f)
+        os.replace(tmp, self.settings_file)
+        self._settings_checked = 0
+        return self.settings()
+
+    def wants(self, name):
+        s = self.settings()
+        return bool(name) and name in s.get("targets", ()) and time.time() < s.get("until", 0)
+
+    # --- Profiling ---
+    def begin(self, label, root_code=None):
+        """Start sampling the calling thread; returns the Profile, or None if it is already sampled"""
+        t = threading.current_thread()
+        with self.lock:
+            if t.ident in self.active:
+                return None  # nested target: its samples already go to the outer profile
+            profile = Profile(label, t.ident, getattr(t, "job", None), root_code)
+            self.active[t.ident] = profile
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self.thread.start()
+        return profile
+
+    def finish(self, profile, error=None):
+        if profile is None:
+            return
+        with self.lock:
+            self.active.pop(profile.thread_id, None)
+        self._write(profile, error)
+
+    def profiled(self, func):
+        """Decorator: profile calls of `func` while its name is a target"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.wants(func.__name__):
+                return func(*args, **kwargs)
+            profile = self.begin(func.__name__, func.__code__)
+            error = None
+            try:
+                return func(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                self.finish(profile, error)
+        return wrapper
+
+    def _run(self):
+        while True:
+            interval = self.settings().get("interval", DEFAULT_INTERVAL)
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                profiles = list(self.active.values())
+            frames = sys._current_frames()
+            workers = [t for t in threading.enumerate() if getattr(t, "job", None) is not None]
+            for p in profiles:
+                stacks = [collapse(frames.get(p.thread_id), p.root_code)]
+                if p.job is not None:  # stages of the same job on worker pools
+                    stacks += [collapse(frames.get(t.ident)) for t in workers
+                               if t.job is p.job and t.ident != p.thread_id]
+                for stack in stacks:
+                    if stack:
+                        p.stacks[stack] += 1
+                p.samples += 1
+            del frames
+            time.sleep(interval)
+
+    # --- Storage ---
+    def _write(self, profile, error=None):
+        with self.lock:
+            self.count += 1
+            n = self.count
+        label = LABEL_RE.sub("_", profile.label).strip("_")[:60] or "profile"
+        name = f"{time.strftime('%Y%m%d_%H%M%S', time.localtime(profile.started))}_{label}_{os.getpid()}_{n}.folded"
+        summary = {"name": name, "label": profile.label, "started": profile.started, "samples": profile.samples,
+                   "duration_ms": round((time.perf_counter() - profile.t0) * 1000, 1),
+                   "job": getattr(profile.job, "id", None), "error": type(error).__name__ if error else None}
+        self.recent.append(summary)
+        if not profile.stacks:
+            return
+        root = LABEL_RE.sub("_", profile.label)
+        try:
+            with open(os.path.join(self.root, name), "w") as f:
+                for stack, count in profile.stacks.most_common():
+                    f.write(f"{root};{stack} {count}\n")
+            self._prune()
+        except OSError:
+            pass
+
+    def _prune(self):
+        files = self.files()
+        for entry in files[self.keep:]:
+            try:
+                os.remove(os.path.join(self.root, entry["name"]))
+            except OSError:
+                pass
+
+    def files(self):
+        """Stored profiles, newest first"""
+        entries = []
+        try:
+            names = [n for n in os.listdir(self.root) if n.endswith(".folded")]
+        except OSError:
+            return entries
+        for n in names:
+            try:
+                st = os.stat(os.path.join(self.root, n))
+            except OSError:
+                continue
+            entries.append({"name": n, "size": st.st_size, "mtime": st.st_mtime})
+        entries.sort(key=lambda e: e["mtime"], reverse=True)
+        return entries
+
+    def path(self, name):
+        """Path of a stored profile, or None for names that are not one"""
+        if not name.endswith(".folded") or os.path.basename(name) != name or LABEL_RE.search(name):
+            return None
+        path = os.path.join(self.root, name)
+        return path if os.path.isfile(path) else None
+
+    def status(self):
+        s = self.settings()
+        with self.lock:
+            running = [{"label": p.label, "job": getattr(p.job, "id", None), "samples": p.samples}
+                       for p in self.active.values()]
+        return {"targets": s.get("targets", []), "enabled": time.time() < s.get("until", 0) and bool(s.get("targets")),
+                "expires_in_s": max(0, round(s.get("until", 0) - time.time())),
+                "interval_ms": round(s.get("interval", DEFAULT_INTERVAL) * 1000, 2), "pid": os.getpid(),
+                "running": running, "recent": list(self.recent)}
+
+
+class MemoryTracer:
+    """tracemalloc with a baseline snapshot to diff against"""
+
+    FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+               tracemalloc.Filter(False, "<unknown>")]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.baseline = None
+        self.baseline_time = None
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(self.FILTERS)
+
+    def start(self, frames=25):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self.baseline, self.baseline_time = self._snapshot(), time.time()
+        return self.status()
+
+    def stop(self):
+        with self.lock:
+            tracemalloc.stop()
+            self.baseline = self.baseline_time = None
+        return self.status()
+
+    def snapshot(self):
+        """Take a new baseline"""
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                raise RuntimeError("tracemalloc is not running")
+            self.baseline, self.baseline_time = self._snapshot(), time.time()
+        return self.status()
+
+    def diff(self, group_by="lineno", limit=25, reset=False):
+        """Largest allocation changes since the baseline, grouped by "lineno", "filename" or "traceback" """
+        with self.lock:
+            if not tracemalloc.is_tracing() or self.baseline is None:
+                raise RuntimeError("tracemalloc is not running")
+            current = self._snapshot()
+            stats = current.compare_to(self.baseline, group_by)
+            since = self.baseline_time
+            if reset:
+                self.baseline, self.baseline_time = current, time.time()
+        top = [{"size_diff": s.size_diff, "size": s.size, "count_diff": s.count_diff, "count": s.count,
+                "traceback": [f"{f.filename}:{f.lineno}" for f in reversed(s.traceback)]}  # innermost first
+               for s in stats[:limit]]
+        return dict(self.status(), since=since, group_by=group_by,
+                    size_diff_total=sum(s.size_diff for s in stats), top=top)
+
+    def status(self):
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {"tracing": tracing, "frames": tracemalloc.get_traceback_limit() if tracing else None,
+                "traced_bytes": current, "peak_bytes": peak, "baseline": self.baseline_time, "pid": os.getpid()}
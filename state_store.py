@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Shared SQLite (WAL) store for sessions, logs and jobs.
+
+In production mode several server processes answer requests; the in-process
+STATE dict and log rings cannot be seen across them. This store keeps the
+same data in one local SQLite database in WAL mode, so readers never block
+the writer and every worker sees the same sessions, logs and job queue. It
+also survives restarts.
+
+Connections are per thread and re-opened after fork.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id  TEXT PRIMARY KEY,
+    next_seq    INTEGER NOT NULL DEFAULT 0,
+    last_active REAL NOT NULL,
+    state       TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS logs (
+    session_id TEXT NOT NULL,
+    seq        INTEGER NOT NULL,
+    entry      TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS jobs (
+    seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+    id         TEXT NOT NULL UNIQUE,
+    kind       TEXT NOT NULL,
+    session_id TEXT,
+    probe      TEXT,
+    priority   INTEGER NOT NULL DEFAULT 0,
+    state      TEXT NOT NULL,
+    cancel     INTEGER NOT NULL DEFAULT 0,
+    owner      TEXT,
+    created    REAL NOT NULL,
+    finished   REAL,
+    data       TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority DESC, seq);
+CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id, created);
+"""
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+
+
+class SqliteDB:
+    """Per-thread WAL connections to one database file (re-opened after fork)"""
+    SCHEMA = ""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.conn().executescript(self.SCHEMA)
+
+    def conn(self):
+        if getattr(self.local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.row_factory = sqlite3.Row
+            self.local.db, self.local.pid = db, os.getpid()
+        return self.local.db
+
+    def tx(self):
+        return _Transaction(self.conn())
+
+
+class StateStore(SqliteDB):
+    SCHEMA = SCHEMA
+
+    # --- Sessions ---
+    def _ensure_session(self, db, session_id, now):
+        db.execute("INSERT OR IGNORE INTO sessions (session_id, last_active) VALUES (?, ?)", (session_id, now))
+
+    def touch(self, session_id):
+        now = time.time()
+        with self.tx() as db:
+            self._ensure_session(db, session_id, now)
+            db.execute("UPDATE sessions SET last_active = ? WHERE session_id = ?", (now, session_id))
+
+    def get_state(self, session_id):
+        row = self.conn().execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row["state"]) if row else {}
+
+    def set_state(self, session_id, key, value):
+        now = time.time()
+        with self.tx() as db:
+            self._ensure_session(db, session_id, now)
+            row = db.execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            state = json.loads(row["state"])
+            state[key] = value
+            db.execute("UPDATE sessions SET state = ?, last_active = ? WHERE session_id = ?",
+                       (json.dumps(state), now, session_id))
+
+    def idle_sessions(self, ttl):
+        """(session_id, state) of sessions idle for longer than ttl seconds"""
+        rows = self.conn().execute("SELECT session_id, state FROM sessions WHERE last_active < ?",
+                                   (time.time() - ttl,)).fetchall()
+        return [(r["session_id"], json.loads(r["state"])) for r in rows]
+
+    def drop_session(self, session_id):
+        with self.tx() as db:
+            db.execute("DELETE FROM logs WHERE session_id = ?", (session_id,))
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    # --- Logs (same cursor semantics as log_buffer.LogRing) ---
+    def append_log(self, session_id, entry, capacity):
+        now = time.time()
+        with self.tx() as db:
+            self._ensure_session(db, session_id, now)
+            seq = db.execute("SELECT next_seq FROM sessions WHERE session_id = ?", (session_id,)).fetchone()[0]
+            entry["seq"] = seq
+            db.execute("INSERT INTO logs (session_id, seq, entry) VALUES (?, ?, ?)",
+                       (session_id, seq, json.dumps(entry, ensure_ascii=False)))
+            db.execute("UPDATE sessions SET next_seq = ?, last_active = ? WHERE session_id = ?",
+                       (seq + 1, now, session_id))
+            if seq >= capacity:
+                db.execute("DELETE FROM logs WHERE session_id = ? AND seq <= ?", (session_id, seq - capacity))
+        return seq
+
+    def read_logs(self, session_id, cursor=0):
+        """Entries with seq >= cursor. Returns (entries, next_cursor, missed)."""
+        db = self.conn()
+        row = db.execute("SELECT next_seq FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        next_seq = row[0] if row else 0
+        cursor = max(0, min(int(cursor), next_seq))
+        first = db.execute("SELECT MIN(seq) FROM logs WHERE session_id = ?", (session_id,)).fetchone()[0]
+        first = next_seq if first is None else first
+        rows = db.execute("SELECT entry FROM logs WHERE session_id = ? AND seq >= ? ORDER BY seq",
+                          (session_id, cursor)).fetchall()
+        return [json.loads(r[0]) for r in rows], next_seq, max(0, first - cursor)
+
+    def clear_logs(self, session_id):
+        with self.tx() as db:
+            db.execute("DELETE FROM logs WHERE session_id = ?", (session_id,))
+
+    # --- Jobs ---
+    def insert_job(self, job):
+        with self.tx() as db:
+            cur = db.execute(
+                "INSERT INTO jobs (id, kind, session_id, probe, priority, state, owner, created, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job["id"], job["kind"], job["session_id"], job["probe"], job["priority"], job["state"],
+                 job.get("owner"), job["created"], json.dumps(job)))
+            return cur.lastrowid
+
+    def update_job(self, job_id, **fields):
+        with self.tx() as db:
+            row = db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if not row:
+                return
+            data = json.loads(row[0])
+            data.update(fields)
+            db.execute("UPDATE jobs SET state = ?, finished = ?, owner = ?, data = ? WHERE id = ?",
+                       (data["state"], data.get("finished"), data.get("owner"), json.dumps(data), job_id))
+
+    def get_job(self, job_id):
+        row = self.conn().execute("SELECT seq, data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(json.loads(row["data"]), seq=row["seq"]) if row else None
+
+    def list_jobs(self, session_id=None, states=None, limit=500):
+        sql, args = "SELECT seq, data FROM jobs WHERE 1=1", []
+        if session_id:
+            sql += " AND session_id = ?"
+            args.append(session_id)
+        if states:
+            sql += f" AND state IN ({','.join('?' * len(states))})"
+            args.extend(states)
+        sql += " ORDER BY created DESC LIMIT ?"
+        args.append(limit)
+        return [dict(json.loads(r["data"]), seq=r["seq"]) for r in self.conn().execute(sql, args)]
+
+    def claim_job(self, owner, per_session, per_probe):
+        """Atomically move the best startable queued job to running (for `owner`)"""
+        with self.tx() as db:
+            running = db.execute("SELECT session_id, probe FROM jobs WHERE state = 'running'").fetchall()
+            queued = db.execute("SELECT id, session_id, probe FROM jobs WHERE state = 'queued' "
+                                "ORDER BY priority DESC, seq LIMIT 200").fetchall()
+            for q in queued:
+                if q["session_id"] and sum(1 for r in running if r["session_id"] == q["session_id"]) >= per_session:
+                    continue
+                if q["probe"] and sum(1 for r in running if r["probe"] == q["probe"]) >= per_probe:
+                    continue
+                row = db.execute("SELECT seq, data FROM jobs WHERE id = ?", (q["id"],)).fetchone()
+                data = json.loads(row["data"])
+                data.update(state="running", started=time.time(), owner=owner)
+                db.execute("UPDATE jobs SET state = 'running', owner = ?, data = ? WHERE id = ?",
+                           (owner, json.dumps(data), q["id"]))
+                return dict(data, seq=row["seq"])
+        return None
+
+    def request_cancel(self, job_id):
+        """Cancel a queued job, or flag a running one for its owner. Returns the job's state before."""
+        with self.tx() as db:
+            row = db.execute("SELECT state, data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if not row or row["state"] not in ("queued", "running"):
+                return None
+            if row["state"] == "queued":
+                data = json.loads(row["data"])
+                data.update(state="cancelled", finished=time.time())
+                db.execute("UPDATE jobs SET state = 'cancelled', finished = ?, cancel = 1, data = ? WHERE id = ?",
+                           (data["finished"], json.dumps(data), job_id))
+            else:
+                db.execute("UPDATE jobs SET cancel = 1 WHERE id = ?", (job_id,))
+            return row["state"]
+
+    def cancel_requested(self, job_ids):
+        if not job_ids:
+            return set()
+        rows = self.conn().execute(f"SELECT id FROM jobs WHERE cancel = 1 AND id IN ({','.join('?' * len(job_ids))})",
+                                   list(job_ids)).fetchall()
+        return {r[0] for r in rows}
+
+    def queue_position(self, job_id):
+        row = self.conn().execute("SELECT seq, priority, state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row or row["state"] != "queued":
+            return None
+        ahead = self.conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND (priority > ? OR (priority = ? AND seq < ?))",
+            (row["priority"], row["priority"], row["seq"])).fetchone()[0]
+        return ahead + 1
+
+    def session_active(self, session_id):
+        row = self.conn().execute("SELECT 1 FROM jobs WHERE session_id = ? AND state IN ('queued', 'running') LIMIT 1",
+                                  (session_id,)).fetchone()
+        return row is not None
+
+    def job_counts(self):
+        return {r[0]: r[1] for r in self.conn().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")}
+
+    def reap_jobs(self, keep=500):
+        """
+        Mark jobs whose owning process is gone as interrupted (running ones, and
+        queued ones nobody will wait for), then trim finished jobs to `keep`.
+        """
+        reaped = 0
+        with self.tx() as db:
+            rows = db.execute("SELECT id, state, owner, data FROM jobs WHERE state IN ('queued', 'running')").fetchall()
+            for r in rows:
+                data = json.loads(r["data"])
+                if r["state"] == "queued" and data.get("requeue", True):
+                    continue
+                try:
+                    alive = pid_alive(int(r["owner"]))
+                except (TypeError, ValueError):
+                    alive = False
+                if alive:
+                    continue
+                data.update(state="interrupted", finished=time.time())
+                db.execute("UPDATE jobs SET state = 'interrupted', finished = ?, data = ? WHERE id = ?",
+                           (data["finished"], json.dumps(data), r["id"]))
+                reaped += 1
+            db.execute("DELETE FROM jobs WHERE seq IN (SELECT seq FROM jobs WHERE state NOT IN ('queued', 'running') "
+                       "ORDER BY finished DESC LIMIT -1 OFFSET ?)", (keep,))
+        return reaped
+
+    # --- Stats ---
+    def stats(self):
+        db = self.conn()
+        size = 0
+        for suffix in ("", "-wal"):
+            try:
+                size += os.path.getsize(self.path + suffix)
+            except OSError:
+                pass
+        return {"path": self.path, "bytes": size,
+                "sessions": db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+                "log_entries": db.execute("SELECT COUNT(*) FROM logs").fetchone()[0],
+                "jobs": self.job_counts()}
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT (ROLLBACK on error); writers queue on the busy timeout"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
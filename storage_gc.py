@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Storage quotas and garbage collection for user_sessions/.
+
+Every build leaves raw/patched/merged images, flash scripts and key files
+next to its bundle, and nothing was ever removed. A background collector
+now keeps the directory in bounds:
+
+1. Intermediates (everything that is not a bundle zip) older than
+   `intermediate_ttl` are removed - the bundle already contains what a
+   user needs, the rest can be rebuilt.
+2. A session over its quota loses its least recently used bundles.
+3. If all sessions together are over the global quota, the least recently
+   used bundles across sessions go next.
+
+Sessions with an active job are skipped, and bundles younger than
+`min_bundle_age` are never evicted. Each run reports the bytes reclaimed.
+"""
+import os
+import time
+import threading
+
+BUNDLE_SUFFIX = "_bundle.zip"
+
+
+class StorageManager:
+    def __init__(self, sessions_dir, session_quota=200 * 1024 * 1024, global_quota=5 * 1024 ** 3,
+                 intermediate_ttl=3600, min_bundle_age=600, is_busy=None, last_used=None,
+                 on_remove=None, log_func=None):
+        self.sessions_dir = sessions_dir
+        self.session_quota = session_quota
+        self.global_quota = global_quota
+        self.intermediate_ttl = intermediate_ttl
+        self.min_bundle_age = min_bundle_age
+        self.is_busy = is_busy or (lambda session_id: False)
+        self.last_used = last_used or (lambda: {})  # -> {(session_id, filename): unix time}
+        self.on_remove = on_remove or (lambda session_id, filename: None)
+        self.log = log_func or (lambda msg, level="info": None)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_report = None
+        self.total_reclaimed = 0
+
+    def start(self, interval=600):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self._run, args=(interval,), name="storage-gc")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, interval):
+        while True:
+            try:
+                report = self.collect()
+                if report["reclaimed_bytes"]:
+                    self.log(f"Storage GC reclaimed {report['reclaimed_bytes'] / 1048576:.1f} MB "
+                             f"({report['removed_files']} files) | 已回收磁盘空间", "info")
+            except Exception as e:
+                self.log(f"Storage GC failed: {e}", "warning")
+            time.sleep(interval)
+
+    # --- Scanning ---
+    def scan(self):
+        """{session_id: [{"name", "path", "size", "mtime", "bundle"}]}"""
+        sessions = {}
+        try:
+            entries = os.listdir(self.sessions_dir)
+        except OSError:
+            return sessions
+        for sid in entries:
+            d = os.path.join(self.sessions_dir, sid)
+            if not os.path.isdir(d):
+                continue
+            files = []
+            for root, _, names in os.walk(d):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append({"name": os.path.relpath(path, d), "path": path, "size": st.st_size,
+                                  "mtime": st.st_mtime, "bundle": root == d and name.endswith(BUNDLE_SUFFIX)})
+            sessions[sid] = files
+        return sessions
+
+    def usage(self):
+        sessions = self.scan()
+        per_session = {sid: sum(f["size"] for f in files) for sid, files in sessions.items()}
+        return {"total_bytes": sum(per_session.values()), "sessions": len(per_session),
+                "largest": sorted(per_session.items(), key=lambda kv: kv[1], reverse=True)[:10],
+                "session_quota": self.session_quota, "global_quota": self.global_quota,
+                "total_reclaimed": self.total_reclaimed, "last_gc": self.last_report}
+
+    # --- Collection ---
+    def collect(self):
+        with self.lock:
+            started = time.time()
+            report = {"reclaimed_bytes": 0, "removed_files": 0, "removed_bundles": 0,
+                      "intermediate_bytes": 0, "bundle_bytes": 0, "skipped_busy": 0}
+            sessions = self.scan()
+            last_used = self.last_used()
+            candidates = []  # evictable bundles: (last_used, sid, file)
+            sizes = {}
+            for sid, files in sessions.items():
+                if self.is_busy(sid):
+                    report["skipped_busy"] += 1
+                    sizes[sid] = sum(f["size"] for f in files)
+                    continue
+                kept = []
+                for f in files:
+                    if not f["bundle"] and started - f["mtime"] > self.intermediate_ttl:
+                        if self._remove(sid, f, report):
+                            report["intermediate_bytes"] += f["size"]
+                            continue
+                    kept.append(f)
+                sizes[sid] = sum(f["size"] for f in kept)
+                bundles = [(last_used.get((sid, f["name"]), f["mtime"]), sid, f) for f in kept
+                           if f["bundle"] and started - f["mtime"] > self.min_bundle_age]
+                bundles.sort(key=lambda b: b[0])
+                # Per-session quota: oldest-used bundles first
+                while sizes[sid] > self.session_quota and bundles:
+                    _, _, f = bundles.pop(0)
+                    if self._remove(sid, f, report):
+                        sizes[sid] -= f["size"]
+                candidates.extend(bundles)
+                self._prune_empty(sid)
+
+            # Global quota: LRU across all sessions
+            total = sum(sizes.values())
+            candidates.sort(key=lambda b: b[0])
+            for _, sid, f in candidates:
+                if total <= self.global_quota:
+                    break
+                if self._remove(sid, f, report):
+                    total -= f["size"]
+                    self._prune_empty(sid)
+
+            report["bundle_bytes"] = report["reclaimed_bytes"] - report["intermediate_bytes"]
+            report["total_bytes"] = total
+            report["finished"] = time.time()
+            report["elapsed_s"] = round(report["finished"] - started, 3)
+            self.total_reclaimed += report["reclaimed_bytes"]
+            self.last_report = report
+            return report
+
+    def _remove(self, sid, f, report):
+        try:
+            os.remove(f["path"])
+        except OSError:
+            return False
+        report["reclaimed_bytes"] += f["size"]
+        report["removed_files"] += 1
+        if f["bundle"]:
+            report["removed_bundles"] += 1
+            self.on_remove(sid, f["name"])
+        return True
+
+    def _prune_empty(self, sid):
+        d = os.path.join(self.sessions_dir, sid)
+        for root, dirs, files in os.walk(d, topdown=False):
+            if not dirs and not files and root != d:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+        try:
+            if not os.listdir(d):
+                os.rmdir(d)
+        except OSError:
+            pass
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Target presence watcher for the autoflash production loop.
+
+Instead of spawning a full OpenOCD / JLinkExe flash attempt every second and
+waiting for it to fail, the watcher keeps ONE OpenOCD process alive with its
+TCL RPC server enabled and polls a single FICR word (INFO.PART) through it.
+A board clamped into the fixture is noticed within one poll interval
+(~50 ms) and the flash itself is issued through the same session, so there
+is no process start-up or USB re-enumeration on the critical path.
+
+Debuggers that cannot hold a persistent OpenOCD session (J-Link via
+JLinkExe/nrfjprog, or HLA ST-Link firmware that refuses to start without a
+target) fall back to a caller supplied probe function.
+"""
+import os
+import socket
+import subprocess
+import threading
+import time
+
+TCL_TERMINATOR = b"\x1a"
+FICR_INFO_PART = "0x10000100"
+
+
+def _free_port():
+    """Ask the OS for an unused local TCP port for the OpenOCD TCL server"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+class OpenOCDSession:
+    """A long-running OpenOCD process driven through its TCL RPC port"""
+
+    def __init__(self, interface_cfg, target_cfg, cwd=None, extra_cmds=None):
+        self.interface_cfg = interface_cfg
+        self.target_cfg = target_cfg
+        self.cwd = cwd
+        self.extra_cmds = extra_cmds or []
+        self.port = None
+        self.proc = None
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def start(self, timeout=5.0):
+        """Start OpenOCD and connect to the TCL port. Returns True on success."""
+        self.port = _free_port()
+        cmd = ["openocd", "-f", self.interface_cfg, "-f", self.target_cfg,
+               "-c", f"gdb_port disabled; telnet_port disabled; tcl_port {self.port}"]
+        for c in self.extra_cmds:
+            cmd += ["-c", c]
+        cmd += ["-c", "init"]
+        try:
+            self.proc = subprocess.Popen(cmd, cwd=self.cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except Exception:
+            self.proc = None
+            return False
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                # OpenOCD exited during init (e.g. HLA ST-Link without target)
+                self.proc = None
+                return False
+            try:
+                self.sock = socket.create_connection(("127.0.0.1", self.port), timeout=1.0)
+                return True
+            except OSError:
+                time.sleep(0.05)
+        self.close()
+        return False
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None and self.sock is not None
+
+    def command(self, tcl, timeout=5.0):
+        """
+        Evaluate a TCL command. Returns (success, output); success is False
+        when the command raised an error inside OpenOCD.
+        """
+        if not self.alive:
+            return False, "OpenOCD session not running"
+        # capture the command output and fold its error status into the reply
+        wrapped = f"set _rc [catch {{capture {{{tcl}}}}} _out]; format \"%d %s\" $_rc $_out"
+        with self.lock:
+            try:
+                self.sock.settimeout(timeout)
+                self.sock.sendall(wrapped.encode() + TCL_TERMINATOR)
+                buf = b""
+                while not buf.endswith(TCL_TERMINATOR):
+                    chunk = self.sock.recv(4096)
+                    if not chunk:
+                        raise OSError("OpenOCD closed the TCL connection")
+                    buf += chunk
+            except OSError as e:
+                self.close()
+                return False, str(e)
+        reply = buf[:-1].decode(errors="replace")
+        rc, _, out = reply.partition(" ")
+        return rc == "0", out.strip()
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.sendall(b"shutdown" + TCL_TERMINATOR)
+            except OSError:
+                pass
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+        if self.proc:
+            try:
+                self.proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+            self.proc = None
+
+
+class TargetWatcher:
+    """
+    Detects board insertion / removal for the autoflash loop.
+    If an OpenOCD session can be held open, presence is a single FICR read;
+    otherwise `probe_func()` (returns bool) is called every `fallback_interval`.
+    """
+
+    def __init__(self, interface_cfg=None, target_cfg=None, cwd=None, probe_func=None,
+                 poll_interval=0.05, fallback_interval=0.25, removal_confirm=3, extra_cmds=None):
+        self.session = None
+        if interface_cfg and target_cfg:
+            # extra_cmds: config commands before init, e.g. "adapter serial ..." to pick the probe
+            self.session = OpenOCDSession(interface_cfg, target_cfg, cwd=cwd, extra_cmds=extra_cmds)
+        self.probe_func = probe_func
+        self.poll_interval = poll_interval
+        self.fallback_interval = fallback_interval
+        self.removal_confirm = removal_confirm
+
+    def start(self):
+        """Returns True if a persistent session is available"""
+        if self.session and not self.session.start():
+            self.session = None
+        return self.persistent
+
+    @property
+    def persistent(self):
+        return self.session is not None and self.session.alive
+
+    def is_present(self):
+        if self.persistent:
+            ok, out = self.session.command(f"mdw {FICR_INFO_PART}", timeout=1.0)
+            return ok and FICR_INFO_PART[2:] in out.lower()
+        if self.probe_func:
+            try:
+                return bool(self.probe_func())
+            except Exception:
+                return False
+        return False
+
+    def _interval(self):
+        return self.poll_interval if self.persistent else self.fallback_interval
+
+    def wait_for_insertion(self, should_stop):
+        """Block until a target answers. Returns False if stopped."""
+        while not should_stop():
+            if self.is_present():
+                return True
+            time.sleep(self._interval())
+        return False
+
+    def wait_for_removal(self, should_stop):
+        """Block until the target stops answering for `removal_confirm` polls"""
+        misses = 0
+        while not should_stop():
+            if self.is_present():
+                misses = 0
+            else:
+                misses += 1
+                if misses >= self.removal_confirm:
+                    return True
+            time.sleep(self._interval())
+        return False
+
+    def run(self, cmds, timeout=60, on_line=None):
+        """
+        Run OpenOCD commands through the persistent session. on_line(stream, line)
+        sees the output of each command as soon as that command returns.
+        """
+        if not self.persistent:
+            return False, "No persistent OpenOCD session"
+        output = []
+        for c in cmds:
+            ok, out = self.session.command(c, timeout=timeout)
+            if out:
+                output.append(out)
+                if on_line:
+                    for line in out.splitlines():
+                        on_line("stdout", line)
+            if not ok:
+                return False, "\n".join(output)
+        return True, "\n".join(output)
+
+    def close(self):
+        if self.session:
+            self.session.close()
+            self.session = None
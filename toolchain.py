@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Toolchain capability probe.
+
+Scans once (at startup, or on demand) for the external tools the flash and
+build paths shell out to, records their versions and which OpenOCD
+interface configs can actually be resolved, and keeps the result in memory
+(and on disk, so the next start has an answer before the rescan finishes).
+Callers ask `has_tool()` instead of paying a failed subprocess per flash.
+"""
+import os
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+TOOLS = ["nrfjprog", "JLinkExe", "openocd", "arm-none-eabi-objcopy", "arm-none-eabi-gdb", "make"]
+
+VERSION_ARGS = {
+    "nrfjprog": ["--version"],
+    "openocd": ["--version"],
+    "arm-none-eabi-objcopy": ["--version"],
+    "arm-none-eabi-gdb": ["--version"],
+    "make": ["--version"],
+}
+
+CACHE = {
+    "tools": {},              # name -> {"available", "path", "version"}
+    "openocd_interfaces": {}, # debugger id -> {"config", "available", "path"}
+    "scanned_at": None,
+}
+_LOCK = threading.Lock()
+_CACHE_FILE = None
+
+
+def _first_line(text):
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if line:
+            return line
+    return None
+
+
+def _tool_version(name, path):
+    """Best-effort version string; never raises"""
+    try:
+        if name == "JLinkExe":
+            # JLinkExe has no --version; run an empty command file and read the banner
+            fd, script = tempfile.mkstemp(suffix=".jlink")
+            with os.fdopen(fd, "w") as f:
+                f.write("exit\n")
+            try:
+                proc = subprocess.run([path, "-NoGui", "1", "-CommandFile", script],
+                                      capture_output=True, text=True, timeout=5)
+            finally:
+                os.remove(script)
+            out = proc.stdout + proc.stderr
+            for line in out.splitlines():
+                if "SEGGER J-Link Commander" in line:
+                    return line.strip()
+            return _first_line(out)
+        proc = subprocess.run([path] + VERSION_ARGS.get(name, ["--version"]),
+                              capture_output=True, text=True, timeout=5)
+        # openocd prints its banner to stderr
+        return _first_line(proc.stdout) or _first_line(proc.stderr)
+    except Exception:
+        return None
+
+
+def _openocd_script_dirs(openocd_path):
+    dirs = []
+    if openocd_path:
+        prefix = os.path.dirname(os.path.dirname(os.path.realpath(openocd_path)))
+        dirs.append(os.path.join(prefix, "share", "openocd", "scripts"))
+        dirs.append(os.path.join(prefix, "scripts"))
+    dirs += ["/usr/share/openocd/scripts", "/usr/local/share/openocd/scripts",
+             "/opt/homebrew/share/openocd/scripts"]
+    return [d for d in dirs if os.path.isdir(d)]
+
+
+def _resolve_interface(cfg, project_root, script_dirs):
+    """Return the absolute path an OpenOCD -f argument would resolve to (or None)"""
+    local = os.path.join(project_root, cfg)
+    if os.path.exists(local):
+        return local
+    for d in script_dirs:
+        p = os.path.join(d, cfg)
+        if os.path.exists(p):
+            return p
+    return None
+
+
+def scan(openocd_interfaces=None, project_root="."):
+    """Probe all tools now; updates and returns the cache"""
+    tools = {}
+    for name in TOOLS:
+        path = shutil.which(name)
+        tools[name] = {
+            "available": path is not None,
+            "path": path,
+            "version": _tool_version(name, path) if path else None,
+        }
+
+    interfaces = {}
+    script_dirs = _openocd_script_dirs(tools["openocd"]["path"])
+    for debugger_id, cfg in (openocd_interfaces or {}).items():
+        resolved = _resolve_interface(cfg, project_root, script_dirs)
+        interfaces[debugger_id] = {
+            "config": cfg,
+            "available": tools["openocd"]["available"] and resolved is not None,
+            "path": resolved,
+        }
+
+    with _LOCK:
+        CACHE["tools"] = tools
+        CACHE["openocd_interfaces"] = interfaces
+        CACHE["scanned_at"] = datetime.now().isoformat(timespec='seconds')
+        _save()
+    return snapshot()
+
+
+def scan_async(openocd_interfaces=None, project_root="."):
+    t = threading.Thread(target=scan, args=(openocd_interfaces, project_root), name="toolchain-scan")
+    t.daemon = True
+    t.start()
+    return t
+
+
+def load(cache_file):
+    """Use `cache_file` for persistence and preload a previous scan from it"""
+    global _CACHE_FILE
+    _CACHE_FILE = cache_file
+    try:
+        with open(cache_file, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+    with _LOCK:
+        CACHE.update({k: data[k] for k in CACHE if k in data})
+
+
+def _save():
+    if not _CACHE_FILE:
+        return
+    try:
+        with open(_CACHE_FILE, "w") as f:
+            json.dump(CACHE, f, indent=1)
+    except OSError:
+        pass
+
+
+def snapshot():
+    with _LOCK:
+        return json.loads(json.dumps(CACHE))
+
+
+def has_tool(name):
+    """True if the tool is known to exist. Unknown (not yet scanned) counts as present."""
+    info = CACHE["tools"].get(name)
+    return True if info is None else bool(info.get("available"))
+
+
+def interface_available(debugger_id):
+    info = CACHE["openocd_interfaces"].get(str(debugger_id))
+    return True if info is None else bool(info.get("available"))
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Per-job span tracing.
+
+A trace is the timeline of one job: nested spans (flash_task ->
+check_hardware_connection -> generate_firmware -> perform_flash, each
+subprocess with its argv and exit code) with start time, duration,
+status and attributes. Finished traces are written as one compact JSON
+file per job under the tracer's root and can be exported in the
+OpenTelemetry (OTLP/JSON) format.
+
+The current trace is found through `resolve()` (the web app returns the
+id of the job its thread runs), so code outside a job pays one lookup
+and records nothing. A job's stages run one after another, possibly on
+other worker threads, so spans nest under whichever span of the trace
+is innermost open.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import threading
+import functools
+from contextlib import contextmanager
+
+TRACE_VERSION = 1
+MAX_SPANS = 2000          # per trace; an autoflash run records many cycles
+MAX_ATTR_LEN = 512
+TRACE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def _attr(value):
+    if isinstance(value, (bool, int, float)) or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        value = " ".join(str(v) for v in value)
+    value = str(value)
+    return value if len(value) <= MAX_ATTR_LEN else value[:MAX_ATTR_LEN] + "..."
+
+
+class Trace:
+    def __init__(self, key, name, attrs=None):
+        self.key = key
+        self.trace_id = uuid.uuid4().hex
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = []
+        self.stack = []           # open spans, innermost last
+        self.dropped = 0
+        self.root = self.start(name, attrs)
+
+    def _now_ms(self):
+        return round((time.perf_counter() - self.t0) * 1000, 3)
+
+    def start(self, name, attrs=None):
+        with self.lock:
+            if len(self.spans) >= MAX_SPANS:
+                self.dropped += 1
+                return None
+            span = {"id": len(self.spans) + 1, "parent": self.stack[-1]["id"] if self.stack else None,
+                    "name": name, "start": self._now_ms(), "dur": None, "status": "ok",
+                    "attrs": {k: _attr(v) for k, v in (attrs or {}).items()}}
+            self.spans.append(span)
+            self.stack.append(span)
+            return span
+
+    def end(self, span, error=None, extra=None):
+        """Close `span`; `extra` attributes are merged in ("status" sets the status)"""
+        if span is None:
+            return
+        extra = dict(extra or {})
+        with self.lock:
+            span["dur"] = round(self._now_ms() - span["start"], 3)
+            span["status"] = extra.pop("status", span["status"])
+            span["attrs"].update((k, _attr(v)) for k, v in extra.items())
+            if error is not None:
+                span["status"] = "error"
+                span["attrs"]["error.type"] = type(error).__name__
+                if str(error):
+                    span["attrs"]["error.message"] = _attr(str(error))
+            self.stack = [o for o in self.stack if o is not span]
+
+    def to_dict(self):
+        with self.lock:
+            spans = [dict(s, attrs=dict(s["attrs"])) for s in self.spans]
+        return {"version": TRACE_VERSION, "key": self.key, "trace_id": self.trace_id,
+                "started": self.started, "dropped": self.dropped, "spans": spans}
+
+
+class Tracer:
+    """Active traces in memory, finished ones in root/<key>.json (the newest `keep` are kept)"""
+
+    def __init__(self, root, resolve=None, keep=500):
+        self.root = root
+        self.resolve = resolve or (lambda: None)
+        self.keep = keep
+        self.active = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def current(self):
+        key = self.resolve()
+        return self.active.get(key) if key is not None else None
+
+    @contextmanager
+    def trace(self, key, name, **attrs):
+        """Root span of `key`'s trace; written to disk when the block exits"""
+        t = Trace(key, name, attrs)
+        with self.lock:
+            self.active[key] = t
+        error = None
+        try:
+            yield t.root
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            t.end(t.root, error)
+            with self.lock:
+                self.active.pop(key, None)
+            self._write(t)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        Child span of the current trace. Yields a dict for attributes known
+        only at the end (exit code...), "status": "error" marks a failure
+        that did not raise.
+        """
+        extra = {}
+        t = self.current()
+        if t is None:
+            yield extra
+            return
+        s = t.start(name, attrs)
+        error = None
+        try:
+            yield extra
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            t.end(s, error, extra)
+
+    def traced(self, func):
+        """Decorator: run `func` in a span named after it; a (False, ...) result marks it failed"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.span(func.__name__) as extra:
+                result = func(*args, **kwargs)
+                if isinstance(result, tuple) and result and result[0] is False:
+                    extra["status"] = "error"
+                return result
+        return wrapper
+
+    # --- Storage ---
+    def _path(self, key):
+        if not TRACE_ID_RE.match(str(key)):
+            raise ValueError(f"Invalid trace key: {key}")
+        return os.path.join(self.root, f"{key}.json")
+
+    def _write(self, t):
+        try:
+            path = self._path(t.key)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(t.to_dict(), f, separators=(",", ":"))
+            os.replace(tmp, path)
+            self._prune()
+        except (OSError, ValueError):
+            pass
+
+    def _prune(self):
+        try:
+            names = [n for n in os.listdir(self.root) if n.endswith(".json")]
+        except OSError:
+            return
+        if len(names) <= self.keep:
+            return
+        paths = [os.path.join(self.root, n) for n in names]
+        paths.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+        for path in paths[:len(paths) - self.keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def load(self, key):
+        """Trace dict of `key` (live if still running here), or None"""
+        t = self.active.get(key)
+        if t is not None:
+            return dict(t.to_dict(), running=True)
+        try:
+            with open(self._path(key), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+# --- OpenTelemetry export ---
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": "" if value is None else str(value)}
+
+
+def to_otlp(trace, service_name="nrf5-airtag-web"):
+    """A stored trace as an OTLP/JSON ExportTraceServiceRequest"""
+    start_ns = int(trace["started"] * 1e9)
+    span_id = lambda n: f"{n:016x}"
+    spans = []
+    for s in trace["spans"]:
+        begin = start_ns + int(s["start"] * 1e6)
+        end = begin + int((s["dur"] or 0) * 1e6)
+        span = {"traceId": trace["trace_id"], "spanId": span_id(s["id"]), "name": s["name"],
+                "kind": 1, "startTimeUnixNano": str(begin), "endTimeUnixNano": str(end),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s["attrs"].items()],
+                "status": {"code": 2, "message": s["attrs"].get("error.message", "")}
+                if s["status"] == "error" else {"code": 1}}
+        if s["parent"]:
+            span["parentSpanId"] = span_id(s["parent"])
+        spans.append(span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+        "scopeSpans": [{"scope": {"name": "tracing", "version": str(TRACE_VERSION)}, "spans": spans}]}]}
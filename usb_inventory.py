@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Background USB inventory of attached debug probes.
+
+One thread rescans the USB bus (sysfs on Linux, `ioreg` on macOS) every
+couple of seconds and keeps the list of recognised probes in memory. All
+callers (the `/api/detect_debugger` poll of every open browser tab, the
+pre-flash hardware check, the bridge) read that list instead of running
+their own scan, so detection cost no longer grows with the number of
+clients.
+"""
+import os
+import re
+import sys
+import threading
+import subprocess
+
+# (vendor id, product id or None for "any") -> (debugger id, display name)
+KNOWN_PROBES = {
+    (0x1366, None): ('1', "Segger J-Link"),
+    (0x0483, 0x3748): ('2', "ST-Link V2"),
+    (0x0483, 0x374A): ('2', "ST-Link V2-1"),
+    (0x0483, 0x374B): ('2', "ST-Link V2-1"),
+    (0x0483, 0x374D): ('2', "ST-Link V3"),
+    (0x0483, 0x374E): ('2', "ST-Link V3"),
+    (0x0483, 0x374F): ('2', "ST-Link V3"),
+    (0x0483, 0x3752): ('2', "ST-Link V2-1"),
+    (0x0483, 0x3753): ('2', "ST-Link V3"),
+    (0x0483, 0x3754): ('2', "ST-Link V3"),
+    (0x0D28, 0x0204): ('3', "DAPLink (CMSIS-DAP)"),
+    (0xC251, 0xF001): ('3', "DAPLink (CMSIS-DAP)"),
+    (0xC251, 0xF002): ('3', "DAPLink (CMSIS-DAP)"),
+}
+
+# Fallback on product strings for clones with odd VID/PIDs
+NAME_HINTS = [
+    ("J-Link", '1', "Segger J-Link"),
+    ("CMSIS-DAP", '3', "DAPLink (CMSIS-DAP)"),
+    ("DAPLink", '3', "DAPLink (CMSIS-DAP)"),
+    ("STLINK", '2', "ST-Link"),
+    ("ST-Link", '2', "ST-Link"),
+    ("Mbed", '3', "DAPLink (CMSIS-DAP)"),
+]
+
+SYSFS_USB = "/sys/bus/usb/devices"
+
+
+def classify(vid, pid, product=""):
+    """Return (debugger id, display name) for a USB device, or None if it is not a probe"""
+    hit = KNOWN_PROBES.get((vid, pid)) or KNOWN_PROBES.get((vid, None))
+    if hit:
+        debugger_id, name = hit
+        # Keep the J-Link model (OB / EDU / Plus) reported by the probe itself
+        if debugger_id == '1' and product and product.startswith("J-Link") and product != "J-Link":
+            name = f"Segger {product}"
+        return debugger_id, name
+    for hint, debugger_id, name in NAME_HINTS:
+        if hint.lower() in (product or "").lower():
+            return debugger_id, name
+    return None
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def scan_sysfs(root=SYSFS_USB):
+    """Linux: list USB devices from sysfs"""
+    devices = []
+    try:
+        entries = os.listdir(root)
+    except OSError:
+        return devices
+    for entry in entries:
+        d = os.path.join(root, entry)
+        vid = _read(os.path.join(d, "idVendor"))
+        pid = _read(os.path.join(d, "idProduct"))
+        if not vid or not pid:
+            continue  # interfaces, not devices
+        devices.append({
+            "vid": int(vid, 16),
+            "pid": int(pid, 16),
+            "serial": _read(os.path.join(d, "serial")),
+            "product": _read(os.path.join(d, "product")) or "",
+            "manufacturer": _read(os.path.join(d, "manufacturer")) or "",
+            "location": entry,
+        })
+    return devices
+
+
+_IOREG_PROP = re.compile(r'"([^"]+)" = (.+)$')
+
+
+def parse_ioreg(output):
+    """macOS: parse `ioreg -p IOUSB -l -w0` into device dicts"""
+    devices = []
+    current = None
+    for line in output.splitlines():
+        if "+-o " in line:
+            if current and "vid" in current:
+                devices.append(current)
+            current = {"product": "", "manufacturer": "", "serial": None,
+                       "location": line.split("+-o ", 1)[1].split("  <")[0].strip()}
+            continue
+        if current is None:
+            continue
+        m = _IOREG_PROP.search(line)
+        if not m:
+            continue
+        key, val = m.group(1), m.group(2).strip().strip('"')
+        if key == "idVendor":
+            current["vid"] = int(val)
+        elif key == "idProduct":
+            current["pid"] = int(val)
+        elif key in ("USB Serial Number", "kUSBSerialNumberString"):
+            current["serial"] = val
+        elif key in ("USB Product Name", "kUSBProductString"):
+            current["product"] = val
+        elif key in ("USB Vendor Name", "kUSBVendorString"):
+            current["manufacturer"] = val
+    if current and "vid" in current:
+        devices.append(current)
+    return devices
+
+
+def scan_ioreg():
+    output = subprocess.run(["ioreg", "-p", "IOUSB", "-l", "-w0"], capture_output=True,
+                            text=True, timeout=10).stdout
+    return parse_ioreg(output)
+
+
+def scan_usb():
+    """Raw USB device list for this platform (empty where unsupported)"""
+    if sys.platform.startswith("linux"):
+        return scan_sysfs()
+    if sys.platform == "darwin":
+        return scan_ioreg()
+    return []
+
+
+def find_probes(devices):
+    probes = []
+    for dev in devices:
+        hit = classify(dev["vid"], dev["pid"], dev.get("product", ""))
+        if not hit:
+            continue
+        debugger_id, name = hit
+        probes.append({
+            "debugger": debugger_id,
+            "name": name,
+            "vendor_id": f"{dev['vid']:04x}",
+            "product_id": f"{dev['pid']:04x}",
+            "serial": dev.get("serial"),
+            "product": dev.get("product", ""),
+            "manufacturer": dev.get("manufacturer", ""),
+            "location": dev.get("location"),
+        })
+    # Stable order: J-Link > DAPLink > ST-Link (same priority as the UI)
+    order = {'1': 0, '3': 1, '2': 2}
+    probes.sort(key=lambda p: (order.get(p["debugger"], 9), p["serial"] or ""))
+    return probes
+
+
+class UsbInventory:
+    """Keeps the attached probe list fresh from a single background thread"""
+
+    def __init__(self, interval=None, scan_func=None):
+        self.interval = interval or (1.0 if sys.platform.startswith("linux") else 2.0)
+        self.scan_func = scan_func or scan_usb
+        self.lock = threading.Lock()
+        self.probes = []
+        self.version = 0
+        self.error = None
+        self.listeners = []  # callables(added, removed)
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def start(self):
+        with self.start_lock:
+            if self.thread:
+                return
+            self.refresh()
+            self.thread = threading.Thread(target=self._run, name="usb-inventory")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def on_change(self, func):
+        self.listeners.append(func)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.refresh()
+
+    def refresh(self):
+        try:
+            probes = find_probes(self.scan_func())
+            error = None
+        except Exception as e:
+            probes, error = self.probes, str(e)
+        key = lambda p: (p["debugger"], p["serial"], p["location"])
+        with self.lock:
+            old = {key(p): p for p in self.probes}
+            new = {key(p): p for p in probes}
+            added = [new[k] for k in new if k not in old]
+            removed = [old[k] for k in old if k not in new]
+            self.probes = probes
+            self.error = error
+            if added or removed:
+                self.version += 1
+        if added or removed:
+            for func in self.listeners:
+                try:
+                    func(added, removed)
+                except Exception:
+                    pass
+
+    def list(self, debugger_id=None):
+        with self.lock:
+            probes = list(self.probes)
+        if debugger_id:
+            probes = [p for p in probes if p["debugger"] == str(debugger_id)]
+        return probes
+
+    def snapshot(self):
+        with self.lock:
+            return {"probes": list(self.probes), "version": self.version,
+                    "supported": sys.platform.startswith("linux") or sys.platform == "darwin",
+                    "error": self.error}
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Streaming ZIP writer.
+
+`stream_zip()` yields the archive chunk by chunk while reading its members,
+so a batch download can go straight into the HTTP response: no temporary
+file, memory bounded by the chunk size. The same generator writes bundles
+to disk (`write_zip()`).
+
+Compression is selectable per archive ("deflate", "store", "bzip2",
+"lzma"); members that are already compressed (zip bundles, images, ...)
+are always stored instead of being deflated a second time.
+"""
+import io
+import os
+import time
+import zipfile
+
+COMPRESSION = {
+    "store": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+COMPRESSED_SUFFIXES = (".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".zst", ".png", ".jpg", ".jpeg", ".pdf")
+
+CHUNK_SIZE = 64 * 1024
+
+
+def compression_method(name):
+    """zipfile constant for a compression name; ValueError if unknown"""
+    try:
+        return COMPRESSION[(name or "deflate").lower()]
+    except KeyError:
+        raise ValueError(f"Unknown compression: {name} (use {', '.join(COMPRESSION)})")
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, non-seekable buffer drained by the generator (zipfile then uses data descriptors)"""
+
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.pos
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def _member_info(arcname, path, data, method):
+    if path is not None:
+        st = os.stat(path)
+        mtime, size = st.st_mtime, st.st_size
+    else:
+        mtime, size = time.time(), len(data)
+    info = zipfile.ZipInfo(arcname, date_time=time.localtime(mtime)[:6])
+    if arcname.lower().endswith(COMPRESSED_SUFFIXES):
+        method = zipfile.ZIP_STORED
+    info.compress_type = method
+    info.file_size = size  # lets zipfile decide on ZIP64 up front
+    if arcname.endswith((".sh", ".bat")):
+        info.external_attr = 0o755 << 16
+    else:
+        info.external_attr = 0o644 << 16
+    return info
+
+
+def stream_zip(members, compression="deflate", chunk_size=CHUNK_SIZE):
+    """
+    Yield a zip archive of `members`: (arcname, path) or (arcname, bytes).
+    Missing files are skipped.
+    """
+    method = compression_method(compression)
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", compression=method, allowZip64=True) as zf:
+        for arcname, src in members:
+            path, data = (None, src) if isinstance(src, (bytes, bytearray)) else (src, None)
+            try:
+                info = _member_info(arcname, path, data, method)
+                f = open(path, "rb") if path is not None else io.BytesIO(data)
+            except OSError:
+                continue
+            with f, zf.open(info, "w") as dest:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def write_zip(path, members, compression="deflate"):
+    """Write `members` to `path` through stream_zip (atomic rename); returns the archive size"""
+    tmp = path + ".tmp"
+    size = 0
+    with open(tmp, "wb") as out:
+        for chunk in stream_zip(members, compression):
+            out.write(chunk)
+            size += len(chunk)
+    os.replace(tmp, path)
+    return size